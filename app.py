@@ -1,12 +1,28 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for
-from data_manager import load_data, save_data
+from flask import Flask, Response, render_template, request, jsonify, redirect, url_for, stream_with_context
+from data_manager import cache_stats, list_users, iter_users, iter_transactions, get_stats, get_recent_transactions, transaction, get_user, get_history, history_count, get_offers, get_offer, save_offer, delete_offer as remove_offer
 from plesk_api import PleskAPI
+from storage import TRANSACTION_TYPES, USER_SORTS
+import export
+import metrics
+from nowpayments import NOWPayments, credit_payments
+from webhook_queue import WebhookQueue, WebhookWorker
+from reconciler import PaymentReconciler
+from scheduler import reactivated
+import json
 import os
-from datetime import datetime, timedelta
+from datetime import date, datetime, timedelta
 
 app = Flask(__name__)
 app.secret_key = os.urandom(24)
 
+HISTORY_PAGE_SIZE = 20
+USERS_PAGE_SIZE = 50
+
+@app.template_filter('datetimeformat')
+def datetimeformat(value, format='%Y-%m-%d %H:%M'):
+    """Format an ISO timestamp"""
+    return datetime.fromisoformat(value).strftime(format)
+
 # Initialize Plesk API
 plesk = PleskAPI(
     host=os.getenv('PLESK_HOST'),
@@ -14,93 +30,132 @@ plesk = PleskAPI(
     password=os.getenv('PLESK_PASSWORD')
 )
 
+# Webhooks are acknowledged once queued, the worker applies them in batches
+nowpayments = NOWPayments(
+    api_key=os.getenv('NOWPAYMENTS_API_KEY'),
+    ipn_secret=os.getenv('NOWPAYMENTS_IPN_SECRET')
+)
+webhook_queue = WebhookQueue()
+webhook_worker = WebhookWorker(webhook_queue, credit_payments)
+# Polls NOWPayments for open payments whose webhook was lost
+payment_reconciler = PaymentReconciler(nowpayments, credit_payments)
+
+# With a webhook URL the Telegram bot runs inside this process and receives
+# its updates on /telegram/webhook instead of polling
+bot_runner = None
+if os.getenv('TELEGRAM_WEBHOOK_URL'):
+    from bot import PleskBot, WebhookRunner
+    bot_runner = WebhookRunner(
+        PleskBot(
+            os.getenv('TELEGRAM_BOT_TOKEN'),
+            {
+                'host': os.getenv('PLESK_HOST'),
+                'username': os.getenv('PLESK_USERNAME'),
+                'password': os.getenv('PLESK_PASSWORD')
+            },
+            {
+                'api_key': os.getenv('NOWPAYMENTS_API_KEY'),
+                'ipn_secret': os.getenv('NOWPAYMENTS_IPN_SECRET')
+            }
+        ),
+        webhook_url=os.getenv('TELEGRAM_WEBHOOK_URL'),
+        secret_token=os.getenv('TELEGRAM_WEBHOOK_SECRET')
+    )
+
 @app.route('/')
 def dashboard():
     """Admin dashboard with statistics"""
-    data = load_data()
-    
-    # Calculate statistics
-    total_users = len(data.get('users', []))
-    active_subscriptions = sum(1 for u in data.get('users', []) if u.get('subscription'))
-    total_revenue = sum(tx['amount'] for u in data.get('users', []) for tx in u.get('history', []) if tx['type'] == 'purchase')
-    
-    # Recent transactions
-    recent_transactions = []
-    for user in data.get('users', []):
-        for tx in user.get('history', [])[-5:]:  # Get last 5 transactions per user
-            recent_transactions.append({
-                'user_id': user['id'],
-                'username': user.get('username'),
-                'type': tx['type'],
-                'amount': tx['amount'],
-                'currency': tx.get('currency'),
-                'timestamp': tx['timestamp']
-            })
-    
-    # Sort by timestamp (newest first)
-    recent_transactions.sort(key=lambda x: x['timestamp'], reverse=True)
+    transaction_type = request.args.get('type') or None
+    if transaction_type is not None and transaction_type not in TRANSACTION_TYPES:
+        return jsonify({'error': f'type must be one of {", ".join(TRANSACTION_TYPES)}'}), 400
+    stats = get_stats()
+    recent_transactions = get_recent_transactions(10, transaction_type)
     
     return render_template('dashboard.html',
-        total_users=total_users,
-        active_subscriptions=active_subscriptions,
-        total_revenue=total_revenue,
-        recent_transactions=recent_transactions[:10]  # Show top 10
+        total_users=int(stats['total_users']),
+        active_subscriptions=int(stats['active_subscriptions']),
+        total_revenue=stats['total_revenue'],
+        recent_transactions=recent_transactions
     )
 
 @app.route('/users')
 def users():
-    """User management page"""
-    data = load_data()
-    return render_template('users.html', users=data.get('users', []))
+    """User management page, paginated and searchable"""
+    query = request.args.get('q', '').strip()
+    sort = request.args.get('sort', 'created')
+    if sort not in USER_SORTS:
+        sort = 'created'
+    descending = request.args.get('order', 'desc') == 'desc'
+    page = max(request.args.get('page', 1, type=int), 1)
+    rows, total = list_users(query or None, sort, descending, USERS_PAGE_SIZE, (page - 1) * USERS_PAGE_SIZE)
+    pages = max((total + USERS_PAGE_SIZE - 1) // USERS_PAGE_SIZE, 1)
+    return render_template('users.html', users=rows, total=total, page=page, pages=pages,
+                           q=query, sort=sort, order='desc' if descending else 'asc')
 
 @app.route('/user/<int:user_id>', methods=['GET', 'POST'])
 def user_detail(user_id):
     """View and edit user details"""
-    data = load_data()
-    user = next((u for u in data.get('users', []) if u['id'] == user_id), None)
+    user = get_user(user_id)
     
     if not user:
         return "User not found", 404
     
     if request.method == 'POST':
-        # Update user data
-        user['wallet_balance'] = float(request.form.get('wallet_balance', 0))
-        
+        expiry_date = request.form.get('expiry_date', '')
         if user.get('subscription'):
-            user['subscription']['expiry'] = request.form.get('expiry_date')
-            
-            # Update Plesk if needed
-            if 'plesk_plan_id' in request.form:
-                plesk.update_subscription(
-                    user['subscription']['plesk_client_id'],
-                    request.form['plesk_plan_id']
-                )
+            try:
+                date.fromisoformat(expiry_date)
+            except ValueError:
+                return "Invalid expiry date", 400
+
+        # Moving a suspended subscription's expiry forward reactivates it
+        subscription = user.get('subscription')
+        reactivate = bool(subscription) and subscription.get('status') == 'suspended' \
+            and expiry_date > (subscription.get('expiry') or '')[:10]
+        if reactivate and subscription.get('credentials', {}).get('domain'):
+            plesk.unsuspend_subscription(subscription['credentials']['domain'])
+
+        # Update Plesk if needed
+        if user.get('subscription') and 'plesk_plan_id' in request.form:
+            plesk.update_subscription(
+                user['subscription']['plesk_client_id'],
+                request.form['plesk_plan_id']
+            )
+        
+        # Update user data
+        with transaction() as tx:
+            tx.set_balance(user_id, float(request.form.get('wallet_balance', 0)))
+            if user.get('subscription'):
+                subscription = tx.get_user(user_id)['subscription']
+                if reactivate:
+                    subscription = reactivated(subscription)
+                subscription['expiry'] = expiry_date
+                tx.set_subscription(user_id, subscription)
         
-        save_data(data)
         return redirect(url_for('user_detail', user_id=user_id))
     
-    return render_template('user_detail.html', user=user)
+    page = max(request.args.get('page', 1, type=int), 1)
+    history = get_history(user_id, limit=HISTORY_PAGE_SIZE, offset=(page - 1) * HISTORY_PAGE_SIZE)
+    pages = max((history_count(user_id) + HISTORY_PAGE_SIZE - 1) // HISTORY_PAGE_SIZE, 1)
+    return render_template('user_detail.html', user=user, history=history, page=page, pages=pages)
 
 @app.route('/offers')
 def offers():
     """Offer management page"""
-    data = load_data()
-    return render_template('offers.html', offers=data.get('offers', []))
+    return render_template('offers.html', offers=get_offers())
 
 @app.route('/offer/add', methods=['GET', 'POST'])
 def add_offer():
     """Add new offer"""
     if request.method == 'POST':
-        data = load_data()
         new_offer = {
-            'id': len(data.get('offers', [])) + 1,
+            'id': None,
             'name': request.form.get('name'),
             'price': float(request.form.get('price')),
             'duration_days': int(request.form.get('duration_days')),
             'plesk_plan_id': request.form.get('plesk_plan_id')
         }
-        data['offers'].append(new_offer)
-        save_data(data)
+        save_offer(new_offer)
         return redirect(url_for('offers'))
     
     return render_template('add_offer.html')
@@ -108,8 +163,7 @@ def add_offer():
 @app.route('/offer/<int:offer_id>/edit', methods=['GET', 'POST'])
 def edit_offer(offer_id):
     """Edit existing offer"""
-    data = load_data()
-    offer = next((o for o in data.get('offers', []) if o['id'] == offer_id), None)
+    offer = get_offer(offer_id)
     
     if not offer:
         return "Offer not found", 404
@@ -119,7 +173,7 @@ def edit_offer(offer_id):
         offer['price'] = float(request.form.get('price'))
         offer['duration_days'] = int(request.form.get('duration_days'))
         offer['plesk_plan_id'] = request.form.get('plesk_plan_id')
-        save_data(data)
+        save_offer(offer)
         return redirect(url_for('offers'))
     
     return render_template('edit_offer.html', offer=offer)
@@ -127,30 +181,106 @@ def edit_offer(offer_id):
 @app.route('/offer/<int:offer_id>/delete', methods=['POST'])
 def delete_offer(offer_id):
     """Delete offer"""
-    data = load_data()
-    data['offers'] = [o for o in data.get('offers', []) if o['id'] != offer_id]
-    save_data(data)
+    remove_offer(offer_id)
     return redirect(url_for('offers'))
 
+@app.route('/cache-stats')
+def cache_stats_view():
+    """Data cache hit/miss counters"""
+    return jsonify(cache_stats())
+
+@app.route('/metrics')
+def metrics_view():
+    """Prometheus metrics of the admin app process"""
+    return Response(metrics.render(), content_type=metrics.CONTENT_TYPE)
+
+def _export_response(name, rows, fields):
+    """Stream rows as CSV or NDJSON (?format=), never holding the whole export"""
+    fmt = request.args.get('format', 'csv')
+    if fmt not in export.FORMATS:
+        return jsonify({'error': f'format must be one of {", ".join(export.FORMATS)}'}), 400
+    return Response(
+        stream_with_context(export.encode(rows, fields, fmt)),
+        mimetype=export.FORMATS[fmt],
+        headers={'Content-Disposition': f'attachment; filename={name}.{fmt}'}
+    )
+
+@app.route('/export/transactions')
+def export_transactions():
+    """Transactions filtered by ?start=&end= (ISO dates, end exclusive), ?type= and ?user_id="""
+    rows = iter_transactions(
+        start=request.args.get('start') or None,
+        end=request.args.get('end') or None,
+        transaction_type=request.args.get('type') or None,
+        user_id=request.args.get('user_id', type=int)
+    )
+    return _export_response('transactions', rows, export.TRANSACTION_FIELDS)
+
+@app.route('/export/users')
+def export_users():
+    """All users with their balance and subscription"""
+    rows = (export.user_row(user) for user in iter_users())
+    return _export_response('users', rows, export.USER_FIELDS)
+
 @app.route('/plesk')
 def plesk_actions():
     """Plesk API actions page"""
     return render_template('plesk.html')
 
+def _ids_from_request():
+    """IDs posted as a JSON list or a comma/whitespace separated string"""
+    ids = request.json.get('ids', [])
+    if isinstance(ids, str):
+        ids = ids.replace(',', ' ').split()
+    return ids
+
+@app.route('/plesk/bulk/update-plan', methods=['POST'])
+def plesk_bulk_update_plan():
+    """Move many subscriptions to a new plan"""
+    ids, plan_id = _ids_from_request(), request.json.get('plan_id')
+    if not ids or not plan_id:
+        return jsonify({'error': 'ids and plan_id are required'}), 400
+    results = plesk.bulk_update_subscriptions(ids, plan_id)
+    return jsonify({'results': results, 'failed': sum(1 for r in results if not r['ok'])})
+
+@app.route('/plesk/bulk/delete-clients', methods=['POST'])
+def plesk_bulk_delete_clients():
+    """Delete many clients"""
+    results = plesk.bulk_delete_clients(_ids_from_request())
+    return jsonify({'results': results, 'failed': sum(1 for r in results if not r['ok'])})
+
 @app.route('/webhook/nowpayments', methods=['POST'])
 def nowpayments_webhook():
-    """Handle NOWPayments webhook notifications"""
-    from nowpayments import NOWPayments
-    np = NOWPayments(
-        api_key=os.getenv('NOWPAYMENTS_API_KEY'),
-        ipn_secret=os.getenv('NOWPAYMENTS_IPN_SECRET')
-    )
-    
-    if np.verify_webhook(request.json, request.headers.get('x-nowpayments-sig')):
-        if np.process_webhook(request.json):
-            return jsonify({'status': 'success'}), 200
-    
-    return jsonify({'status': 'error'}), 400
+    """Verify a NOWPayments notification and queue it for the worker"""
+    body = request.get_data()
+    if not nowpayments.verify_webhook(body, request.headers.get('x-nowpayments-sig')):
+        return jsonify({'status': 'error'}), 400
+    try:
+        payload = json.loads(body)
+    except ValueError:
+        return jsonify({'status': 'error'}), 400
+    if not isinstance(payload, dict):
+        return jsonify({'status': 'error'}), 400
+
+    queued = webhook_queue.enqueue(payload)
+    webhook_worker.wake()
+    return jsonify({'status': 'queued' if queued else 'duplicate'}), 200
+
+@app.route('/telegram/webhook', methods=['POST'])
+def telegram_webhook():
+    """Updates pushed by Telegram, processed by the bot's event loop"""
+    if bot_runner is None:
+        return jsonify({'status': 'error'}), 404
+    if not bot_runner.check_secret(request.headers.get('X-Telegram-Bot-Api-Secret-Token')):
+        return jsonify({'status': 'error'}), 403
+    # Telegram redelivers the update if it does not get a 200
+    if not bot_runner.submit(request.get_json()):
+        return jsonify({'status': 'unavailable'}), 503
+    return jsonify({'status': 'ok'}), 200
 
 if __name__ == '__main__':
-    app.run(host='0.0.0.0', port=8000)
\ No newline at end of file
+    webhook_worker.start()
+    payment_reconciler.start()
+    if bot_runner:
+        bot_runner.start_in_thread()
+    app.run(host='0.0.0.0', port=8000)
@@ -0,0 +1,89 @@
+import gzip
+import json
+import os
+from snapshot import write_snapshot
+
+
+def month_of(timestamp):
+    """Archive segment ("YYYY-MM") an ISO timestamp belongs to"""
+    return timestamp[:7]
+
+
+class HistoryArchive:
+    """Compressed per-month segments of transactions moved out of the journal.
+
+    Each month is one gzip file of JSON lines (`YYYY-MM.jsonl.gz`, records
+    carry their user_id) next to `YYYY-MM.idx`, a JSON map of user_id to the
+    number of that user's records in the month. Segments are written whole
+    and atomically, and never change afterwards, so the index tells which
+    segments hold a user's records without decompressing anything.
+    """
+
+    def __init__(self, directory):
+        self.directory = directory
+        self._counts = {}
+
+    def _path(self, month, suffix):
+        return os.path.join(self.directory, f"{month}{suffix}")
+
+    def months(self):
+        """Months with a segment, oldest first"""
+        try:
+            names = os.listdir(self.directory)
+        except FileNotFoundError:
+            return []
+        return sorted(name[:-len(".idx")] for name in names if name.endswith(".idx"))
+
+    def write_month(self, month, entries):
+        """Store (user_id, record) pairs as the segment of `month`, replacing any previous one"""
+        os.makedirs(self.directory, exist_ok=True)
+        counts = {}
+        lines = []
+        for user_id, record in entries:
+            lines.append(json.dumps(dict(record, user_id=user_id), separators=(",", ":")).encode() + b"\n")
+            counts[str(user_id)] = counts.get(str(user_id), 0) + 1
+        write_snapshot(self._path(month, ".jsonl.gz"), gzip.compress(b"".join(lines)))
+        # The index is written last, a month is only listed once its segment is complete
+        write_snapshot(self._path(month, ".idx"), json.dumps(counts).encode())
+        self._counts[month] = {int(k): v for k, v in counts.items()}
+
+    def counts(self, month):
+        """Records per user_id in a month"""
+        if month not in self._counts:
+            with open(self._path(month, ".idx"), "rb") as f:
+                self._counts[month] = {int(k): v for k, v in json.load(f).items()}
+        return self._counts[month]
+
+    def scan(self, month, user_id=None):
+        """Yield (user_id, record) of a month in time order, optionally of one user"""
+        if user_id is not None and user_id not in self.counts(month):
+            return
+        with gzip.open(self._path(month, ".jsonl.gz"), "rb") as f:
+            for line in f:
+                record = json.loads(line)
+                record_user_id = record.pop("user_id")
+                if user_id is None or record_user_id == user_id:
+                    yield record_user_id, record
+
+    def read(self, user_id, limit=None, offset=0):
+        """Up to `limit` archived records of a user, skipping the `offset`
+        most recent ones, oldest first.
+
+        Only the segments holding the requested page are decompressed.
+        """
+        pages = []
+        for month in reversed(self.months()):
+            if limit is not None and limit <= 0:
+                break
+            count = self.counts(month).get(user_id, 0)
+            if offset >= count:
+                offset -= count
+                continue
+            records = [record for _, record in self.scan(month, user_id)]
+            end = count - offset
+            start = 0 if limit is None else max(end - limit, 0)
+            pages.append(records[start:end])
+            if limit is not None:
+                limit -= end - start
+            offset = 0
+        return [record for page in reversed(pages) for record in page]
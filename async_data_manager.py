@@ -0,0 +1,66 @@
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+import data_manager
+
+# Threads available for blocking storage calls made from the event loop
+DB_EXECUTOR_WORKERS = int(os.getenv("DB_EXECUTOR_WORKERS", "4"))
+
+_executor = None
+
+def get_executor():
+    """Return the bounded executor used for storage calls"""
+    global _executor
+    if _executor is None:
+        _executor = ThreadPoolExecutor(max_workers=DB_EXECUTOR_WORKERS, thread_name_prefix="data_manager")
+    return _executor
+
+async def run(func, *args, **kwargs):
+    """Run a blocking call on the storage executor without blocking the event loop"""
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(get_executor(), functools.partial(func, *args, **kwargs))
+
+async def in_transaction(func):
+    """Run func(tx) as one atomic write (data_manager.commit) and return its result"""
+    return await run(data_manager.commit, func)
+
+async def get_user(user_id):
+    """Get user by Telegram ID"""
+    return await run(data_manager.get_user, user_id)
+
+async def get_history(user_id, limit=None, offset=0):
+    """Get a page of a user's transactions, oldest first"""
+    return await run(data_manager.get_history, user_id, limit, offset)
+
+async def history_count(user_id):
+    """Number of transactions in a user's history, archived ones included"""
+    return await run(data_manager.history_count, user_id)
+
+async def add_user(user):
+    """Create a user, returns False if the ID is already taken"""
+    return await run(data_manager.add_user, user)
+
+async def update_wallet(user_id, amount):
+    """Update user's wallet balance"""
+    return await run(data_manager.update_wallet, user_id, amount)
+
+async def add_transaction(user_id, transaction_type, amount, currency=None):
+    """Add transaction to user history"""
+    return await run(data_manager.add_transaction, user_id, transaction_type, amount, currency)
+
+async def get_purchase(job_id):
+    """Charge marker recorded with a purchase, until its provisioning job is settled"""
+    return await run(data_manager.get_purchase, job_id)
+
+async def get_offers():
+    """Get all offers"""
+    return await run(data_manager.get_offers)
+
+async def get_offers_version():
+    """Catalog version, changes whenever an offer is added, edited or deleted"""
+    return await run(data_manager.get_offers_version)
+
+async def get_offer(offer_id):
+    """Get offer by ID"""
+    return await run(data_manager.get_offer, offer_id)
@@ -0,0 +1,98 @@
+"""Event-loop lag while bot-style handlers hit the data layer.
+
+Runs the same workload twice: calling data_manager directly on the event
+loop (how the handlers used to work) and through async_data_manager. A probe
+task sleeps for 1 ms in a loop and records how late it wakes up.
+
+    python benchmarks/event_loop_lag.py --users 20000 --concurrency 50
+"""
+import argparse
+import asyncio
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(int(len(values) * pct / 100), len(values) - 1)] if values else 0.0
+
+
+async def probe(lags, stop):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(0.001)
+        lags.append(time.perf_counter() - start - 0.001)
+
+
+async def run_workload(mode, users, concurrency, requests):
+    import data_manager
+    import async_data_manager as db
+
+    async def handler(user_id):
+        # Roughly what show_wallet + a deposit credit do
+        if mode == "sync":
+            data_manager.get_user(user_id)
+            data_manager.update_wallet(user_id, 1)
+        else:
+            await db.get_user(user_id)
+            await db.update_wallet(user_id, 1)
+
+    async def client(worker):
+        for i in range(requests):
+            await handler((worker * requests + i) % users + 1)
+
+    lags, stop = [], asyncio.Event()
+    probe_task = asyncio.create_task(probe(lags, stop))
+    start = time.perf_counter()
+    await asyncio.gather(*(client(w) for w in range(concurrency)))
+    elapsed = time.perf_counter() - start
+    stop.set()
+    await probe_task
+    return {
+        "mode": mode,
+        "handlers_per_s": concurrency * requests / elapsed,
+        "lag_p50_ms": percentile(lags, 50) * 1000,
+        "lag_p99_ms": percentile(lags, 99) * 1000,
+        "lag_max_ms": max(lags, default=0) * 1000,
+        "lag_mean_ms": statistics.fmean(lags) * 1000 if lags else 0.0,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=10000)
+    parser.add_argument("--concurrency", type=int, default=50)
+    parser.add_argument("--requests", type=int, default=20, help="handlers per concurrent client")
+    parser.add_argument("--backend", default="json", choices=["json", "sqlite"])
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_lag_")
+    os.environ["DB_BACKEND"] = args.backend
+    os.environ["DB_FILE"] = os.path.join(workdir, "users.db")
+    os.environ["SQLITE_FILE"] = os.path.join(workdir, "users.sqlite")
+    import data_manager
+
+    data_manager.save_data({
+        "users": [
+            {"id": i, "username": f"user{i}", "wallet_balance": 0, "subscription": None}
+            for i in range(1, args.users + 1)
+        ],
+        "offers": []
+    })
+
+    for mode in ("sync", "async"):
+        result = asyncio.run(run_workload(mode, args.users, args.concurrency, args.requests))
+        print(
+            f"{result['mode']:>5}: {result['handlers_per_s']:8.1f} handlers/s  "
+            f"loop lag p50 {result['lag_p50_ms']:7.2f} ms  p99 {result['lag_p99_ms']:7.2f} ms  "
+            f"max {result['lag_max_ms']:7.2f} ms"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,95 @@
+"""Synthetic users.db fixtures for the benchmarks.
+
+Datasets are deterministic for a given (users, seed): history lengths follow
+a geometric distribution (most users have a handful of transactions, a few
+have dozens), deposits precede purchases and every record falls within the
+last year. Fixtures are built once into a cache directory and copied into a
+scratch directory for each run, so runs never see each other's writes.
+"""
+import os
+import random
+import shutil
+import sys
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from storage import JSONStorage, migrate_json_to_sqlite
+
+HISTORY_MEAN = 6
+OFFERS = [
+    {"id": 1, "name": "Starter", "price": 5.0, "duration_days": 30, "plesk_plan_id": "starter"},
+    {"id": 2, "name": "Business", "price": 15.0, "duration_days": 30, "plesk_plan_id": "business"},
+    {"id": 3, "name": "Pro", "price": 40.0, "duration_days": 90, "plesk_plan_id": "pro"},
+]
+
+
+def generate(users, seed=1, history_mean=HISTORY_MEAN):
+    """Return (data, entries): the users.db document and its journal entries in time order"""
+    rng = random.Random(seed)
+    now = datetime(2024, 6, 1)
+    docs, entries = [], []
+    for user_id in range(1, users + 1):
+        created = now - timedelta(seconds=rng.randrange(365 * 86400))
+        balance = 0.0
+        subscription = None
+        count = min(int(rng.expovariate(1 / history_mean)), 200)
+        times = sorted(created + timedelta(seconds=rng.randrange(int((now - created).total_seconds()) + 1))
+                       for _ in range(count))
+        for when in times:
+            offer = rng.choice(OFFERS)
+            if balance >= offer["price"] and rng.random() < 0.4:
+                balance -= offer["price"]
+                record = {"type": "purchase", "amount": -offer["price"], "currency": None}
+                subscription = {
+                    "plan": offer["name"],
+                    "offer_id": offer["id"],
+                    "price": offer["price"],
+                    "duration_days": offer["duration_days"],
+                    "expiry": (when + timedelta(days=offer["duration_days"])).date().isoformat(),
+                    "plesk_client_id": user_id,
+                    "subscription_id": user_id,
+                    "credentials": {"username": f"u{user_id}", "password": "x", "domain": f"site{user_id}.example.com"}
+                }
+            else:
+                amount = float(rng.choice([5, 10, 20, 50, 100]))
+                balance += amount
+                record = {"type": "deposit", "amount": amount, "currency": rng.choice(["btc", "eth", "usdt", "ltc"])}
+            record["timestamp"] = when.isoformat()
+            entries.append((user_id, record))
+        docs.append({
+            "id": user_id,
+            "username": f"user{user_id}",
+            "wallet_balance": balance,
+            "subscription": subscription,
+            "created_at": created.isoformat()
+        })
+    entries.sort(key=lambda e: e[1]["timestamp"])
+    return {"users": docs, "offers": [dict(o) for o in OFFERS], "offers_version": 1}, entries
+
+
+def fixture_dir(cache, users, seed):
+    return os.path.join(cache, f"users-{users}-seed{seed}")
+
+
+def build(cache, users, seed=1):
+    """Build the JSON and SQLite fixtures for a size unless they are cached, returns their directory"""
+    path = fixture_dir(cache, users, seed)
+    if os.path.exists(os.path.join(path, "users.sqlite")):
+        return path
+    os.makedirs(path, exist_ok=True)
+    data, entries = generate(users, seed)
+    storage = JSONStorage(os.path.join(path, "users.db"))
+    storage.journal.append(entries)
+    storage.save(data)
+    storage.rebuild_stats()
+    migrate_json_to_sqlite(os.path.join(path, "users.db"), os.path.join(path, "users.sqlite"))
+    return path
+
+
+def checkout(fixture, workdir):
+    """Copy a cached fixture into a scratch directory"""
+    os.makedirs(workdir, exist_ok=True)
+    for name in os.listdir(fixture):
+        shutil.copy2(os.path.join(fixture, name), os.path.join(workdir, name))
+    return workdir
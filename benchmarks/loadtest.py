@@ -0,0 +1,438 @@
+"""Offline load test of the bot's handlers.
+
+Simulated Telegram users go through /start, the wallet and offer menus, a
+purchase and a deposit request. Synthetic updates reach the bot's Application
+through one of three runners: `direct` (process_update), `polling` (the bot
+long-polls the stub's getUpdates) or `webhook` (WebhookRunner, as behind
+/telegram/webhook). The Telegram Bot API, Plesk and NOWPayments are local stub
+servers with configurable latency, error rate and 429 responses, so nothing
+leaves the machine. Reports per-handler and end-to-end latency, event-loop
+lag and how many purchases and payment requests failed.
+
+    python benchmarks/loadtest.py --users 2000 --concurrency 500 --plesk-latency 300 --plesk-429-rate 0.05
+    python benchmarks/loadtest.py --runner polling --concurrent-updates 1
+    python benchmarks/loadtest.py --runner webhook --concurrent-updates 64
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import sys
+import tempfile
+import threading
+import time
+from collections import Counter
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlparse
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+TOKEN = "123456:LOADTEST"
+CURRENCIES = ["btc", "eth", "ltc", "usdt", "xmr", "doge", "trx", "bnb"]
+OFFER = {"id": None, "name": "Starter", "price": 5.0, "duration_days": 30, "plesk_plan_id": "starter"}
+# First user ID, far from real Telegram IDs in a copied database
+USER_ID_BASE = 10_000_000
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(int(len(values) * pct / 100), len(values) - 1)] if values else 0.0
+
+
+def summarize(latencies):
+    return {
+        "n": len(latencies),
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "max_ms": max(latencies, default=0) * 1000,
+        "mean_ms": statistics.fmean(latencies) * 1000 if latencies else 0.0,
+    }
+
+
+class StubServer(ThreadingHTTPServer):
+    """Local HTTP server answering with route(method, path, params) after `latency` seconds.
+
+    A share of requests fails with 500 (`error_rate`) or 429 (`throttle_rate`).
+    """
+
+    daemon_threads = True
+    request_queue_size = 1024
+
+    def __init__(self, route, latency=0.0, error_rate=0.0, throttle_rate=0.0):
+        super().__init__(("127.0.0.1", 0), StubHandler)
+        self.route = route
+        self.latency = latency
+        self.error_rate = error_rate
+        self.throttle_rate = throttle_rate
+        self.counts = Counter()
+        self._lock = threading.Lock()
+
+    @property
+    def url(self):
+        return f"http://127.0.0.1:{self.server_address[1]}"
+
+    def start(self):
+        threading.Thread(target=self.serve_forever, daemon=True).start()
+        return self
+
+    def count(self, name):
+        with self._lock:
+            self.counts[name] += 1
+            return self.counts[name]
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+
+    def _handle(self):
+        body = self.rfile.read(int(self.headers.get("Content-Length") or 0))
+        if self.headers.get("Content-Type", "").startswith("application/json"):
+            params = json.loads(body or b"{}")
+        else:
+            params = {key: values[0] for key, values in parse_qs(body.decode()).items()}
+        server = self.server
+        if server.latency:
+            time.sleep(server.latency)
+        roll = random.random()
+        if roll < server.throttle_rate:
+            server.count("429")
+            status, payload = 429, {"error": "Too Many Requests"}
+        elif roll < server.throttle_rate + server.error_rate:
+            server.count("500")
+            status, payload = 500, {"error": "Internal Server Error"}
+        else:
+            server.count("ok")
+            status, payload = 200, server.route(self.command, urlparse(self.path).path, params)
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _handle
+
+    def log_message(self, format, *args):
+        pass
+
+
+class Inbox:
+    """Updates waiting to be fetched with getUpdates"""
+
+    def __init__(self):
+        self._updates = []
+        self._ready = threading.Condition()
+
+    def put(self, update):
+        with self._ready:
+            self._updates.append(update)
+            self._ready.notify_all()
+
+    def fetch(self, offset, timeout, limit=100):
+        # Updates below offset are confirmed, like the real Bot API
+        with self._ready:
+            self._updates = [u for u in self._updates if u["update_id"] >= offset]
+            if not self._updates:
+                self._ready.wait(min(timeout, 1))
+            return self._updates[:limit]
+
+
+def telegram_route(server):
+    """Bot API stand-in; outgoing texts are counted by their first line"""
+    texts = Counter()
+    inbox = Inbox()
+
+    def route(method, path, params):
+        name = path.rsplit("/", 1)[-1]
+        if "text" in params:
+            texts[params["text"].splitlines()[0]] += 1
+        if name == "getUpdates":
+            result = inbox.fetch(int(params.get("offset") or 0), float(params.get("timeout") or 0))
+        elif name == "getMe":
+            result = {"id": 1, "is_bot": True, "first_name": "Load test", "username": "loadtest_bot"}
+        elif name == "sendMessage":
+            result = {
+                "message_id": server().count("message_id"), "date": int(time.time()),
+                "chat": {"id": int(params["chat_id"]), "type": "private"}, "text": params.get("text")
+            }
+        else:
+            result = True
+        return {"ok": True, "result": result}
+    return route, (texts, inbox)
+
+
+def plesk_route(server):
+    def route(method, path, params):
+        if method == "POST" and path.endswith(("/clients", "/subscriptions")):
+            return {"id": server().count("id")}
+        return {"code": 0}
+    return route
+
+
+def nowpayments_route(server):
+    def route(method, path, params):
+        if path.endswith("/currencies"):
+            return [{"currency": currency} for currency in CURRENCIES]
+        payment_id = server().count("payment_id")
+        return {
+            "payment_id": payment_id, "payment_status": "waiting",
+            "pay_address": f"addr{payment_id}", "expiration_estimate_date": "in 20 minutes"
+        }
+    return route
+
+
+def stub(route_factory, latency_ms, error_rate, throttle_rate):
+    servers = []
+    route = route_factory(lambda: servers[0])
+    extra = None
+    if isinstance(route, tuple):
+        route, extra = route
+    server = StubServer(route, latency_ms / 1000, error_rate, throttle_rate).start()
+    servers.append(server)
+    return server, extra
+
+
+class Updates:
+    """Builds synthetic Telegram updates (as the Bot API sends them) for simulated users"""
+
+    def __init__(self):
+        self._next = 0
+
+    def _id(self):
+        self._next += 1
+        return self._next
+
+    @staticmethod
+    def _user(user_id):
+        return {"id": user_id, "is_bot": False, "first_name": f"Load{user_id}", "username": f"load{user_id}"}
+
+    def _message(self, user_id, text, sender):
+        return {
+            "message_id": self._id(), "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"}, "from": sender, "text": text
+        }
+
+    def message(self, user_id, text):
+        message = self._message(user_id, text, self._user(user_id))
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"update_id": self._id(), "message": message}
+
+    def callback(self, user_id, data):
+        return {"update_id": self._id(), "callback_query": {
+            "id": str(self._id()), "from": self._user(user_id), "chat_instance": str(user_id), "data": data,
+            "message": self._message(user_id, "menu", {"id": 1, "is_bot": True, "first_name": "Load test"})
+        }}
+
+
+async def probe(lags, stop):
+    while not stop.is_set():
+        start = time.perf_counter()
+        await asyncio.sleep(0.001)
+        lags.append(time.perf_counter() - start - 0.001)
+
+
+async def run(args):
+    import async_data_manager as db
+    from bot import PleskBot, WebhookRunner
+    from nowpayments import credit_payments
+    from telegram import Update
+    from telegram.ext import TypeHandler
+
+    telegram, (texts, inbox) = stub(telegram_route, args.telegram_latency, 0, 0)
+    plesk, _ = stub(plesk_route, args.plesk_latency, args.plesk_error_rate, args.plesk_429_rate)
+    payments, _ = stub(nowpayments_route, args.payments_latency, args.payments_error_rate, args.payments_429_rate)
+
+    bot = PleskBot(
+        TOKEN,
+        {"host": None, "username": "admin", "password": "secret", "base_url": f"{plesk.url}/api/v2"},
+        {"api_key": "key", "ipn_secret": "secret", "base_url": f"{payments.url}/v1"},
+        telegram_base_url=f"{telegram.url}/bot",
+        concurrent_updates=args.concurrent_updates
+    )
+    bot.provisioning.retry_delay = args.retry_delay
+    application = bot.application
+    handler_errors = []
+
+    async def on_error(update, context):
+        handler_errors.append(repr(context.error))
+    application.add_error_handler(on_error)
+
+    offer_id = (await db.run(db.data_manager.save_offer, dict(OFFER)))["id"]
+    updates = Updates()
+    latencies = {}
+    sessions = []
+    runner = WebhookRunner(bot)
+
+    # With a runner in between, an update is done once a handler in a later group saw it
+    waiting = {}
+
+    async def handled(update, context):
+        done = waiting.pop(update.update_id, None)
+        if done:
+            done.set_result(None)
+    application.add_handler(TypeHandler(Update, handled), group=1)
+
+    async def deliver(payload):
+        if args.runner == "direct":
+            await application.process_update(Update.de_json(payload, application.bot))
+            return
+        done = waiting[payload["update_id"]] = asyncio.get_running_loop().create_future()
+        if args.runner == "webhook":
+            await runner.feed(payload)
+        else:
+            inbox.put(payload)
+        await done
+
+    async def step(name, payload):
+        start = time.perf_counter()
+        await deliver(payload)
+        latencies.setdefault(name, []).append(time.perf_counter() - start)
+
+    async def session(user_id):
+        start = time.perf_counter()
+        await step("start", updates.message(user_id, "/start"))
+        # A confirmed deposit, as the payment webhook worker would apply it
+        await db.run(credit_payments, [{
+            "payment_id": f"load-{user_id}", "payment_status": "finished",
+            "order_id": f"deposit_{user_id}_1", "price_amount": OFFER["price"], "pay_currency": "btc"
+        }])
+        for name, data in (("wallet", "wallet"), ("buy", "buy"), ("offer", f"offer_{offer_id}"),
+                           ("deposit", "deposit"), ("currency", f"currency_{CURRENCIES[0]}")):
+            await step(name, updates.callback(user_id, data))
+            if args.think:
+                await asyncio.sleep(random.uniform(0, args.think / 1000))
+        await step("deposit_amount", updates.message(user_id, "25"))
+        sessions.append(time.perf_counter() - start)
+
+    limit = asyncio.Semaphore(args.concurrency)
+
+    async def limited(user_id):
+        async with limit:
+            await session(user_id)
+
+    if args.runner == "webhook":
+        await runner.start()
+    else:
+        await application.initialize()
+        await bot.warm_up(application)
+        if args.runner == "polling":
+            await application.start()
+            await application.updater.start_polling(poll_interval=0, timeout=1)
+    lags, stop = [], asyncio.Event()
+    probe_task = asyncio.create_task(probe(lags, stop))
+    start = time.perf_counter()
+    await asyncio.gather(*(limited(USER_ID_BASE + i) for i in range(args.users)))
+    elapsed = time.perf_counter() - start
+
+    # Purchases finish in the background, wait for the provisioning workers
+    deadline = time.monotonic() + args.provisioning_timeout
+    while time.monotonic() < deadline:
+        counts = await db.run(bot.jobs.counts)
+        if not counts.get("queued") and not counts.get("running"):
+            break
+        await asyncio.sleep(0.2)
+    provisioned = time.perf_counter() - start
+    stop.set()
+    await probe_task
+    counts = await db.run(bot.jobs.counts)
+    if args.runner == "webhook":
+        await runner.stop()
+    else:
+        if args.runner == "polling":
+            await application.updater.stop()
+            await application.stop()
+        await bot.shutdown(application)
+        await application.shutdown()
+
+    return {
+        "runner": args.runner,
+        "concurrent_updates": args.concurrent_updates,
+        "users": args.users,
+        "concurrency": args.concurrency,
+        "elapsed_s": elapsed,
+        "sessions_per_s": args.users / elapsed,
+        "provisioning_s": provisioned,
+        "session": summarize(sessions),
+        "handlers": {name: summarize(values) for name, values in latencies.items()},
+        "event_loop_lag": summarize(lags),
+        "purchases": {
+            "accepted": texts["✅ Purchase accepted!"],
+            "succeeded": counts.get("done", 0),
+            "failed": counts.get("failed", 0),
+            "unfinished": counts.get("queued", 0) + counts.get("running", 0),
+            "rejected": texts["❌ Insufficient funds!"] + texts["⏳ Your previous purchase is still being set up."],
+        },
+        "payment_requests": {
+            "created": texts["💳 Payment Request Created"],
+            "failed": texts["❌ Failed to create payment request. Please try again later."],
+        },
+        "handler_errors": len(handler_errors),
+        "stubs": {
+            "telegram": dict(telegram.counts),
+            "plesk": dict(plesk.counts),
+            "nowpayments": dict(payments.counts),
+        },
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=1000, help="simulated Telegram users")
+    parser.add_argument("--concurrency", type=int, default=200, help="users active at once")
+    parser.add_argument("--think", type=float, default=0, help="max pause between clicks, ms")
+    parser.add_argument("--runner", default="direct", choices=["direct", "polling", "webhook"])
+    parser.add_argument("--concurrent-updates", type=int, default=64,
+                        help="updates the bot handles at once (polling/webhook runners), 1 = sequential")
+    parser.add_argument("--backend", default="json", choices=["json", "sqlite"])
+    parser.add_argument("--telegram-latency", type=float, default=30, help="ms")
+    parser.add_argument("--plesk-latency", type=float, default=200, help="ms")
+    parser.add_argument("--plesk-error-rate", type=float, default=0.0)
+    parser.add_argument("--plesk-429-rate", type=float, default=0.0)
+    parser.add_argument("--plesk-rate", type=float, help="override PLESK_RATE_LIMIT (requests/s)")
+    parser.add_argument("--payments-latency", type=float, default=150, help="ms")
+    parser.add_argument("--payments-error-rate", type=float, default=0.0)
+    parser.add_argument("--payments-429-rate", type=float, default=0.0)
+    parser.add_argument("--retry-delay", type=float, default=1, help="provisioning retry delay, s")
+    parser.add_argument("--provisioning-timeout", type=float, default=600, help="s")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--output", help="also write the results to this JSON file")
+    parser.add_argument("--verbose", action="store_true", help="show the bot's error log")
+    args = parser.parse_args()
+
+    random.seed(args.seed)
+    workdir = tempfile.mkdtemp(prefix="loadtest_")
+    os.environ.update({
+        "DB_BACKEND": args.backend,
+        "DB_FILE": os.path.join(workdir, "users.db"),
+        "SQLITE_FILE": os.path.join(workdir, "users.sqlite"),
+        "PROVISIONING_FILE": os.path.join(workdir, "provisioning.db"),
+        "WEBHOOK_QUEUE_FILE": os.path.join(workdir, "webhooks.db"),
+        "PLESK_RATE_LIMIT_FILE": os.path.join(workdir, "plesk.ratelimit"),
+    })
+    if args.plesk_rate:
+        os.environ["PLESK_RATE_LIMIT"] = str(args.plesk_rate)
+    if not args.verbose:
+        # Injected failures would flood the output
+        import logging
+        logging.disable(logging.ERROR)
+
+    result = asyncio.run(run(args))
+    print(f"{result['runner']} runner, {result['concurrent_updates']} concurrent updates, "
+          f"{result['users']} users, {result['concurrency']} concurrent: "
+          f"{result['sessions_per_s']:.1f} sessions/s, provisioning done after {result['provisioning_s']:.1f} s")
+    for name, stats in [("session", result["session"]), *result["handlers"].items(),
+                        ("loop lag", result["event_loop_lag"])]:
+        print(f"  {name:<15} p50 {stats['p50_ms']:9.2f} ms  p99 {stats['p99_ms']:9.2f} ms  max {stats['max_ms']:9.2f} ms")
+    print(f"  purchases       {result['purchases']}")
+    print(f"  payments        {result['payment_requests']}")
+    print(f"  handler errors  {result['handler_errors']}")
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,72 @@
+"""Encode/decode time and size of users.db in each snapshot format.
+
+Compares the old pretty-printed JSON with the compact JSON and msgpack
+serializers from snapshot.py on a synthetic document (see fixtures.py).
+Writes go through write_snapshot (temp file, fsync, rename), reads through
+read_snapshot (mmap).
+
+    python benchmarks/snapshot_formats.py --users 100000
+"""
+import argparse
+import json
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fixtures
+from snapshot import SERIALIZERS, get_serializer, read_snapshot, write_snapshot
+
+
+class PrettyJSON:
+    """What users.db was written as before: json.dump(data, f, indent=2)"""
+    name = "json (indent=2)"
+
+    def dumps(self, data):
+        return json.dumps(data, indent=2).encode()
+
+
+def timed(func, repeat):
+    samples = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        func()
+        samples.append(time.perf_counter() - start)
+    return statistics.median(samples)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--users", type=int, default=100000)
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--seed", type=int, default=1)
+    args = parser.parse_args()
+
+    data, _ = fixtures.generate(args.users, args.seed)
+    workdir = tempfile.mkdtemp(prefix="bench_snapshot_")
+    serializers = [PrettyJSON()]
+    for name in SERIALIZERS:
+        try:
+            serializers.append(get_serializer(name))
+        except RuntimeError as e:
+            print(f"skipping {name}: {e}", file=sys.stderr)
+
+    print(f"{args.users} users, median of {args.repeat} runs")
+    print(f"{'format':<16} {'size MB':>9} {'encode ms':>10} {'write ms':>9} {'decode ms':>10}")
+    for serializer in serializers:
+        path = os.path.join(workdir, "users.db")
+        payload = serializer.dumps(data)
+        encode = timed(lambda: serializer.dumps(data), args.repeat)
+        write = timed(lambda: write_snapshot(path, payload), args.repeat)
+        decode = timed(lambda: read_snapshot(path), args.repeat)
+        assert read_snapshot(path)["users"] == data["users"]
+        print(f"{serializer.name:<16} {len(payload) / 1e6:9.1f} {encode * 1000:10.1f} "
+              f"{write * 1000:9.1f} {decode * 1000:10.1f}")
+
+
+if __name__ == "__main__":
+    main()
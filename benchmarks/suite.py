@@ -0,0 +1,263 @@
+"""Benchmark suite for the data layer, the dashboard and the payment webhook.
+
+Runs every operation against synthetic fixtures of each size and backend and
+writes machine-readable results; `compare` diffs two result files and exits
+non-zero when an operation got slower than the threshold.
+
+    python benchmarks/suite.py run --sizes 1000,10000,100000 --output results.json
+    python benchmarks/suite.py compare baseline.json results.json --threshold 0.2
+
+Each (backend, size) runs in a fresh interpreter on its own copy of the
+fixture, because data_manager reads its configuration at import time.
+"""
+import argparse
+import hashlib
+import hmac
+import json
+import multiprocessing
+import os
+import platform
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+
+import fixtures
+
+IPN_SECRET = "benchmark-secret"
+OPERATIONS = [
+    "load_data", "get_user", "update_wallet", "add_transaction",
+    "dashboard", "webhook", "webhook_apply", "concurrent_writers",
+]
+
+
+def percentile(values, pct):
+    values = sorted(values)
+    return values[min(int(len(values) * pct / 100), len(values) - 1)] if values else 0.0
+
+
+def summarize(latencies, elapsed, **extra):
+    """Latency percentiles in ms and throughput for one operation"""
+    result = {
+        "n": len(latencies),
+        "p50_ms": percentile(latencies, 50) * 1000,
+        "p90_ms": percentile(latencies, 90) * 1000,
+        "p99_ms": percentile(latencies, 99) * 1000,
+        "max_ms": max(latencies, default=0) * 1000,
+        "mean_ms": statistics.fmean(latencies) * 1000 if latencies else 0.0,
+        "ops_per_s": len(latencies) / elapsed if elapsed else 0.0,
+    }
+    result.update(extra)
+    return result
+
+
+def timed(func, args_list):
+    latencies = []
+    start = time.perf_counter()
+    for args in args_list:
+        t = time.perf_counter()
+        func(*args)
+        latencies.append(time.perf_counter() - t)
+    return latencies, time.perf_counter() - start
+
+
+def _writer(user_ids, results):
+    import data_manager
+    latencies = []
+    for user_id in user_ids:
+        t = time.perf_counter()
+        data_manager.update_wallet(user_id, 1)
+        latencies.append(time.perf_counter() - t)
+    results.put(latencies)
+
+
+def bench_concurrent_writers(users, writers, per_writer, rng):
+    """update_wallet from several processes at once; checks that no update is lost"""
+    import data_manager
+    targets = [rng.randint(1, users) for _ in range(writers * per_writer)]
+    before = {user_id: data_manager.get_user(user_id)["wallet_balance"] for user_id in set(targets)}
+    context = multiprocessing.get_context("fork")
+    results = context.Queue()
+    procs = [
+        context.Process(target=_writer, args=(targets[i * per_writer:(i + 1) * per_writer], results))
+        for i in range(writers)
+    ]
+    start = time.perf_counter()
+    for proc in procs:
+        proc.start()
+    latencies = [lat for _ in procs for lat in results.get()]
+    for proc in procs:
+        proc.join()
+    elapsed = time.perf_counter() - start
+    expected = {user_id: before[user_id] + targets.count(user_id) for user_id in before}
+    lost = sum(round(expected[u] - data_manager.get_user(u)["wallet_balance"]) for u in expected)
+    return summarize(latencies, elapsed, writers=writers, lost_updates=lost)
+
+
+def run_one(backend, users, iterations, writers, seed, fixture_cache, operations):
+    """Benchmark one backend/size in this process, returns a list of result dicts"""
+    workdir = fixtures.checkout(fixtures.build(fixture_cache, users, seed), tempfile.mkdtemp(prefix="bench_"))
+    os.environ.update({
+        "DB_BACKEND": backend,
+        "DB_FILE": os.path.join(workdir, "users.db"),
+        "SQLITE_FILE": os.path.join(workdir, "users.sqlite"),
+        "WEBHOOK_QUEUE_FILE": os.path.join(workdir, "webhooks.db"),
+        "NOWPAYMENTS_IPN_SECRET": IPN_SECRET,
+    })
+    import data_manager
+    rng = random.Random(seed)
+    user_ids = [rng.randint(1, users) for _ in range(iterations)]
+    results = []
+
+    def record(op, result):
+        results.append(dict(result, backend=backend, users=users, op=op))
+
+    if "load_data" in operations:
+        # Full loads are slow at 100k users, a few samples are enough
+        record("load_data", summarize(*timed(data_manager.load_data, [()] * max(3, iterations // 50))))
+    if "get_user" in operations:
+        record("get_user", summarize(*timed(data_manager.get_user, [(u,) for u in user_ids])))
+    if "update_wallet" in operations:
+        record("update_wallet", summarize(*timed(data_manager.update_wallet, [(u, 1) for u in user_ids])))
+    if "add_transaction" in operations:
+        record("add_transaction", summarize(*timed(
+            data_manager.add_transaction, [(u, "deposit", 1.0, "btc") for u in user_ids]
+        )))
+
+    if {"dashboard", "webhook", "webhook_apply"} & set(operations):
+        import app
+        client = app.app.test_client()
+        if "dashboard" in operations:
+            def dashboard():
+                assert client.get("/").status_code == 200
+            record("dashboard", summarize(*timed(dashboard, [()] * iterations)))
+        if "webhook" in operations:
+            def webhook(n, user_id):
+                body = json.dumps({
+                    "payment_id": f"bench-{n}", "payment_status": "finished",
+                    "order_id": f"deposit_{user_id}_{n}", "price_amount": 10, "pay_currency": "btc"
+                }).encode()
+                signature = hmac.new(IPN_SECRET.encode(), body, hashlib.sha512).hexdigest()
+                response = client.post("/webhook/nowpayments", data=body,
+                                       headers={"x-nowpayments-sig": signature, "Content-Type": "application/json"})
+                assert response.status_code == 200
+            record("webhook", summarize(*timed(webhook, list(enumerate(user_ids)))))
+        if "webhook_apply" in operations:
+            # Queued notifications applied by the worker, one transaction per
+            # batch: latencies are per batch, throughput in events per second
+            latencies, applied = [], 0
+            start = time.perf_counter()
+            while True:
+                t = time.perf_counter()
+                handled = app.webhook_worker.apply_next_batch()
+                if not handled:
+                    break
+                latencies.append(time.perf_counter() - t)
+                applied += handled
+            elapsed = time.perf_counter() - start
+            record("webhook_apply", summarize(latencies, elapsed, n=applied, batches=len(latencies),
+                                              ops_per_s=applied / elapsed if elapsed else 0.0))
+
+    if "concurrent_writers" in operations:
+        record("concurrent_writers", bench_concurrent_writers(
+            users, writers, max(iterations // writers, 1), rng
+        ))
+    return results
+
+
+def run(args):
+    results = []
+    for backend in args.backends.split(","):
+        for users in (int(size) for size in args.sizes.split(",")):
+            print(f"{backend} {users} users ...", file=sys.stderr)
+            output = subprocess.run(
+                [sys.executable, __file__, "_one", backend, str(users), "--iterations", str(args.iterations),
+                 "--writers", str(args.writers), "--seed", str(args.seed), "--fixtures", args.fixtures,
+                 "--ops", args.ops],
+                check=True, capture_output=True, text=True
+            ).stdout
+            results.extend(json.loads(output))
+    report = {
+        "meta": {
+            "timestamp": datetime.now().isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "commit": subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT,
+                                     capture_output=True, text=True).stdout.strip() or None,
+            "args": {k: v for k, v in vars(args).items() if k != "func"},
+        },
+        "results": results,
+    }
+    for r in results:
+        print(f"{r['backend']:>6} {r['users']:>7} {r['op']:<18} p50 {r.get('p50_ms', 0):9.3f} ms  "
+              f"p99 {r.get('p99_ms', 0):9.3f} ms  {r['ops_per_s']:10.1f} ops/s"
+              + (f"  lost {r['lost_updates']}" if "lost_updates" in r else ""))
+    with open(args.output, "w") as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}", file=sys.stderr)
+
+
+def compare(args):
+    """Exit with 1 if any operation's p50 or throughput regressed past the threshold"""
+    def load(path):
+        with open(path) as f:
+            return {(r["backend"], r["users"], r["op"]): r for r in json.load(f)["results"]}
+    old, new = load(args.baseline), load(args.current)
+    regressions = 0
+    for key in sorted(old.keys() & new.keys()):
+        before, after = old[key], new[key]
+        throughput = after["ops_per_s"] / before["ops_per_s"] - 1 if before["ops_per_s"] else 0.0
+        latency = after["p50_ms"] / before["p50_ms"] - 1 if before.get("p50_ms") else 0.0
+        regressed = throughput < -args.threshold or latency > args.threshold
+        regressions += regressed
+        print(f"{key[0]:>6} {key[1]:>7} {key[2]:<18} p50 {latency:+7.1%}  throughput {throughput:+7.1%}"
+              + ("  REGRESSION" if regressed else ""))
+    sys.exit(1 if regressions else 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    def add_run_options(cmd):
+        cmd.add_argument("--iterations", type=int, default=200, help="samples per operation")
+        cmd.add_argument("--writers", type=int, default=4, help="processes in concurrent_writers")
+        cmd.add_argument("--seed", type=int, default=1)
+        cmd.add_argument("--fixtures", default=os.path.join(tempfile.gettempdir(), "plesk-bot-fixtures"),
+                         help="cache directory for generated datasets")
+        cmd.add_argument("--ops", default=",".join(OPERATIONS))
+
+    cmd = commands.add_parser("run", help="run the suite")
+    cmd.add_argument("--sizes", default="1000,10000,100000")
+    cmd.add_argument("--backends", default="json,sqlite")
+    cmd.add_argument("--output", default="bench_results.json")
+    add_run_options(cmd)
+    cmd.set_defaults(func=run)
+
+    cmd = commands.add_parser("compare", help="compare two result files")
+    cmd.add_argument("baseline")
+    cmd.add_argument("current")
+    cmd.add_argument("--threshold", type=float, default=0.2, help="allowed relative slowdown")
+    cmd.set_defaults(func=compare)
+
+    cmd = commands.add_parser("_one")
+    cmd.add_argument("backend")
+    cmd.add_argument("users", type=int)
+    add_run_options(cmd)
+    cmd.set_defaults(func=lambda a: print(json.dumps(run_one(
+        a.backend, a.users, a.iterations, a.writers, a.seed, a.fixtures, a.ops.split(",")
+    ))))
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,4 +1,9 @@
+import asyncio
+import hmac
 import logging
+import os
+import threading
+from contextlib import asynccontextmanager
 from telegram import InlineKeyboardButton, InlineKeyboardMarkup, Update
 from telegram.ext import (
     Application,
@@ -8,9 +13,12 @@ from telegram.ext import (
     MessageHandler,
     filters
 )
-from data_manager import get_user, update_wallet, add_transaction
-from plesk_api import PleskAPI
-from nowpayments import NOWPayments
+import async_data_manager as db
+from plesk_api import AsyncPleskAPI
+from nowpayments import NOWPayments, credit_payments
+from provisioning import JobStore, ProvisioningWorkers, WarmPool
+from scheduler import ExpiryScheduler
+import metrics
 import random
 import string
 
@@ -21,20 +29,181 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+OFFERS_PER_PAGE = 8
+HISTORY_PER_PAGE = 10
+# Telegram renders large inline keyboards poorly, so currencies are paged
+CURRENCIES_PER_PAGE = 24
+CURRENCY_COLUMNS = 3
+
+# Updates handled at once; one user's updates still run one after another
+BOT_CONCURRENT_UPDATES = int(os.getenv("BOT_CONCURRENT_UPDATES", "64"))
+
+HANDLER_SECONDS = metrics.histogram("bot_handler_seconds", "Bot handler latency by command or button", ["handler"])
+HANDLER_ERRORS = metrics.counter("bot_handler_errors_total", "Bot handlers that raised", ["handler"])
+# Callback data prefixes used as metric labels, anything else is counted as "other"
+CALLBACKS = {
+    "back", "wallet", "buy", "offerpage", "history", "historypage", "offer", "deposit", "currencypage", "currency"
+}
+
+
+class KeyedLock:
+    """One asyncio lock per key, dropped once nobody holds or waits for it.
+
+    Waiters are served in arrival order, so updates from the same user run
+    one at a time and in order while different users proceed in parallel.
+    """
+    
+    def __init__(self):
+        self._locks = {}
+    
+    @asynccontextmanager
+    async def hold(self, key):
+        entry = self._locks.get(key)
+        if entry is None:
+            entry = self._locks[key] = [asyncio.Lock(), 0]
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._locks[key]
+    
+    def __len__(self):
+        return len(self._locks)
+
+
+class MenuCache:
+    """Prebuilt menu texts and keyboards, rebuilt only when their source version changes"""
+    
+    def __init__(self):
+        self._views = {}
+    
+    def lookup(self, name, version):
+        """Return the cached view, or None if it is missing or was built from another version"""
+        cached = self._views.get(name)
+        return cached[1] if cached and cached[0] == version else None
+    
+    def store(self, name, version, view):
+        self._views[name] = (version, view)
+        return view
+
+
+def paginate(rows, per_page, page_prefix):
+    """Split keyboard rows into pages, each with Prev/Next and Back buttons"""
+    pages = [rows[i:i + per_page] for i in range(0, len(rows), per_page)] or [[]]
+    markups = []
+    for number, page_rows in enumerate(pages):
+        nav = []
+        if number > 0:
+            nav.append(InlineKeyboardButton("◀️ Prev", callback_data=f"{page_prefix}{number - 1}"))
+        if number < len(pages) - 1:
+            nav.append(InlineKeyboardButton("Next ▶️", callback_data=f"{page_prefix}{number + 1}"))
+        keyboard = list(page_rows)
+        if nav:
+            keyboard.append(nav)
+        keyboard.append([InlineKeyboardButton("🔙 Back", callback_data="back")])
+        markups.append(InlineKeyboardMarkup(keyboard))
+    return markups
+
+
+def history_keyboard(page, pages):
+    """Newer/Older buttons for a history page; pages are only read when opened"""
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton("◀️ Newer", callback_data=f"historypage_{page - 1}"))
+    if page < pages - 1:
+        nav.append(InlineKeyboardButton("Older ▶️", callback_data=f"historypage_{page + 1}"))
+    keyboard = [nav] if nav else []
+    keyboard.append([InlineKeyboardButton("🔙 Back", callback_data="back")])
+    return InlineKeyboardMarkup(keyboard)
+
+
+def build_offer_pages(offers):
+    rows = [
+        [InlineKeyboardButton(f"{offer['name']} - ${offer['price']}", callback_data=f"offer_{offer['id']}")]
+        for offer in offers
+    ]
+    return paginate(rows, OFFERS_PER_PAGE, "offerpage_")
+
+
+def build_currency_pages(currencies):
+    buttons = [
+        InlineKeyboardButton(currency.upper(), callback_data=f"currency_{currency}")
+        for currency in currencies
+    ]
+    rows = [buttons[i:i + CURRENCY_COLUMNS] for i in range(0, len(buttons), CURRENCY_COLUMNS)]
+    return paginate(rows, CURRENCIES_PER_PAGE // CURRENCY_COLUMNS, "currencypage_")
+
+
+MAIN_MENU = InlineKeyboardMarkup([
+    [InlineKeyboardButton("💰 My Wallet", callback_data="wallet")],
+    [InlineKeyboardButton("🛒 Buy Account", callback_data="buy")],
+    [InlineKeyboardButton("📜 History", callback_data="history")]
+])
+
+
 class PleskBot:
-    def __init__(self, token, plesk_config, nowpayments_config):
-        self.application = Application.builder().token(token).build()
-        self.plesk = PleskAPI(**plesk_config)
+    def __init__(self, token, plesk_config, nowpayments_config, telegram_base_url=None,
+                 concurrent_updates=BOT_CONCURRENT_UPDATES):
+        builder = (
+            Application.builder()
+            .token(token)
+            .post_init(self.warm_up)
+            .post_shutdown(self.shutdown)
+            .concurrent_updates(concurrent_updates if concurrent_updates > 1 else False)
+        )
+        if telegram_base_url:
+            # Another Bot API server, e.g. a local one
+            builder = builder.base_url(telegram_base_url)
+        self.application = builder.build()
+        self.plesk = AsyncPleskAPI(**plesk_config)
         self.nowpayments = NOWPayments(**nowpayments_config)
+        self.menus = MenuCache()
+        self.jobs = JobStore()
+        self.pool = WarmPool(self.jobs, self.plesk)
+        self.provisioning = ProvisioningWorkers(
+            self.jobs, self.plesk, self.provisioning_done,
+            pool=self.pool if self.pool.enabled else None
+        )
+        self.scheduler = ExpiryScheduler(self.plesk, notify=self.send_notice)
+        self.metrics_exporter = None
+        self.user_locks = KeyedLock()
         
         # Register handlers
-        self.application.add_handler(CommandHandler("start", self.start))
-        self.application.add_handler(CallbackQueryHandler(self.button_handler))
+        self.application.add_handler(CommandHandler("start", self._handler(self.start, "start")))
+        self.application.add_handler(CallbackQueryHandler(self._handler(self.button_handler)))
+        self.application.add_handler(
+            MessageHandler(filters.TEXT & ~filters.COMMAND, self._handler(self.handle_deposit_amount, "deposit_amount"))
+        )
+    
+    def _handler(self, callback, name=None):
+        """Wrap a handler to run one update per user at a time and record its latency,
+        labelled by name or the button pressed.
+        
+        Updates are processed concurrently, so without the per-user lock a
+        double tap on an offer could charge twice.
+        """
+        async def handler(update, context):
+            label = name
+            if label is None:
+                label = update.callback_query.data.split("_")[0]
+                label = label if label in CALLBACKS else "other"
+            user = update.effective_user
+            async with self.user_locks.hold(user.id if user else None):
+                with HANDLER_SECONDS.time(handler=label):
+                    try:
+                        return await callback(update, context)
+                    except Exception:
+                        HANDLER_ERRORS.inc(handler=label)
+                        raise
+        return handler
         
     async def start(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
         """Send welcome message with main menu"""
         user = update.effective_user
-        user_data = get_user(user.id)
+        user_data = await db.get_user(user.id)
         
         if not user_data:
             # Create new user if doesn't exist
@@ -42,25 +211,14 @@ class PleskBot:
                 "id": user.id,
                 "username": user.username,
                 "wallet_balance": 0,
-                "subscription": None,
-                "history": []
+                "subscription": None
             }
-            from data_manager import load_data, save_data
-            data = load_data()
-            data["users"].append(user_data)
-            save_data(data)
-        
-        keyboard = [
-            [InlineKeyboardButton("💰 My Wallet", callback_data="wallet")],
-            [InlineKeyboardButton("🛒 Buy Account", callback_data="buy")],
-            [InlineKeyboardButton("📜 History", callback_data="history")]
-        ]
-        reply_markup = InlineKeyboardMarkup(keyboard)
+            await db.add_user(user_data)
         
         await update.message.reply_text(
             f"👋 Welcome {user.first_name}!\n"
             "Please choose an option:",
-            reply_markup=reply_markup
+            reply_markup=MAIN_MENU
         )
 
     async def button_handler(self, update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -68,22 +226,30 @@ class PleskBot:
         query = update.callback_query
         await query.answer()
         
-        if query.data == "wallet":
+        if query.data == "back":
+            await query.edit_message_text("Please choose an option:", reply_markup=MAIN_MENU)
+        elif query.data == "wallet":
             await self.show_wallet(query)
         elif query.data == "buy":
             await self.show_offers(query)
+        elif query.data.startswith("offerpage_"):
+            await self.show_offers(query, int(query.data.split("_")[1]))
         elif query.data == "history":
             await self.show_history(query)
+        elif query.data.startswith("historypage_"):
+            await self.show_history(query, int(query.data.split("_")[1]))
         elif query.data.startswith("offer_"):
             await self.process_offer(query)
         elif query.data == "deposit":
             await self.request_deposit(query)
+        elif query.data.startswith("currencypage_"):
+            await self.request_deposit(query, int(query.data.split("_")[1]))
         elif query.data.startswith("currency_"):
-            await self.create_payment(query)
+            await self.create_payment(query, context)
     
     async def show_wallet(self, query):
         """Display user's wallet balance and options"""
-        user = get_user(query.from_user.id)
+        user = await db.get_user(query.from_user.id)
         balance = user.get("wallet_balance", 0)
         
         keyboard = [
@@ -98,36 +264,24 @@ class PleskBot:
             reply_markup=reply_markup
         )
     
-    async def show_offers(self, query):
+    async def show_offers(self, query, page=0):
         """Display available Plesk account offers"""
-        from data_manager import load_data
-        data = load_data()
-        offers = data.get("offers", [])
-        
-        keyboard = []
-        for offer in offers:
-            keyboard.append([
-                InlineKeyboardButton(
-                    f"{offer['name']} - ${offer['price']}",
-                    callback_data=f"offer_{offer['id']}"
-                )
-            ])
-        keyboard.append([InlineKeyboardButton("🔙 Back", callback_data="back")])
-        reply_markup = InlineKeyboardMarkup(keyboard)
+        version = await db.get_offers_version()
+        pages = self.menus.lookup("offers", version)
+        if pages is None:
+            pages = self.menus.store("offers", version, build_offer_pages(await db.get_offers()))
         
         await query.edit_message_text(
             "🛒 Available Plesk Accounts:\n\n"
             "Please select an offer:",
-            reply_markup=reply_markup
+            reply_markup=pages[min(page, len(pages) - 1)]
         )
     
     async def process_offer(self, query):
         """Process user's selection of an offer"""
         offer_id = int(query.data.split("_")[1])
-        from data_manager import load_data
-        data = load_data()
-        offer = next((o for o in data["offers"] if o["id"] == offer_id), None)
-        user = get_user(query.from_user.id)
+        offer = await db.get_offer(offer_id)
+        user = await db.get_user(query.from_user.id)
         
         if not offer:
             await query.edit_message_text("❌ Offer not found!")
@@ -145,87 +299,109 @@ class PleskBot:
             )
             return
         
-        # Process purchase
-        if not user.get("subscription"):
-            # Create new Plesk client
-            client = self.plesk.create_client()
-            subscription = self.plesk.create_subscription(
-                client["plesk_client_id"],
-                offer["plesk_plan_id"]
-            )
-            
-            # Update user data
-            user["subscription"] = {
-                "plan": offer["name"],
-                "expiry": "2024-12-31",  # Should calculate based on duration
-                "plesk_client_id": client["plesk_client_id"],
-                "credentials": {
-                    "username": client["username"],
-                    "password": client["password"],
-                    "domain": subscription["domain"]
-                }
-            }
-            update_wallet(query.from_user.id, -offer["price"])
-            add_transaction(
-                user_id=query.from_user.id,
-                transaction_type="purchase",
-                amount=-offer["price"]
-            )
-            
-            # Send credentials to user
+        kind = "update" if user.get("subscription") else "new"
+        if await db.run(self.jobs.active_for, query.from_user.id):
             await query.edit_message_text(
-                "🎉 Purchase Successful!\n\n"
-                f"🔑 Username: {client['username']}\n"
-                f"🔒 Password: {client['password']}\n"
-                f"🌐 Domain: {subscription['domain']}\n\n"
-                "Thank you for your purchase!",
+                "⏳ Your previous purchase is still being set up.\n"
+                "You will get a message as soon as it is ready.",
                 reply_markup=InlineKeyboardMarkup([
                     [InlineKeyboardButton("🏠 Main Menu", callback_data="back")]
                 ])
             )
-        else:
-            # Existing user - just update subscription
-            self.plesk.update_subscription(
-                user["subscription"]["plesk_client_id"],
-                offer["plesk_plan_id"]
-            )
-            update_wallet(query.from_user.id, -offer["price"])
-            add_transaction(
+            return
+        
+        # Reserve the funds now, Plesk is called by the provisioning workers.
+        # The job exists before the charge, and the charge records a marker for
+        # it, so a crash in between is settled when the workers start.
+        job_id = await self.provisioning.reserve(query.from_user.id, query.message.chat_id, kind, offer)
+        
+        def charge(tx):
+            current = tx.get_user(query.from_user.id)
+            if current.get("wallet_balance", 0) < offer["price"]:
+                return False
+            tx.adjust_balance(query.from_user.id, -offer["price"])
+            tx.add_transaction(
                 user_id=query.from_user.id,
                 transaction_type="purchase",
                 amount=-offer["price"]
             )
-            
+            tx.set_purchase(job_id, {"user_id": query.from_user.id, "amount": offer["price"], "state": "charged"})
+            return True
+        
+        try:
+            charged = await db.in_transaction(charge)
+        except Exception:
+            await self.provisioning.settle(job_id)
+            raise
+        
+        if not charged:
+            await db.run(self.jobs.cancel, job_id)
             await query.edit_message_text(
-                "🎉 Subscription Updated!\n\n"
-                f"Your account has been upgraded to {offer['name']}",
+                "❌ Insufficient funds!",
                 reply_markup=InlineKeyboardMarkup([
                     [InlineKeyboardButton("🏠 Main Menu", callback_data="back")]
                 ])
             )
-    
-    async def request_deposit(self, query):
-        """Show deposit options with supported cryptocurrencies"""
-        currencies = self.nowpayments.get_currencies()
+            return
         
-        keyboard = []
-        for currency in currencies:
-            keyboard.append([
-                InlineKeyboardButton(
-                    currency.upper(),
-                    callback_data=f"currency_{currency}"
-                )
+        await self.provisioning.submit(job_id)
+        await query.edit_message_text(
+            "✅ Purchase accepted!\n\n"
+            f"Your {offer['name']} account is being set up. "
+            "You will get a message as soon as it is ready.",
+            reply_markup=InlineKeyboardMarkup([
+                [InlineKeyboardButton("🏠 Main Menu", callback_data="back")]
             ])
-        keyboard.append([InlineKeyboardButton("🔙 Back", callback_data="back")])
-        reply_markup =InlineKeyboardMarkup(keyboard)
+        )
+    
+    async def provisioning_done(self, job, subscription, error):
+        """Tell the buyer how their purchase went"""
+        if error:
+            text = (
+                "❌ We could not set up your account.\n"
+                f"${job['offer']['price']} has been refunded to your wallet."
+            )
+        elif job["kind"] == "new":
+            credentials = subscription["credentials"]
+            text = (
+                "🎉 Purchase Successful!\n\n"
+                f"🔑 Username: {credentials['username']}\n"
+                f"🔒 Password: {credentials['password']}\n"
+                f"🌐 Domain: {credentials['domain']}\n\n"
+                "Thank you for your purchase!"
+            )
+        else:
+            text = (
+                "🎉 Subscription Updated!\n\n"
+                f"Your account has been upgraded to {job['offer']['name']}"
+            )
+        await self.send_notice(job["chat_id"] or job["user_id"], text)
+    
+    async def send_notice(self, user_id, text):
+        """Message a user outside of a conversation"""
+        try:
+            await self.application.bot.send_message(
+                user_id, text,
+                reply_markup=InlineKeyboardMarkup([[InlineKeyboardButton("🏠 Main Menu", callback_data="back")]])
+            )
+        except Exception as e:
+            logger.error(f"Could not notify user {user_id}: {str(e)}")
+    
+    async def request_deposit(self, query, page=0):
+        """Show deposit options with supported cryptocurrencies"""
+        currencies = await asyncio.to_thread(self.nowpayments.get_currencies)
+        version = tuple(currencies)
+        pages = self.menus.lookup("currencies", version)
+        if pages is None:
+            pages = self.menus.store("currencies", version, build_currency_pages(currencies))
         
         await query.edit_message_text(
             "💳 Deposit Funds\n\n"
             "Select cryptocurrency:",
-            reply_markup=reply_markup
+            reply_markup=pages[min(page, len(pages) - 1)]
         )
     
-    async def create_payment(self, query):
+    async def create_payment(self, query, context):
         """Create a crypto payment invoice"""
         currency = query.data.split("_")[1]
         order_id = f"deposit_{query.from_user.id}_{random.randint(1000, 9999)}"
@@ -258,13 +434,20 @@ class PleskBot:
         user_id = update.effective_user.id
         
         try:
-            payment = self.nowpayments.create_payment(
+            payment = await asyncio.to_thread(
+                self.nowpayments.create_payment,
                 amount=amount,
                 currency=currency,
                 order_id=order_id,
                 user_id=user_id
             )
             
+            # Recorded as pending, so the reconciler can credit it if its webhook is lost
+            try:
+                await db.run(credit_payments, [dict(payment, order_id=order_id, price_amount=amount)])
+            except Exception as e:
+                logger.error(f"Recording payment {payment.get('payment_id')} failed: {str(e)}")
+            
             await update.message.reply_text(
                 f"💳 Payment Request Created\n\n"
                 f"Amount: ${amount:.2f}\n"
@@ -284,10 +467,13 @@ class PleskBot:
         # Clear context
         context.user_data.clear()
     
-    async def show_history(self, query):
-        """Show user's transaction history"""
-        user = get_user(query.from_user.id)
-        history = user.get("history", [])
+    async def show_history(self, query, page=0):
+        """Show user's transaction history, newest page first.
+
+        Older pages are read from the history archive once they reach past the journal.
+        """
+        user_id = query.from_user.id
+        history = await db.get_history(user_id, limit=HISTORY_PER_PAGE, offset=page * HISTORY_PER_PAGE)
         
         if not history:
             await query.edit_message_text(
@@ -298,10 +484,11 @@ class PleskBot:
             )
             return
         
-        history_text = "📜 Transaction History:\n\n"
-        for tx in history[-10:]:  # Show last 10 transactions
+        pages = (await db.history_count(user_id) + HISTORY_PER_PAGE - 1) // HISTORY_PER_PAGE
+        history_text = f"📜 Transaction History ({page + 1}/{pages}):\n\n"
+        for tx in reversed(history):
             amount = f"+${tx['amount']}" if tx['amount'] > 0 else f"-${abs(tx['amount'])}"
-            currency = tx.get('currency', '').upper()
+            currency = (tx.get('currency') or '').upper()
             history_text += (
                 f"🕒 {tx['timestamp']}\n"
                 f"💵 {amount} {currency}\n"
@@ -310,16 +497,114 @@ class PleskBot:
         
         await query.edit_message_text(
             history_text,
-            reply_markup=InlineKeyboardMarkup([
-                [InlineKeyboardButton("🔙 Back", callback_data="back")]
-            ])
+            reply_markup=history_keyboard(page, pages)
         )
     
+    async def warm_up(self, application):
+        """Start the metrics exporter and background workers, and load the currency list
+        before the first Deposit click"""
+        if metrics.METRICS_PORT:
+            self.metrics_exporter = metrics.start_exporter(metrics.METRICS_PORT)
+        await self.provisioning.start()
+        await self.scheduler.start()
+        try:
+            await asyncio.to_thread(self.nowpayments.get_currencies)
+        except Exception as e:
+            logger.warning(f"Could not preload currencies: {str(e)}")
+    
+    async def shutdown(self, application):
+        """Stop the background workers and release pooled connections"""
+        await self.scheduler.stop()
+        await self.provisioning.stop()
+        await self.plesk.aclose()
+        if self.metrics_exporter:
+            await asyncio.to_thread(self.metrics_exporter.shutdown)
+    
     def run(self):
-        """Start the bot"""
-        # Add handler for deposit amount
-        self.application.add_handler(
-            MessageHandler(filters.TEXT & ~filters.COMMAND, self.handle_deposit_amount)
-        )
+        """Start the bot, polling Telegram for updates"""
+        self.application.run_polling()
+
+
+class WebhookRunner:
+    """Runs a PleskBot from updates Telegram posts to a webhook.
+
+    The Flask app hands each request body to submit(); the bot itself runs on
+    its own event loop in a background thread (start_in_thread), handling up
+    to the bot's concurrent_updates at once. start()/stop()/feed() are the
+    same steps for callers that already run an event loop.
+    """
+    
+    def __init__(self, bot, webhook_url=None, secret_token=None):
+        self.bot = bot
+        self.webhook_url = webhook_url
+        self.secret_token = secret_token
+        self.running = False
+        self._loop = None
+        self._thread = None
+    
+    def check_secret(self, header):
+        """Whether a request carries the secret token the webhook was registered with"""
+        if not self.secret_token:
+            return True
+        return header is not None and hmac.compare_digest(header, self.secret_token)
+    
+    async def start(self):
+        application = self.bot.application
+        await application.initialize()
+        await self.bot.warm_up(application)
+        await application.start()
+        if self.webhook_url:
+            await application.bot.set_webhook(
+                self.webhook_url, secret_token=self.secret_token, allowed_updates=Update.ALL_TYPES
+            )
+        self.running = True
+    
+    async def stop(self):
+        self.running = False
+        application = self.bot.application
+        await application.stop()
+        await self.bot.shutdown(application)
+        await application.shutdown()
+    
+    async def feed(self, payload):
+        """Queue one update (the decoded webhook body) for processing"""
+        application = self.bot.application
+        await application.update_queue.put(Update.de_json(payload, application.bot))
+    
+    def start_in_thread(self):
+        """Start the bot on a background event loop, returns once it is running"""
+        started = threading.Event()
+        error = []
         
-        self.application.run_polling()
\ No newline at end of file
+        def run():
+            self._loop = asyncio.new_event_loop()
+            asyncio.set_event_loop(self._loop)
+            try:
+                self._loop.run_until_complete(self.start())
+            except Exception as e:
+                error.append(e)
+                started.set()
+                return
+            started.set()
+            self._loop.run_forever()
+            self._loop.run_until_complete(self.stop())
+            self._loop.close()
+        
+        self._thread = threading.Thread(target=run, name="telegram-bot", daemon=True)
+        self._thread.start()
+        started.wait()
+        if error:
+            raise error[0]
+    
+    def stop_thread(self):
+        if self._thread:
+            self._loop.call_soon_threadsafe(self._loop.stop)
+            self._thread.join()
+            self._thread = None
+    
+    def submit(self, payload):
+        """Hand an update over from another thread, False if the bot is not running"""
+        if not self.running:
+            return False
+        asyncio.run_coroutine_threadsafe(self.feed(payload), self._loop)
+        return True
\ No newline at end of file
@@ -0,0 +1,73 @@
+import logging
+import threading
+import time
+
+logger = logging.getLogger(__name__)
+
+
+class TTLCache:
+    """Thread-safe TTL cache with stale-while-revalidate refresh.
+
+    Fresh values are returned from memory. An expired value is still
+    returned while a single background thread reloads it, and if the reload
+    fails the last-known value keeps being served (retried after
+    `retry_after` seconds). Only a key that was never loaded blocks on its
+    loader.
+    """
+
+    def __init__(self, ttl, retry_after=60):
+        self.ttl = ttl
+        self.retry_after = retry_after
+        self._entries = {}
+        self._refreshing = set()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+    def get(self, key, loader):
+        """Return the cached value for key, calling loader() to fill or refresh it"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                value, expires_at = entry
+                if now < expires_at:
+                    self.hits += 1
+                    return value
+                self.stale_hits += 1
+                if key not in self._refreshing:
+                    self._refreshing.add(key)
+                    threading.Thread(target=self._refresh, args=(key, loader), daemon=True).start()
+                return value
+            self.misses += 1
+        value = loader()
+        self.set(key, value)
+        return value
+
+    def set(self, key, value):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + self.ttl)
+
+    def _refresh(self, key, loader):
+        try:
+            self.set(key, loader())
+        except Exception as e:
+            logger.warning(f"Refreshing {key!r} failed, serving stale value: {e}")
+            with self._lock:
+                value, _ = self._entries[key]
+                self._entries[key] = (value, time.monotonic() + self.retry_after)
+        finally:
+            with self._lock:
+                self._refreshing.discard(key)
+
+    def invalidate(self, key=None):
+        """Drop one key, or everything"""
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+    def stats(self):
+        return {"hits": self.hits, "stale_hits": self.stale_hits, "misses": self.misses}
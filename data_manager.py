@@ -1,59 +1,265 @@
-import json
 import os
-import fcntl
-from datetime import datetime
+import threading
+import time
+from contextlib import contextmanager
+from storage import JSONStorage, SQLiteStorage
+import metrics
 
-DB_FILE = "users.db"
+DB_BACKEND = os.getenv("DB_BACKEND", "json")
+DB_FILE = os.getenv("DB_FILE", "users.db")
+SQLITE_FILE = os.getenv("SQLITE_FILE", "users.sqlite")
+# Writes arriving within this many ms are committed together (JSON backend), 0 commits each on its own
+WRITE_BATCH_WINDOW_MS = float(os.getenv("WRITE_BATCH_WINDOW_MS", "5"))
+# A batch is committed early once it holds this many writes
+WRITE_BATCH_MAX_OPS = int(os.getenv("WRITE_BATCH_MAX_OPS", "100"))
+# Transactions older than this many days (rounded down to the month) are archived by compact-history
+HISTORY_RETENTION_DAYS = int(os.getenv("HISTORY_RETENTION_DAYS", "365"))
 
-def load_data():
-    """Load data from the local database file"""
-    if not os.path.exists(DB_FILE):
-        return {"users": [], "offers": []}
-    
-    with open(DB_FILE, "r") as f:
-        fcntl.flock(f, fcntl.LOCK_SH)
+_storage = None
+_committer = None
+
+OPERATION_SECONDS = metrics.histogram(
+    "data_operation_seconds", "load_data, save_data and transaction() latency, lock wait included", ["operation"]
+)
+FILE_BYTES = metrics.gauge("storage_file_bytes", "Size of the store's files", ["file"])
+BATCH_OPS = metrics.histogram(
+    "storage_commit_batch_ops", "Writes per group commit", buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500)
+)
+
+@metrics.on_collect
+def _collect_file_sizes():
+    if DB_BACKEND == "sqlite":
+        paths = (SQLITE_FILE, SQLITE_FILE + "-wal")
+    else:
+        paths = (DB_FILE, DB_FILE + ".journal", DB_FILE + ".journal.idx")
+    for path in paths:
         try:
-            return json.load(f)
-        finally:
-            fcntl.flock(f, fcntl.LOCK_UN)
+            FILE_BYTES.set(os.path.getsize(path), file=os.path.basename(path))
+        except OSError:
+            pass
 
-def save_data(data):
-    """Save data to the local database file with file locking"""
-    with open(DB_FILE, "w") as f:
-        fcntl.flock(f, fcntl.LOCK_EX)
+def get_storage():
+    """Return the configured storage backend (DB_BACKEND=json|sqlite)"""
+    global _storage
+    if _storage is None:
+        if DB_BACKEND == "sqlite":
+            _storage = SQLiteStorage(SQLITE_FILE)
+        elif DB_BACKEND == "json":
+            _storage = JSONStorage(DB_FILE)
+        else:
+            raise ValueError(f"Unknown DB_BACKEND: {DB_BACKEND}")
+    return _storage
+
+
+class _Write:
+    def __init__(self, func):
+        self.func = func
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+
+
+class GroupCommitter:
+    """Coalesces concurrent writes into one commit.
+
+    The first writer of a batch becomes its leader: it waits up to `window`
+    seconds (or until `max_ops` writes are queued), then applies every queued
+    func(tx) to one snapshot with storage.commit_batch, which writes and
+    fsyncs the file once. Each caller returns only after that write, so a
+    burst of N writes costs one file rewrite per batch instead of N.
+    """
+
+    def __init__(self, storage, window, max_ops):
+        self.storage = storage
+        self.window = window
+        self.max_ops = max_ops
+        self._pid = os.getpid()
+        self._lock = threading.Lock()
+        self._full = threading.Condition(self._lock)
+        self._pending = []
+        self._collecting = False
+
+    def submit(self, func):
+        write = _Write(func)
+        with self._lock:
+            self._pending.append(write)
+            leader = not self._collecting
+            self._collecting = True
+            if len(self._pending) >= self.max_ops:
+                self._full.notify()
+        if leader:
+            self._lead()
+        write.done.wait()
+        if write.error is not None:
+            raise write.error
+        return write.result
+
+    def _lead(self):
+        deadline = time.monotonic() + self.window
+        with self._lock:
+            while len(self._pending) < self.max_ops:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._full.wait(remaining)
+            batch, self._pending = self._pending, []
+            # Writes arriving from now on start the next batch
+            self._collecting = False
+        BATCH_OPS.observe(len(batch))
         try:
-            json.dump(data, f, indent=2)
-        finally:
-            fcntl.flock(f, fcntl.LOCK_UN)
+            with OPERATION_SECONDS.time(operation="commit_batch"):
+                outcomes = self.storage.commit_batch([write.func for write in batch])
+        except Exception as e:
+            outcomes = [(None, e)] * len(batch)
+        for write, (result, error) in zip(batch, outcomes):
+            write.result, write.error = result, error
+            write.done.set()
+
+
+def _get_committer():
+    global _committer
+    storage = get_storage()
+    if _committer is None or _committer._pid != os.getpid():
+        _committer = GroupCommitter(storage, WRITE_BATCH_WINDOW_MS / 1000, WRITE_BATCH_MAX_OPS)
+    return _committer
+
+def commit(func):
+    """Run func(tx) as one atomic write and return its result.
+
+    With the JSON backend, writes from concurrent threads are grouped into one
+    file rewrite (WRITE_BATCH_WINDOW_MS, WRITE_BATCH_MAX_OPS); func may then be
+    replayed if another write in its batch fails, so it must act only through tx.
+    """
+    if WRITE_BATCH_WINDOW_MS > 0 and hasattr(get_storage(), "commit_batch"):
+        return _get_committer().submit(func)
+    with transaction() as tx:
+        return func(tx)
+
+def cache_stats():
+    """Snapshot cache hit/miss counters (JSON backend only)"""
+    storage = get_storage()
+    return storage.cache_stats() if hasattr(storage, "cache_stats") else {}
+
+def load_data():
+    """Load data from the local database"""
+    with OPERATION_SECONDS.time(operation="load_data"):
+        return get_storage().load()
+
+def save_data(data):
+    """Save data to the local database"""
+    with OPERATION_SECONDS.time(operation="save_data"):
+        get_storage().save(data)
+
+@contextmanager
+def transaction():
+    """Open a unit of work holding the write lock until it exits.
+
+    All mutations made through the yielded object are committed together:
+
+        with transaction() as tx:
+            tx.adjust_balance(user_id, amount)
+            tx.add_transaction(user_id, "deposit", amount, currency)
+    """
+    with OPERATION_SECONDS.time(operation="transaction"), get_storage().transaction() as tx:
+        yield tx
 
 def get_user(user_id):
     """Get user by Telegram ID"""
-    data = load_data()
-    return next((u for u in data["users"] if u["id"] == user_id), None)
+    return get_storage().get_user(user_id)
+
+def list_users(query=None, sort="created", descending=False, limit=50, offset=0):
+    """A page of user summaries (id, username, wallet_balance, plan, created_at)
+    and the total number of matches.
+
+    query matches a username or Telegram ID prefix; sort is "created" or "balance".
+    """
+    return get_storage().list_users(query, sort, descending, limit, offset)
+
+def iter_users():
+    """Yield every user without history, for exports"""
+    return get_storage().iter_users()
+
+def iter_transactions(start=None, end=None, transaction_type=None, user_id=None):
+    """Yield transactions with their user_id, oldest first, for exports.
+
+    start/end are ISO timestamps (or date prefixes), start inclusive, end exclusive.
+    """
+    return get_storage().iter_transactions(start, end, transaction_type, user_id)
+
+def get_history(user_id, limit=None, offset=0):
+    """Get up to `limit` transactions of a user, skipping the `offset` most
+    recent ones, oldest first. Older pages are read from the history archive."""
+    return get_storage().get_history(user_id, limit, offset)
+
+def history_count(user_id):
+    """Number of transactions in a user's history, archived ones included"""
+    return get_storage().history_count(user_id)
+
+def add_user(user):
+    """Create a user, returns False if the ID is already taken"""
+    return commit(lambda tx: tx.add_user(user))
+
+def save_user(user):
+    """Replace a stored user with the given one"""
+    return commit(lambda tx: tx.save_user(user))
 
 def update_wallet(user_id, amount):
     """Update user's wallet balance"""
-    data = load_data()
-    user = next((u for u in data["users"] if u["id"] == user_id), None)
-    if user:
-        user["wallet_balance"] = user.get("wallet_balance", 0) + amount
-        save_data(data)
-        return True
-    return False
+    return commit(lambda tx: tx.adjust_balance(user_id, amount))
 
 def add_transaction(user_id, transaction_type, amount, currency=None):
     """Add transaction to user history"""
-    data = load_data()
-    user = next((u for u in data["users"] if u["id"] == user_id), None)
-    if user:
-        if "history" not in user:
-            user["history"] = []
-        user["history"].append({
-            "type": transaction_type,
-            "amount": amount,
-            "currency": currency,
-            "timestamp": datetime.now().isoformat()
-        })
-        save_data(data)
-        return True
-    return False
\ No newline at end of file
+    return commit(lambda tx: tx.add_transaction(user_id, transaction_type, amount, currency))
+
+def get_stats():
+    """Dashboard counters (total_users, active_subscriptions, total_revenue),
+    maintained at write time and built on first use"""
+    return get_storage().get_stats() or get_storage().rebuild_stats()
+
+def rebuild_stats():
+    """Recompute the dashboard counters from scratch, returns (stored, rebuilt)"""
+    stored = get_storage().get_stats()
+    return stored, get_storage().rebuild_stats()
+
+def get_due_subscriptions(before, limit=100):
+    """Users whose subscription expires before the ISO date `before`, soonest first.
+
+    Served from an expiry index, so only due subscriptions are read.
+    """
+    return get_storage().get_due_subscriptions(before, limit)
+
+def next_expiry():
+    """Earliest expiry date the scheduler has to act on, or None"""
+    return get_storage().next_expiry()
+
+def get_recent_transactions(limit=10, transaction_type=None):
+    """Newest transactions across all users, optionally of one type, newest first"""
+    return get_storage().get_recent_transactions(limit, transaction_type)
+
+def get_pending_payments(limit=None):
+    """Payments still waiting for a final status, least recently updated first"""
+    return get_storage().get_pending_payments(limit)
+
+def get_purchase(job_id):
+    """Charge marker recorded with a purchase, until its provisioning job is settled"""
+    return get_storage().get_purchase(job_id)
+
+def get_offers():
+    """Get all offers"""
+    return get_storage().get_offers()
+
+def get_offers_version():
+    """Catalog version, changes whenever an offer is added, edited or deleted"""
+    return get_storage().get_offers_version()
+
+def get_offer(offer_id):
+    """Get offer by ID"""
+    return get_storage().get_offer(offer_id)
+
+def save_offer(offer):
+    """Create or update an offer, a new ID is assigned when offer['id'] is None"""
+    return commit(lambda tx: tx.save_offer(offer))
+
+def delete_offer(offer_id):
+    """Delete offer by ID"""
+    commit(lambda tx: tx.delete_offer(offer_id))
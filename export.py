@@ -0,0 +1,63 @@
+import csv
+import io
+import json
+
+TRANSACTION_FIELDS = ["timestamp", "user_id", "type", "amount", "currency"]
+USER_FIELDS = ["id", "username", "wallet_balance", "plan", "expiry", "created_at"]
+
+# Rows encoded per chunk handed to the response
+ROWS_PER_CHUNK = 500
+
+FORMATS = {
+    "csv": "text/csv",
+    "ndjson": "application/x-ndjson",
+}
+
+
+def user_row(user):
+    """Flatten a user into the exported columns"""
+    subscription = user.get("subscription") or {}
+    return {
+        "id": user["id"],
+        "username": user.get("username"),
+        "wallet_balance": user.get("wallet_balance", 0),
+        "plan": subscription.get("plan"),
+        "expiry": subscription.get("expiry"),
+        "created_at": user.get("created_at")
+    }
+
+
+def _chunks(rows, encode):
+    chunk = []
+    for row in rows:
+        chunk.append(encode(row))
+        if len(chunk) == ROWS_PER_CHUNK:
+            yield "".join(chunk)
+            chunk = []
+    if chunk:
+        yield "".join(chunk)
+
+
+def to_csv(rows, fields):
+    """Yield CSV text in chunks, header first"""
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fields, extrasaction="ignore")
+
+    def encode(row):
+        buffer.seek(0)
+        buffer.truncate()
+        writer.writerow(row)
+        return buffer.getvalue()
+
+    writer.writeheader()
+    yield buffer.getvalue()
+    yield from _chunks(rows, encode)
+
+
+def to_ndjson(rows, fields):
+    """Yield one JSON object per line, in chunks"""
+    return _chunks(rows, lambda row: json.dumps({field: row.get(field) for field in fields}) + "\n")
+
+
+def encode(rows, fields, fmt):
+    return to_csv(rows, fields) if fmt == "csv" else to_ndjson(rows, fields)
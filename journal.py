@@ -0,0 +1,241 @@
+import json
+import os
+import struct
+
+# (user_id, byte offset of the record in the log)
+INDEX_ENTRY = struct.Struct("<qQ")
+
+
+class Journal:
+    """Append-only transaction log with a per-user offset index.
+
+    Records are stored one JSON object per line in `path`. For every record a
+    fixed-size (user_id, offset) entry is appended to `path`.idx, so a reader
+    can build the per-user index without parsing the log, and fetching a
+    page of one user's history only reads the records on that page.
+
+    Records appended together with a users.db write carry that write's
+    commit sequence (`seq`), so records of a commit whose users.db write
+    never happened can be found at the tail and dropped (last_seq, truncate).
+
+    Callers serialize access: appends and rewrites under the store's
+    exclusive lock, reads under its shared lock.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.index_path = path + ".idx"
+        self._offsets = {}
+        self._index_key = None
+        self._index_size = 0
+
+    def _refresh(self):
+        """Load index entries appended since the last call"""
+        try:
+            st = os.stat(self.index_path)
+        except FileNotFoundError:
+            self._offsets, self._index_key, self._index_size = {}, None, 0
+            return
+        if st.st_ino != self._index_key or st.st_size < self._index_size:
+            # The journal was rewritten
+            self._offsets, self._index_key, self._index_size = {}, st.st_ino, 0
+        if st.st_size == self._index_size:
+            return
+        with open(self.index_path, "rb") as f:
+            f.seek(self._index_size)
+            chunk = f.read(st.st_size - self._index_size)
+        chunk = chunk[:len(chunk) - len(chunk) % INDEX_ENTRY.size]
+        for user_id, offset in INDEX_ENTRY.iter_unpack(chunk):
+            self._offsets.setdefault(user_id, []).append(offset)
+        self._index_size += len(chunk)
+
+    @staticmethod
+    def _encode(entries, start, seq=None):
+        lines, index = [], []
+        offset = start
+        extra = {} if seq is None else {"seq": seq}
+        for user_id, record in entries:
+            line = json.dumps(dict(record, user_id=user_id, **extra)).encode() + b"\n"
+            lines.append(line)
+            index.append(INDEX_ENTRY.pack(user_id, offset))
+            offset += len(line)
+        return b"".join(lines), b"".join(index)
+
+    @staticmethod
+    def _decode(line):
+        record = json.loads(line)
+        record.pop("seq", None)
+        return record.pop("user_id"), record
+
+    def append(self, entries, seq=None):
+        """Append (user_id, record) pairs, tagged with commit sequence `seq` if given"""
+        if not entries:
+            return
+        with open(self.path, "ab") as log:
+            lines, index = self._encode(entries, log.tell(), seq)
+            log.write(lines)
+            log.flush()
+            os.fsync(log.fileno())
+        # The index is written last so it never points past the log
+        with open(self.index_path, "ab") as idx:
+            idx.write(index)
+            idx.flush()
+            os.fsync(idx.fileno())
+
+    def rewrite(self, entries):
+        """Atomically replace the whole journal with (user_id, record) pairs"""
+        lines, index = self._encode(entries, 0)
+        for path, payload in ((self.path, lines), (self.index_path, index)):
+            with open(path + ".tmp", "wb") as f:
+                f.write(payload)
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(path + ".tmp", path)
+
+    def count(self, user_id):
+        self._refresh()
+        return len(self._offsets.get(user_id, ()))
+
+    def read(self, user_id, limit=None, offset=0):
+        """Return up to `limit` records of a user, skipping the `offset`
+        most recent ones, oldest first"""
+        self._refresh()
+        offsets = self._offsets.get(user_id, [])
+        end = len(offsets) - offset
+        start = 0 if limit is None else max(end - limit, 0)
+        records = []
+        if end <= 0:
+            return records
+        with open(self.path, "rb") as log:
+            for pos in offsets[start:end]:
+                log.seek(pos)
+                records.append(self._decode(log.readline())[1])
+        return records
+
+    def __iter__(self):
+        """Yield (user_id, record) for every record in log order"""
+        self._refresh()
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb") as log:
+            for line in log:
+                yield self._decode(line)
+
+    def size(self):
+        """Bytes of the log; everything before this offset is immutable"""
+        try:
+            return os.path.getsize(self.path)
+        except FileNotFoundError:
+            return 0
+
+    def offsets(self, user_id):
+        """Byte offsets of a user's records, oldest first"""
+        self._refresh()
+        return list(self._offsets.get(user_id, ()))
+
+    def find_time(self, timestamp, end):
+        """Offset of the first record at or after `timestamp` before byte `end`.
+
+        Records are appended in time order, so this is a binary search over
+        line starts and reads O(log n) lines.
+        """
+        # Invariant: records starting before `low` are older than timestamp,
+        # the one starting at `high` (if any) is not; both are line starts
+        low, high = 0, end
+        with open(self.path, "rb") as log:
+            while low < high:
+                mid = (low + high) // 2
+                log.seek(mid - 1 if mid else 0)
+                if mid:
+                    log.readline()
+                start = log.tell()
+                if start >= high:
+                    # No line starts in [mid, high), step over the one at low
+                    log.seek(low)
+                    start = low
+                line = log.readline()
+                if json.loads(line)["timestamp"] < timestamp:
+                    low = start + len(line)
+                else:
+                    high = start
+        return low
+
+    def last_seq(self):
+        """(commit sequence, byte offset) of the run of records at the end of
+        the log that share one sequence, None if the last record has none"""
+        size = self.size()
+        if not size:
+            return None
+        seq, start = None, size
+        with open(self.path, "rb") as log:
+            for line_start, line in self._lines_backwards(log, size, 4096):
+                line_seq = json.loads(line).get("seq")
+                if line_seq is None or (seq is not None and line_seq != seq):
+                    break
+                seq, start = line_seq, line_start
+        return None if seq is None else (seq, start)
+
+    def truncate(self, size):
+        """Drop every record at or after byte `size`.
+
+        The index is replaced with a new file, so readers holding offsets
+        from the old one reload it, before the log is cut.
+        """
+        with open(self.index_path, "rb") as f:
+            entries = [e for e in INDEX_ENTRY.iter_unpack(f.read()) if e[1] < size]
+        with open(self.index_path + ".tmp", "wb") as f:
+            f.write(b"".join(INDEX_ENTRY.pack(*e) for e in entries))
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(self.index_path + ".tmp", self.index_path)
+        with open(self.path, "r+b") as log:
+            log.truncate(size)
+            os.fsync(log.fileno())
+
+    @staticmethod
+    def _lines_backwards(log, end, block_size=65536):
+        """Yield (offset, line) newest first from byte `end` backwards"""
+        pos, tail = end, b""
+        while pos > 0:
+            step = min(block_size, pos)
+            pos -= step
+            log.seek(pos)
+            lines = (log.read(step) + tail).split(b"\n")
+            # The first piece may be the end of a line that starts in an earlier block
+            tail = lines.pop(0) if pos else b""
+            offset = pos + len(tail) + (1 if pos else 0)
+            starts = []
+            for line in lines:
+                starts.append(offset)
+                offset += len(line) + 1
+            for line_start, line in zip(reversed(starts), reversed(lines)):
+                if line:
+                    yield line_start, line
+
+    def scan_backwards(self, end, block_size=65536):
+        """Yield (user_id, record) newest first from byte `end` backwards,
+        reading the log in blocks from its tail"""
+        if not end:
+            return
+        with open(self.path, "rb") as log:
+            for _, line in self._lines_backwards(log, end, block_size):
+                yield self._decode(line)
+
+    def scan(self, start=0, end=None, offsets=None):
+        """Yield (user_id, record) from byte `start` up to `end`, or at the
+        given record offsets, reading one line at a time"""
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "rb") as log:
+            if offsets is not None:
+                for pos in offsets:
+                    log.seek(pos)
+                    yield self._decode(log.readline())
+                return
+            log.seek(start)
+            pos = start
+            for line in log:
+                pos += len(line)
+                if end is not None and pos > end:
+                    return
+                yield self._decode(line)
@@ -0,0 +1,117 @@
+import argparse
+import os
+from datetime import datetime, timedelta
+import data_manager
+from storage import migrate_json_to_sqlite
+from webhook_queue import WEBHOOK_QUEUE_FILE, WEBHOOK_BATCH_SIZE
+from reconciler import RECONCILE_CONCURRENCY
+
+
+def migrate(args):
+    """Copy the JSON users.db into a SQLite store"""
+    users, offers = migrate_json_to_sqlite(args.source, args.target)
+    print(f"Migrated {users} users and {offers} offers to {args.target}")
+    print("Set DB_BACKEND=sqlite to use it")
+
+
+def migrate_history(args):
+    """Move history embedded in users.db into the transaction journal"""
+    storage = data_manager.get_storage()
+    if not hasattr(storage, "migrate_history"):
+        print("Only the JSON backend embeds history")
+        return
+    print(f"Moved {storage.migrate_history()} history entries to {storage.journal.path}")
+
+
+def compact_history(args):
+    """Move transactions older than the retention window into the monthly archive"""
+    storage = data_manager.get_storage()
+    if not hasattr(storage, "compact_history"):
+        print("Only the JSON backend archives history")
+        return
+    before = (datetime.now() - timedelta(days=args.retention_days)).date().isoformat()
+    moved = storage.compact_history(before)
+    print(f"Archived {moved} transactions before {before[:7]} to {storage.archive.directory}")
+
+
+def rebuild_stats(args):
+    """Recompute the dashboard counters and report any drift"""
+    stored, rebuilt = data_manager.rebuild_stats()
+    for name, value in rebuilt.items():
+        before = (stored or {}).get(name)
+        status = "ok" if before is not None and abs(before - value) < 1e-6 else "fixed"
+        print(f"{name}: {before} -> {value} ({status})")
+
+
+def webhook_worker(args):
+    """Apply queued NOWPayments webhooks, once or continuously"""
+    from nowpayments import credit_payments
+    from webhook_queue import WebhookQueue, WebhookWorker
+    worker = WebhookWorker(WebhookQueue(args.queue), credit_payments, batch_size=args.batch_size)
+    if args.once:
+        print(f"Applied {worker.drain()} queued webhooks")
+        print(f"Pruned {worker.prune()} processed webhooks")
+        return
+    worker.run()
+
+
+def reconcile_payments(args):
+    """Poll NOWPayments for open payments and credit the finished ones"""
+    from nowpayments import NOWPayments, credit_payments
+    from reconciler import PaymentReconciler
+    nowpayments = NOWPayments(os.getenv("NOWPAYMENTS_API_KEY"), os.getenv("NOWPAYMENTS_IPN_SECRET"))
+    reconciler = PaymentReconciler(nowpayments, credit_payments, concurrency=args.concurrency)
+    if args.once:
+        print(f"Polled open payments: {reconciler.reconcile()}")
+        return
+    reconciler.run()
+
+
+def provisioning_stats(args):
+    """Provisioning job counts and warm pool hit rate / refill lag"""
+    from provisioning import JobStore, WarmPool
+    jobs = JobStore()
+    print(f"jobs: {jobs.counts()}")
+    for name, value in WarmPool(jobs, plesk=None).stats().items():
+        print(f"pool {name}: {value}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Maintenance commands")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    cmd = commands.add_parser("migrate", help="migrate users.db (JSON) to SQLite")
+    cmd.add_argument("--source", default=data_manager.DB_FILE)
+    cmd.add_argument("--target", default=data_manager.SQLITE_FILE)
+    cmd.set_defaults(func=migrate)
+
+    cmd = commands.add_parser("migrate-history", help="move embedded history into the journal")
+    cmd.set_defaults(func=migrate_history)
+
+    cmd = commands.add_parser("compact-history", help="archive transactions older than the retention window")
+    cmd.add_argument("--retention-days", type=int, default=data_manager.HISTORY_RETENTION_DAYS)
+    cmd.set_defaults(func=compact_history)
+
+    cmd = commands.add_parser("rebuild-stats", help="recompute dashboard counters")
+    cmd.set_defaults(func=rebuild_stats)
+
+    cmd = commands.add_parser("webhook-worker", help="apply queued NOWPayments webhooks")
+    cmd.add_argument("--queue", default=WEBHOOK_QUEUE_FILE)
+    cmd.add_argument("--batch-size", type=int, default=WEBHOOK_BATCH_SIZE)
+    cmd.add_argument("--once", action="store_true", help="drain the queue and exit")
+    cmd.set_defaults(func=webhook_worker)
+
+    cmd = commands.add_parser("reconcile-payments", help="credit payments whose webhook was lost")
+    cmd.add_argument("--concurrency", type=int, default=RECONCILE_CONCURRENCY)
+    cmd.add_argument("--once", action="store_true", help="run one pass and exit")
+    cmd.set_defaults(func=reconcile_payments)
+
+    cmd = commands.add_parser("provisioning-stats", help="show provisioning jobs and warm pool metrics")
+    cmd.set_defaults(func=provisioning_stats)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == '__main__':
+    main()
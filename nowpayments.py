@@ -2,17 +2,53 @@ import requests
 import hmac
 import hashlib
 import json
+import logging
+import math
+import os
+import time
 from datetime import datetime
-from data_manager import add_transaction
+from cache import TTLCache
+from data_manager import commit
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Seconds before the currency list / minimum amounts are refreshed in the background
+NOWPAYMENTS_CATALOG_TTL = int(os.getenv("NOWPAYMENTS_CATALOG_TTL", "3600"))
+TIMEOUT = 10
+
+# Shared by every NOWPayments instance in the process
+catalog_cache = TTLCache(ttl=NOWPAYMENTS_CATALOG_TTL)
+
+REQUEST_SECONDS = metrics.histogram(
+    "nowpayments_request_seconds", "NOWPayments API calls by endpoint and HTTP status", ["method", "endpoint", "status"]
+)
 
 class NOWPayments:
-    def __init__(self, api_key, ipn_secret):
-        self.base_url = "https://api.nowpayments.io/v1"
+    def __init__(self, api_key, ipn_secret, base_url="https://api.nowpayments.io/v1"):
+        self.base_url = base_url
         self.headers = {
             "x-api-key": api_key,
             "Content-Type": "application/json"
         }
         self.ipn_secret = ipn_secret
+        # Persistent session so calls reuse keep-alive connections
+        self.session = requests.Session()
+        self.session.headers.update(self.headers)
+
+    def _request(self, method, endpoint, **kwargs):
+        """Call the API, raising on HTTP errors; returns the decoded JSON"""
+        start = time.perf_counter()
+        status = "error"
+        try:
+            response = self.session.request(method, f"{self.base_url}{endpoint}", timeout=TIMEOUT, **kwargs)
+            status = response.status_code
+        finally:
+            REQUEST_SECONDS.observe(
+                time.perf_counter() - start, method=method, endpoint=metrics.endpoint_label(endpoint), status=status
+            )
+        response.raise_for_status()
+        return response.json()
 
     def create_payment(self, amount, currency, order_id, user_id):
         """Create a new crypto payment invoice"""
@@ -27,61 +63,128 @@ class NOWPayments:
             "cancel_url": "https://yourdomain.com/cancel"
         }
 
-        response = requests.post(
-            f"{self.base_url}/payment",
-            headers=self.headers,
-            json=data
-        )
-        response.raise_for_status()
-        return response.json()
+        return self._request("POST", "/payment", json=data)
 
-    def verify_webhook(self, request_data, signature):
-        """Verify the authenticity of a webhook notification"""
+    def get_payment_status(self, payment_id):
+        """Current state of a payment, in the same shape as its webhook payload"""
+        return self._request("GET", f"/payment/{payment_id}")
+
+    def verify_webhook(self, body, signature):
+        """Verify the authenticity of a webhook notification.
+
+        body should be the raw request bytes, so the HMAC covers exactly
+        what NOWPayments signed.
+        """
+        if not signature:
+            return False
+        if not isinstance(body, (bytes, str)):
+            body = json.dumps(body)
+        if isinstance(body, str):
+            body = body.encode()
         expected_signature = hmac.new(
             self.ipn_secret.encode(),
-            json.dumps(request_data).encode(),
+            body,
             hashlib.sha512
         ).hexdigest()
         return hmac.compare_digest(expected_signature, signature)
 
     def process_webhook(self, data):
         """Process a valid payment webhook"""
-        payment_status = data.get("payment_status")
-        if payment_status == "finished":
-            user_id = int(data["order_id"].split("_")[-1])
-            amount = float(data["price_amount"])
-            currency = data["pay_currency"]
-            
-            # Add transaction to user history
-            add_transaction(
-                user_id=user_id,
-                transaction_type="deposit",
-                amount=amount,
-                currency=currency
-            )
-            
-            # Update wallet balance
-            from data_manager import update_wallet
-            update_wallet(user_id, amount)
-            
-            return True
-        return False
+        return credit_payments([data])[0] == "credited"
 
     def get_currencies(self):
-        """Get list of supported cryptocurrencies"""
-        response = requests.get(
-            f"{self.base_url}/currencies",
-            headers=self.headers
-        )
-        response.raise_for_status()
-        return [c["currency"] for c in response.json()]
+        """Get list of supported cryptocurrencies (cached)"""
+        return catalog_cache.get(("currencies", self.base_url), self._fetch_currencies)
+
+    def _fetch_currencies(self):
+        return [c["currency"] for c in self._request("GET", "/currencies")]
 
     def get_min_amount(self, currency):
-        """Get minimum payment amount for a currency"""
-        response = requests.get(
-            f"{self.base_url}/min-amount",
-            params={"currency_from": "usd", "currency_to": currency},
-            headers=self.headers
+        """Get minimum payment amount for a currency (cached)"""
+        return catalog_cache.get(
+            ("min_amount", self.base_url, currency),
+            lambda: self._fetch_min_amount(currency)
         )
-        response.raise_for_status()
-        return response.json().get("min_amount")
\ No newline at end of file
+
+    def _fetch_min_amount(self, currency):
+        return self._request(
+            "GET", "/min-amount", params={"currency_from": "usd", "currency_to": currency}
+        ).get("min_amount")
+
+
+def _user_id_from_order(order_id):
+    # order ids are created as deposit_<user_id>_<random suffix>
+    try:
+        return int(str(order_id).split("_")[1])
+    except (IndexError, ValueError):
+        return None
+
+
+def _parse_payment(data):
+    """(payment_id, user_id, status, amount, currency) of a payload, raises
+    ValueError if a field cannot be stored"""
+    if not isinstance(data, dict):
+        raise ValueError("payload is not an object")
+    status, currency = data.get("payment_status"), data.get("pay_currency")
+    if not isinstance(status, str) or not status:
+        raise ValueError("payment_status is missing or not a string")
+    if currency is not None and not isinstance(currency, str):
+        raise ValueError("pay_currency is not a string")
+    try:
+        amount = float(data.get("price_amount") or 0)
+    except (TypeError, ValueError):
+        raise ValueError(f"price_amount {data.get('price_amount')!r} is not a number")
+    if not math.isfinite(amount):
+        raise ValueError(f"price_amount {amount} is not finite")
+    return data.get("payment_id"), _user_id_from_order(data.get("order_id")), status, amount, currency
+
+
+def credit_payments(events):
+    """Apply a batch of webhook payloads in one transaction.
+
+    Every payment's last seen status is kept in the payments index, and a
+    payment_id is credited at most once however often its "finished"
+    notification is delivered. Returns one outcome per event; a payload that
+    cannot be applied is skipped as "invalid payload" without failing the rest.
+    """
+    def apply(tx):
+        outcomes = []
+        for data in events:
+            try:
+                payment_id, user_id, status, amount, currency = _parse_payment(data)
+            except ValueError as e:
+                logger.warning(f"Skipping invalid payment notification {str(data)[:200]}: {e}")
+                outcomes.append("invalid payload")
+                continue
+            if payment_id is None or user_id is None:
+                outcomes.append("invalid order_id")
+                continue
+            payment = tx.get_payment(payment_id)
+            if payment and payment["status"] == "finished":
+                outcomes.append("duplicate")
+                continue
+            if tx.get_user(user_id) is None:
+                outcomes.append("unknown user")
+                continue
+
+            if status == "finished":
+                tx.add_transaction(
+                    user_id=user_id,
+                    transaction_type="deposit",
+                    amount=amount,
+                    currency=currency
+                )
+                tx.adjust_balance(user_id, amount)
+                outcomes.append("credited")
+            else:
+                outcomes.append("recorded")
+            tx.set_payment(payment_id, {
+                "user_id": user_id,
+                "status": status,
+                "amount": amount,
+                "currency": currency,
+                "updated_at": datetime.now().isoformat()
+            })
+        return outcomes
+
+    return commit(apply)
@@ -1,40 +1,114 @@
+import asyncio
+import os
 import requests
 import random
 import string
 import time
+import httpx
+from concurrent.futures import ThreadPoolExecutor
+from requests.adapters import HTTPAdapter
 from requests.auth import HTTPBasicAuth
+from rate_limiter import get_bucket
+import metrics
+
+# Keep-alive connections held open to the Plesk host
+PLESK_MAX_CONNECTIONS = int(os.getenv("PLESK_MAX_CONNECTIONS", "10"))
+# Requests in flight at once per Plesk host (async client)
+PLESK_MAX_CONCURRENCY = int(os.getenv("PLESK_MAX_CONCURRENCY", "5"))
+
+MAX_RETRIES = 3
+TIMEOUT = 10
+
+REQUEST_SECONDS = metrics.histogram(
+    "plesk_request_seconds", "Plesk API calls by endpoint and HTTP status", ["method", "endpoint", "status"]
+)
+RETRIES = metrics.counter("plesk_retries_total", "Plesk calls retried, by reason", ["reason"])
+BACKOFF_SECONDS = metrics.counter("plesk_backoff_seconds_total", "Seconds slept before retrying Plesk calls")
+
+
+def _record(method, endpoint, start, status):
+    REQUEST_SECONDS.observe(
+        time.perf_counter() - start, method=method, endpoint=metrics.endpoint_label(endpoint), status=status
+    )
+
+
+def _backoff(reason, delay):
+    RETRIES.inc(reason=reason)
+    BACKOFF_SECONDS.inc(delay)
+    return delay
+
+
+def _client_payload(email=None):
+    """Random credentials and the request body for a new client"""
+    username = ''.join(random.choices(string.ascii_letters + string.digits, k=8))
+    password = ''.join(random.choices(string.ascii_letters + string.digits + '!@#$%^&*', k=12))
+    data = {
+        "name": username,
+        "login": username,
+        "password": password,
+        "email": email or f"{username}@example.com"
+    }
+    return username, password, data
+
+
+def _bulk_result(item, result=None, error=None):
+    if error is not None:
+        return {"id": item, "ok": False, "error": str(error)}
+    return {"id": item, "ok": True, "result": result}
+
+
+def _subscription_payload(client_id, plan_id, domain=None):
+    """Domain and request body for a new subscription"""
+    if not domain:
+        domain = f"temp-{random.randint(1000, 9999)}.example.com"
+    data = {
+        "name": domain,
+        "service_plan": {"id": plan_id},
+        "hosting_type": "virtual",
+        "owner_client": {"id": client_id},
+        "external_id": str(random.randint(100000, 999999))
+    }
+    return domain, data
+
 
 class PleskAPI:
-    def __init__(self, host, username, password):
-        self.base_url = f"https://{host}/api/v2"
+    def __init__(self, host, username, password, rate_limiter=None, base_url=None):
+        self.base_url = base_url or f"https://{host}/api/v2"
+        # Shared with every other process talking to this Plesk host
+        self.rate_limiter = rate_limiter or get_bucket()
         self.auth = HTTPBasicAuth(username, password)
         self.headers = {
             "Content-Type": "application/json",
             "Accept": "application/json"
         }
+        # One pooled session so calls reuse keep-alive TLS connections
+        self.session = requests.Session()
+        self.session.auth = self.auth
+        self.session.headers.update(self.headers)
+        self.session.mount("https://", HTTPAdapter(pool_maxsize=PLESK_MAX_CONNECTIONS))
 
     def _request(self, method, endpoint, data=None):
         url = f"{self.base_url}{endpoint}"
-        max_retries = 3
-        for attempt in range(max_retries):
+        for attempt in range(MAX_RETRIES):
             try:
-                response = requests.request(
-                    method,
-                    url,
-                    json=data,
-                    headers=self.headers,
-                    auth=self.auth,
-                    timeout=10
-                )
+                self.rate_limiter.acquire()
+                start = time.perf_counter()
+                try:
+                    response = self.session.request(method, url, json=data, timeout=TIMEOUT)
+                except requests.exceptions.RequestException:
+                    _record(method, endpoint, start, "error")
+                    raise
+                _record(method, endpoint, start, response.status_code)
                 if response.status_code == 429:  # Rate limited
-                    time.sleep(2 ** attempt)  # Exponential backoff
+                    time.sleep(_backoff("429", 2 ** attempt))  # Exponential backoff
                     continue
                 response.raise_for_status()
                 return response.json()
             except requests.exceptions.RequestException as e:
-                if attempt == max_retries - 1:
+                if attempt == MAX_RETRIES - 1:
                     raise Exception(f"Plesk API request failed: {str(e)}")
-                time.sleep(1)
+                time.sleep(_backoff("error", 1))
+        raise Exception("Plesk API request failed: rate limited")
 
     def client_exists(self, client_id):
         """Check if a client exists in Plesk"""
@@ -47,16 +121,7 @@ class PleskAPI:
 
     def create_client(self, email=None):
         """Create a new Plesk client with random credentials"""
-        username = ''.join(random.choices(string.ascii_letters + string.digits, k=8))
-        password = ''.join(random.choices(string.ascii_letters + string.digits + '!@#$%^&*', k=12))
-        
-        data = {
-            "name": username,
-            "login": username,
-            "password": password,
-            "email": email or f"{username}@example.com"
-        }
-        
+        username, password, data = _client_payload(email)
         response = self._request("POST", "/clients", data)
         return {
             "plesk_client_id": response["id"],
@@ -66,17 +131,7 @@ class PleskAPI:
 
     def create_subscription(self, client_id, plan_id, domain=None):
         """Create a subscription for a client"""
-        if not domain:
-            domain = f"temp-{random.randint(1000, 9999)}.example.com"
-            
-        data = {
-            "name": domain,
-            "service_plan": {"id": plan_id},
-            "hosting_type": "virtual",
-            "owner_client": {"id": client_id},
-            "external_id": str(random.randint(100000, 999999))
-        }
-        
+        domain, data = _subscription_payload(client_id, plan_id, domain)
         response = self._request("POST", "/subscriptions", data)
         return {
             "subscription_id": response["id"],
@@ -92,4 +147,159 @@ class PleskAPI:
 
     def delete_client(self, client_id):
         """Delete a client and all associated resources"""
-        return self._request("DELETE", f"/clients/{client_id}")
\ No newline at end of file
+        return self._request("DELETE", f"/clients/{client_id}")
+
+    def suspend_subscription(self, domain):
+        """Suspend a subscription's webspace"""
+        return self._request("POST", "/cli/subscription/call", {"params": ["--webspace-off", domain]})
+
+    def unsuspend_subscription(self, domain):
+        """Turn a suspended subscription's webspace back on"""
+        return self._request("POST", "/cli/subscription/call", {"params": ["--webspace-on", domain]})
+
+    def _bulk(self, items, call):
+        def run(item):
+            try:
+                return _bulk_result(item, call(item))
+            except Exception as e:
+                return _bulk_result(item, error=e)
+        with ThreadPoolExecutor(max_workers=PLESK_MAX_CONNECTIONS) as executor:
+            return list(executor.map(run, items))
+
+    def bulk_update_subscriptions(self, subscription_ids, new_plan_id):
+        """Move many subscriptions to a plan, one {"id", "ok", "result"/"error"} per ID"""
+        return self._bulk(subscription_ids, lambda sid: self.update_subscription(sid, new_plan_id))
+
+    def bulk_delete_clients(self, client_ids):
+        """Delete many clients, one {"id", "ok", "result"/"error"} per ID"""
+        return self._bulk(client_ids, self.delete_client)
+
+
+class AsyncPleskAPI:
+    """Non-blocking Plesk client for use inside the bot's event loop.
+
+    Requests share a keep-alive connection pool, at most `max_concurrency`
+    are in flight against the host, and retries back off with asyncio.sleep.
+    Every request also takes a token from the cross-process rate limiter.
+    """
+
+    def __init__(self, host, username, password,
+                 max_connections=PLESK_MAX_CONNECTIONS, max_concurrency=PLESK_MAX_CONCURRENCY,
+                 rate_limiter=None, base_url=None):
+        self.base_url = base_url or f"https://{host}/api/v2"
+        self.rate_limiter = rate_limiter or get_bucket()
+        self.auth = (username, password)
+        self.headers = {
+            "Content-Type": "application/json",
+            "Accept": "application/json"
+        }
+        self.limits = httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        self.max_concurrency = max_concurrency
+        self._client = None
+        self._semaphore = None
+
+    def _get_client(self):
+        # Created lazily so both belong to the running event loop
+        if self._client is None:
+            self._client = httpx.AsyncClient(
+                auth=self.auth, headers=self.headers, limits=self.limits, timeout=TIMEOUT
+            )
+            self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        return self._client
+
+    async def aclose(self):
+        """Close pooled connections"""
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    async def _request(self, method, endpoint, data=None):
+        url = f"{self.base_url}{endpoint}"
+        client = self._get_client()
+        for attempt in range(MAX_RETRIES):
+            try:
+                await self.rate_limiter.acquire_async()
+                async with self._semaphore:
+                    start = time.perf_counter()
+                    try:
+                        response = await client.request(method, url, json=data)
+                    except httpx.HTTPError:
+                        _record(method, endpoint, start, "error")
+                        raise
+                _record(method, endpoint, start, response.status_code)
+                if response.status_code == 429:  # Rate limited
+                    await asyncio.sleep(_backoff("429", 2 ** attempt))  # Exponential backoff
+                    continue
+                response.raise_for_status()
+                return response.json()
+            except httpx.HTTPError as e:
+                if attempt == MAX_RETRIES - 1:
+                    raise Exception(f"Plesk API request failed: {str(e)}")
+                await asyncio.sleep(_backoff("error", 1))
+        raise Exception("Plesk API request failed: rate limited")
+
+    async def client_exists(self, client_id):
+        """Check if a client exists in Plesk"""
+        try:
+            await self._request("GET", f"/clients/{client_id}")
+            return True
+        except Exception:
+            return False
+
+    async def create_client(self, email=None):
+        """Create a new Plesk client with random credentials"""
+        username, password, data = _client_payload(email)
+        response = await self._request("POST", "/clients", data)
+        return {
+            "plesk_client_id": response["id"],
+            "username": username,
+            "password": password
+        }
+
+    async def create_subscription(self, client_id, plan_id, domain=None):
+        """Create a subscription for a client"""
+        domain, data = _subscription_payload(client_id, plan_id, domain)
+        response = await self._request("POST", "/subscriptions", data)
+        return {
+            "subscription_id": response["id"],
+            "domain": domain
+        }
+
+    async def update_subscription(self, subscription_id, new_plan_id):
+        """Update a subscription's service plan"""
+        return await self._request("PUT", f"/subscriptions/{subscription_id}", {
+            "service_plan": {"id": new_plan_id}
+        })
+
+    async def delete_client(self, client_id):
+        """Delete a client and all associated resources"""
+        return await self._request("DELETE", f"/clients/{client_id}")
+
+    async def suspend_subscription(self, domain):
+        """Suspend a subscription's webspace"""
+        return await self._request("POST", "/cli/subscription/call", {"params": ["--webspace-off", domain]})
+
+    async def unsuspend_subscription(self, domain):
+        """Turn a suspended subscription's webspace back on"""
+        return await self._request("POST", "/cli/subscription/call", {"params": ["--webspace-on", domain]})
+
+    async def _bulk(self, items, call):
+        # Each waiting request borrows a token from the shared bucket, so only
+        # a burst's worth is started at once and other callers are not starved
+        pending = asyncio.Semaphore(max(1, int(self.rate_limiter.burst)))
+
+        async def run(item):
+            async with pending:
+                try:
+                    return _bulk_result(item, await call(item))
+                except Exception as e:
+                    return _bulk_result(item, error=e)
+        return await asyncio.gather(*(run(item) for item in items))
+
+    async def bulk_update_subscriptions(self, subscription_ids, new_plan_id):
+        """Move many subscriptions to a plan, one {"id", "ok", "result"/"error"} per ID"""
+        return await self._bulk(subscription_ids, lambda sid: self.update_subscription(sid, new_plan_id))
+
+    async def bulk_delete_clients(self, client_ids):
+        """Delete many clients, one {"id", "ok", "result"/"error"} per ID"""
+        return await self._bulk(client_ids, self.delete_client)
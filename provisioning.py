@@ -0,0 +1,513 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from collections import deque
+from datetime import datetime
+import async_data_manager as db
+from scheduler import reactivated, subscription_period
+from storage import SQLiteConnections
+
+logger = logging.getLogger(__name__)
+
+# Job state for purchases waiting on Plesk
+PROVISIONING_FILE = os.getenv("PROVISIONING_FILE", "provisioning.db")
+# Purchases provisioned concurrently
+PROVISIONING_WORKERS = int(os.getenv("PROVISIONING_WORKERS", "4"))
+# Attempts before a job fails and the reserved funds are refunded
+PROVISIONING_MAX_ATTEMPTS = int(os.getenv("PROVISIONING_MAX_ATTEMPTS", "3"))
+# Spare Plesk clients kept ready for new purchases (0 disables the warm pool)
+PLESK_POOL_SIZE = int(os.getenv("PLESK_POOL_SIZE", "0"))
+# Ready-made subscriptions per plan, as plan_id:count[,plan_id:count...]
+PLESK_POOL_PLANS = os.getenv("PLESK_POOL_PLANS", "")
+# Seconds between checks that the pool is at its target size
+PLESK_POOL_REFILL_INTERVAL = int(os.getenv("PLESK_POOL_REFILL_INTERVAL", "30"))
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    chat_id INTEGER,
+    kind TEXT NOT NULL,
+    offer TEXT NOT NULL,
+    state TEXT NOT NULL,
+    attempts INTEGER NOT NULL DEFAULT 0,
+    progress TEXT,
+    error TEXT,
+    charged INTEGER,
+    created_at TEXT NOT NULL,
+    updated_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS jobs_user ON jobs(user_id, state);
+DROP INDEX IF EXISTS jobs_unfinished;
+CREATE INDEX IF NOT EXISTS jobs_open ON jobs(id) WHERE state IN ('pending', 'queued', 'running', 'refunding');
+"""
+
+
+class JobStore:
+    """Persistent provisioning jobs.
+
+    kind is "new" (create a client and subscription) or "update" (change the
+    plan of the user's existing subscription). A job is created pending
+    before its purchase is charged, then moves to queued (or cancelled if the
+    charge did not happen), running, and done; one that runs out of attempts
+    is refunding until its refund has committed, then failed. Jobs left
+    unfinished by a restart are picked up again. progress holds what Plesk
+    already created, so a retry creates neither a second client nor a second
+    subscription.
+
+    charged is 1 for jobs whose charge is recorded as a purchase marker in the
+    user store; jobs from before markers existed have none.
+    """
+
+    def __init__(self, path=PROVISIONING_FILE):
+        self.path = path
+        self.db = SQLiteConnections(path)
+        conn = self.db.get()
+        columns = {row["name"] for row in conn.execute("PRAGMA table_info(jobs)")}
+        if columns and "charged" not in columns:
+            conn.execute("ALTER TABLE jobs ADD COLUMN charged INTEGER")
+        conn.executescript(SCHEMA)
+
+    @staticmethod
+    def _job_from_row(row):
+        if row is None:
+            return None
+        job = dict(row)
+        job["offer"] = json.loads(job["offer"])
+        job["progress"] = json.loads(job["progress"]) if job["progress"] else {}
+        return job
+
+    def create(self, user_id, chat_id, kind, offer):
+        now = datetime.now().isoformat()
+        with self.db.write() as conn:
+            cursor = conn.execute(
+                "INSERT INTO jobs (user_id, chat_id, kind, offer, state, charged, created_at, updated_at)"
+                " VALUES (?, ?, ?, ?, 'pending', 1, ?, ?)",
+                (user_id, chat_id, kind, json.dumps(offer), now, now)
+            )
+            return cursor.lastrowid
+
+    def get(self, job_id):
+        return self._job_from_row(self.db.get().execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone())
+
+    def active_for(self, user_id):
+        """The user's pending, queued or running job, if any"""
+        return self._job_from_row(self.db.get().execute(
+            "SELECT * FROM jobs WHERE user_id = ? AND state IN ('pending', 'queued', 'running') ORDER BY id LIMIT 1",
+            (user_id,)
+        ).fetchone())
+
+    def unfinished(self):
+        """IDs of jobs that still have to run or be refunded, oldest first"""
+        rows = self.db.get().execute(
+            "SELECT id FROM jobs WHERE state IN ('queued', 'running', 'refunding') ORDER BY id"
+        ).fetchall()
+        return [row["id"] for row in rows]
+
+    def pending(self):
+        """IDs of jobs whose charge may or may not have committed"""
+        rows = self.db.get().execute("SELECT id FROM jobs WHERE state = 'pending' ORDER BY id").fetchall()
+        return [row["id"] for row in rows]
+
+    def _update(self, job_id, **fields):
+        fields["updated_at"] = datetime.now().isoformat()
+        columns = ", ".join(f"{name} = ?" for name in fields)
+        with self.db.write() as conn:
+            conn.execute(f"UPDATE jobs SET {columns} WHERE id = ?", (*fields.values(), job_id))
+
+    def start(self, job_id):
+        with self.db.write() as conn:
+            conn.execute(
+                "UPDATE jobs SET state = 'running', attempts = attempts + 1, updated_at = ? WHERE id = ?",
+                (datetime.now().isoformat(), job_id)
+            )
+        return self.get(job_id)
+
+    def save_progress(self, job_id, progress):
+        self._update(job_id, progress=json.dumps(progress))
+
+    def queue(self, job_id):
+        self._update(job_id, state="queued")
+
+    def cancel(self, job_id):
+        self._update(job_id, state="cancelled")
+
+    def finish(self, job_id):
+        self._update(job_id, state="done", error=None)
+
+    def fail(self, job_id, error, final):
+        self._update(job_id, state="refunding" if final else "queued", error=error)
+
+    def refunded(self, job_id):
+        self._update(job_id, state="failed")
+
+    def counts(self):
+        rows = self.db.get().execute("SELECT state, COUNT(*) AS n FROM jobs GROUP BY state").fetchall()
+        return {row["state"]: row["n"] for row in rows}
+
+
+POOL_SCHEMA = """
+CREATE TABLE IF NOT EXISTS pool (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    plan_id TEXT,
+    client TEXT NOT NULL,
+    subscription TEXT,
+    created_at TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS pool_plan ON pool(plan_id, id);
+CREATE TABLE IF NOT EXISTS pool_metrics (
+    name TEXT PRIMARY KEY,
+    value REAL NOT NULL
+);
+"""
+
+
+def parse_pool_plans(spec):
+    """"basic:3,pro:1" -> {"basic": 3, "pro": 1}"""
+    plans = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        plan_id, _, count = item.rpartition(":")
+        plans[plan_id] = int(count)
+    return plans
+
+
+class WarmPool:
+    """Plesk clients (and subscriptions for popular plans) created ahead of time.
+
+    Entries live next to the jobs in the provisioning database; plan_id is
+    NULL for a bare client. A claim hands an entry to a job in the same
+    write that records it as the job's progress, so a crash cannot lose a
+    claimed client. A background task tops the pool back up to its targets.
+    """
+
+    def __init__(self, jobs, plesk, size=PLESK_POOL_SIZE, plans=None, refill_interval=PLESK_POOL_REFILL_INTERVAL):
+        self.db = jobs.db
+        self.db.get().executescript(POOL_SCHEMA)
+        self.plesk = plesk
+        self.targets = {None: size}
+        self.targets.update(parse_pool_plans(PLESK_POOL_PLANS) if plans is None else plans)
+        self.refill_interval = refill_interval
+        # Claim times per pool key, matched against refills to measure lag
+        self._claims = {key: deque() for key in self.targets}
+        self._wake = None
+        self._task = None
+
+    @property
+    def enabled(self):
+        return any(self.targets.values())
+
+    @staticmethod
+    def _bump(conn, name, amount=1):
+        conn.execute(
+            "INSERT INTO pool_metrics (name, value) VALUES (?, ?)"
+            " ON CONFLICT(name) DO UPDATE SET value = value + excluded.value",
+            (name, amount)
+        )
+
+    def _claim(self, job_id, plan_id):
+        with self.db.write() as conn:
+            self._bump(conn, "claims")
+            for key in (str(plan_id), None):
+                row = conn.execute(
+                    "SELECT * FROM pool WHERE plan_id IS ? ORDER BY id LIMIT 1", (key,)
+                ).fetchone()
+                if row:
+                    break
+            else:
+                self._bump(conn, "misses")
+                return None, None
+            progress = {"client": json.loads(row["client"]), "pooled": True}
+            if row["subscription"]:
+                progress["subscription"] = json.loads(row["subscription"])
+                self._bump(conn, "subscription_hits")
+            self._bump(conn, "hits")
+            conn.execute("DELETE FROM pool WHERE id = ?", (row["id"],))
+            conn.execute(
+                "UPDATE jobs SET progress = ?, updated_at = ? WHERE id = ?",
+                (json.dumps(progress), datetime.now().isoformat(), job_id)
+            )
+            return row["plan_id"], progress
+
+    async def claim(self, job_id, plan_id):
+        """Hand a pooled entry to a job, preferring a ready subscription for plan_id.
+
+        Returns the job's new progress, or None if the pool is empty.
+        """
+        key, progress = await db.run(self._claim, job_id, plan_id)
+        if progress is not None:
+            self._claims.setdefault(key, deque()).append(time.monotonic())
+            if self._wake:
+                self._wake.set()
+        return progress
+
+    def _add(self, plan_id, client, subscription=None):
+        with self.db.write() as conn:
+            conn.execute(
+                "INSERT INTO pool (plan_id, client, subscription, created_at) VALUES (?, ?, ?, ?)",
+                (plan_id, json.dumps(client), json.dumps(subscription) if subscription else None,
+                 datetime.now().isoformat())
+            )
+            self._bump(conn, "refills")
+            claims = self._claims.get(plan_id)
+            if claims:
+                lag = time.monotonic() - claims.popleft()
+                self._bump(conn, "refill_lag_total", lag)
+                self._bump(conn, "refill_lag_count")
+                conn.execute(
+                    "INSERT INTO pool_metrics (name, value) VALUES ('refill_lag_max', ?)"
+                    " ON CONFLICT(name) DO UPDATE SET value = MAX(value, excluded.value)",
+                    (lag,)
+                )
+
+    def available(self):
+        rows = self.db.get().execute("SELECT plan_id, COUNT(*) AS n FROM pool GROUP BY plan_id").fetchall()
+        return {row["plan_id"]: row["n"] for row in rows}
+
+    def stats(self):
+        """Pool size per plan, hit rate and refill lag"""
+        metrics = {row["name"]: row["value"] for row in self.db.get().execute("SELECT * FROM pool_metrics")}
+        claims = metrics.get("claims", 0)
+        lag_count = metrics.get("refill_lag_count", 0)
+        return {
+            "available": {key or "client": count for key, count in self.available().items()},
+            "targets": {key or "client": count for key, count in self.targets.items()},
+            "claims": int(claims),
+            "hits": int(metrics.get("hits", 0)),
+            "subscription_hits": int(metrics.get("subscription_hits", 0)),
+            "misses": int(metrics.get("misses", 0)),
+            "hit_rate": metrics.get("hits", 0) / claims if claims else 0.0,
+            "refills": int(metrics.get("refills", 0)),
+            "refill_lag_avg": metrics.get("refill_lag_total", 0) / lag_count if lag_count else 0.0,
+            "refill_lag_max": metrics.get("refill_lag_max", 0.0),
+        }
+
+    async def _create(self, plan_id):
+        client = await self.plesk.create_client()
+        subscription = None
+        if plan_id is not None:
+            subscription = await self.plesk.create_subscription(client["plesk_client_id"], plan_id)
+        await db.run(self._add, plan_id, client, subscription)
+
+    async def refill(self):
+        """Create whatever is missing to reach the targets, returns how many entries were added"""
+        available = await db.run(self.available)
+        pending = [
+            self._create(plan_id)
+            for plan_id, target in self.targets.items()
+            for _ in range(target - available.get(plan_id, 0))
+        ]
+        results = await asyncio.gather(*pending, return_exceptions=True)
+        for error in (r for r in results if isinstance(r, Exception)):
+            logger.warning(f"Refilling the Plesk pool failed: {str(error)}")
+        return sum(1 for r in results if not isinstance(r, Exception))
+
+    async def start(self):
+        self._wake = asyncio.Event()
+        self._task = asyncio.create_task(self._refill_loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _refill_loop(self):
+        while True:
+            await self.refill()
+            try:
+                await asyncio.wait_for(self._wake.wait(), self.refill_interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wake.clear()
+
+
+class ProvisioningWorkers:
+    """Runs provisioning jobs on a pool of asyncio workers.
+
+    A job is reserved before its purchase is charged, and the charge records
+    a purchase marker for the job in the same transaction; submit() then
+    queues it. Pending jobs left by a crash are settled from that marker on
+    start. A job that succeeds stores the subscription on the user and drops
+    the marker together; one that still fails after max_attempts is refunded
+    at most once, guarded by the marker. notify(job, subscription, error) is
+    awaited once a job is done or failed. New purchases take a client from
+    the warm pool when one is given and not empty.
+    """
+
+    def __init__(self, jobs, plesk, notify, workers=PROVISIONING_WORKERS,
+                 max_attempts=PROVISIONING_MAX_ATTEMPTS, retry_delay=5, pool=None):
+        self.jobs = jobs
+        self.plesk = plesk
+        self.notify = notify
+        self.pool = pool
+        self.workers = workers
+        self.max_attempts = max_attempts
+        self.retry_delay = retry_delay
+        self._queue = None
+        self._tasks = []
+
+    async def start(self):
+        """Spawn the workers and resume jobs left over from a previous run"""
+        if self.pool:
+            await self.pool.start()
+        self._queue = asyncio.Queue()
+        for job_id in await db.run(self.jobs.pending):
+            await self._settle(job_id)
+        for job_id in await db.run(self.jobs.unfinished):
+            self._queue.put_nowait(job_id)
+        self._tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self.pool:
+            await self.pool.stop()
+
+    async def reserve(self, user_id, chat_id, kind, offer):
+        """Persist a pending job for a purchase about to be charged"""
+        return await db.run(self.jobs.create, user_id, chat_id, kind, offer)
+
+    async def submit(self, job_id):
+        """Queue a reserved job once its purchase has been charged"""
+        await db.run(self.jobs.queue, job_id)
+        self._queue.put_nowait(job_id)
+
+    async def settle(self, job_id):
+        """Queue a pending job if its charge committed, cancel it otherwise"""
+        if await self._settle(job_id):
+            self._queue.put_nowait(job_id)
+            return True
+        return False
+
+    async def _settle(self, job_id):
+        if await db.get_purchase(job_id):
+            await db.run(self.jobs.queue, job_id)
+            return True
+        await db.run(self.jobs.cancel, job_id)
+        return False
+
+    async def _worker(self):
+        while True:
+            job_id = await self._queue.get()
+            try:
+                await self._run(job_id)
+            except Exception as e:
+                logger.error(f"Provisioning job {job_id} crashed: {str(e)}")
+            finally:
+                self._queue.task_done()
+
+    async def _run(self, job_id):
+        job = await db.run(self.jobs.get, job_id)
+        if job["state"] == "refunding":
+            await self._refund_failed(job, job["error"])
+            return
+        job = await db.run(self.jobs.start, job_id)
+        try:
+            subscription = await self._provision(job)
+        except Exception as e:
+            final = job["attempts"] >= self.max_attempts
+            await db.run(self.jobs.fail, job_id, str(e), final)
+            if not final:
+                logger.warning(f"Provisioning job {job_id} failed (attempt {job['attempts']}), retrying: {str(e)}")
+                asyncio.get_running_loop().call_later(
+                    self.retry_delay * job["attempts"], self._queue.put_nowait, job_id
+                )
+                return
+            logger.error(f"Provisioning job {job_id} failed, refunding: {str(e)}")
+            await self._refund_failed(job, str(e))
+            return
+
+        def complete(tx):
+            tx.set_subscription(job["user_id"], subscription)
+            tx.delete_purchase(job_id)
+
+        await db.in_transaction(complete)
+        await db.run(self.jobs.finish, job_id)
+        await self.notify(job, subscription, None)
+
+    async def _refund_failed(self, job, error):
+        """Refund the purchase and remove what Plesk created.
+
+        The job stays refunding, and is resumed after a restart, until the
+        refund has committed. Only a job whose purchase marker is still there
+        is refunded and cleaned up, so a job settled twice never pays back
+        twice or deletes a client that is in use.
+        """
+        try:
+            refunded = await db.in_transaction(lambda tx: self._refund(tx, job))
+        except Exception as e:
+            logger.error(f"Refunding job {job['id']} failed, retrying: {str(e)}")
+            asyncio.get_running_loop().call_later(self.retry_delay, self._queue.put_nowait, job["id"])
+            return
+        if refunded:
+            client = (await db.run(self.jobs.get, job["id"]))["progress"].get("client")
+            if client:
+                try:
+                    await self.plesk.delete_client(client["plesk_client_id"])
+                except Exception as cleanup_error:
+                    logger.warning(f"Could not remove client of failed job {job['id']}: {str(cleanup_error)}")
+        await db.run(self.jobs.refunded, job["id"])
+        if refunded:
+            await db.in_transaction(lambda tx: tx.delete_purchase(job["id"]))
+            await self.notify(job, None, error)
+
+    async def _provision(self, job):
+        """Make the Plesk calls for a job, returns the user's new subscription"""
+        offer = job["offer"]
+        if job["kind"] == "update":
+            user = await db.get_user(job["user_id"])
+            current = user["subscription"]
+            if current.get("status") == "suspended":
+                domain = current.get("credentials", {}).get("domain")
+                if domain:
+                    await self.plesk.unsuspend_subscription(domain)
+                current = reactivated(current)
+            await self.plesk.update_subscription(
+                current.get("subscription_id", current["plesk_client_id"]),
+                offer["plesk_plan_id"]
+            )
+            return dict(current, plan=offer["name"], **subscription_period(offer))
+
+        progress = job["progress"]
+        if "client" not in progress and self.pool:
+            progress = await self.pool.claim(job["id"], offer["plesk_plan_id"]) or progress
+        if "client" not in progress:
+            progress["client"] = await self.plesk.create_client()
+            await db.run(self.jobs.save_progress, job["id"], progress)
+        client = progress["client"]
+        subscription = progress.get("subscription")
+        if subscription is None:
+            subscription = await self.plesk.create_subscription(client["plesk_client_id"], offer["plesk_plan_id"])
+            progress["subscription"] = subscription
+            await db.run(self.jobs.save_progress, job["id"], progress)
+        return {
+            "plan": offer["name"],
+            **subscription_period(offer),
+            "plesk_client_id": client["plesk_client_id"],
+            "subscription_id": subscription["subscription_id"],
+            "credentials": {
+                "username": client["username"],
+                "password": client["password"],
+                "domain": subscription["domain"]
+            }
+        }
+
+    @staticmethod
+    def _refund(tx, job):
+        """Pay a failed job's purchase back, returns False if its marker is gone"""
+        purchase = tx.get_purchase(job["id"])
+        if purchase is not None and purchase["state"] != "charged":
+            # Refunded by an earlier attempt that stopped before cleaning up
+            return True
+        if purchase is None and job.get("charged"):
+            # Never charged, or settled already
+            return False
+        price = job["offer"]["price"]
+        tx.adjust_balance(job["user_id"], price)
+        tx.add_transaction(user_id=job["user_id"], transaction_type="refund", amount=price)
+        tx.set_purchase(job["id"], {"user_id": job["user_id"], "amount": price, "state": "refunded"})
+        return True
@@ -0,0 +1,99 @@
+import asyncio
+import fcntl
+import os
+import struct
+import threading
+import time
+
+# Plesk requests per second shared by every process (bot, admin, workers)
+PLESK_RATE_LIMIT = float(os.getenv("PLESK_RATE_LIMIT", "10"))
+# Requests allowed back to back after a quiet period
+PLESK_RATE_BURST = int(os.getenv("PLESK_RATE_BURST", "20"))
+PLESK_RATE_LIMIT_FILE = os.getenv("PLESK_RATE_LIMIT_FILE", "plesk.ratelimit")
+
+# tokens, wall-clock time of the last update
+_STATE = struct.Struct("<dd")
+
+
+class TokenBucket:
+    """Token bucket shared between processes through a small state file.
+
+    Each call takes a token under an exclusive flock. When the bucket is
+    empty the token is borrowed and the caller is told how long to wait, so
+    concurrent callers queue up at exactly `rate` per second instead of
+    polling.
+    """
+
+    def __init__(self, path=PLESK_RATE_LIMIT_FILE, rate=PLESK_RATE_LIMIT, burst=PLESK_RATE_BURST):
+        self.path = path
+        self.rate = rate
+        self.burst = burst
+        self._fd = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _open(self):
+        # flock is per open file description, so each process needs its own
+        if self._pid != os.getpid():
+            self._fd = os.open(self.path, os.O_RDWR | os.O_CREAT, 0o644)
+            self._pid = os.getpid()
+        return self._fd
+
+    def reserve(self, blocking=True):
+        """Take a token, returns the seconds to wait before using it.
+
+        With blocking=False returns None instead of waiting when another
+        thread or process holds the state file.
+        """
+        if self.rate <= 0:
+            return 0.0
+        if not self._lock.acquire(blocking):
+            return None
+        try:
+            fd = self._open()
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+            except BlockingIOError:
+                return None
+            try:
+                raw = os.pread(fd, _STATE.size, 0)
+                now = time.time()
+                if len(raw) == _STATE.size:
+                    tokens, updated = _STATE.unpack(raw)
+                    tokens = min(self.burst, tokens + max(0.0, now - updated) * self.rate)
+                else:
+                    tokens = self.burst
+                tokens -= 1
+                os.pwrite(fd, _STATE.pack(tokens, now), 0)
+            finally:
+                fcntl.flock(fd, fcntl.LOCK_UN)
+        finally:
+            self._lock.release()
+        return 0.0 if tokens >= 0 else -tokens / self.rate
+
+    def acquire(self):
+        """Block until a request may be sent"""
+        delay = self.reserve()
+        if delay:
+            time.sleep(delay)
+
+    async def acquire_async(self):
+        """Wait, without blocking the event loop, until a request may be sent.
+
+        The state file is locked in a worker thread when it is busy.
+        """
+        delay = self.reserve(blocking=False)
+        if delay is None:
+            delay = await asyncio.to_thread(self.reserve)
+        if delay:
+            await asyncio.sleep(delay)
+
+
+_buckets = {}
+
+
+def get_bucket(path=PLESK_RATE_LIMIT_FILE):
+    """Process-wide bucket for a state file"""
+    if path not in _buckets:
+        _buckets[path] = TokenBucket(path)
+    return _buckets[path]
@@ -0,0 +1,81 @@
+import logging
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+import data_manager
+import metrics
+
+logger = logging.getLogger(__name__)
+
+# Seconds between reconciliation passes
+RECONCILE_INTERVAL = int(os.getenv("RECONCILE_INTERVAL", "300"))
+# NOWPayments status requests in flight at once
+RECONCILE_CONCURRENCY = int(os.getenv("RECONCILE_CONCURRENCY", "8"))
+
+POLLED = metrics.counter("payments_reconciled_total", "Open payments polled by the reconciler", ["outcome"])
+
+
+class PaymentReconciler(threading.Thread):
+    """Catches up on payments whose webhook never arrived.
+
+    Each pass takes the open payments from the store's pending index, asks
+    NOWPayments for their status with at most `concurrency` requests in
+    flight, and hands the ones whose status changed to apply_batch (the
+    webhook's idempotent credit_payments) in one transaction. A pass costs
+    one request per open payment, whatever the number of users.
+    """
+
+    def __init__(self, nowpayments, apply_batch, concurrency=RECONCILE_CONCURRENCY, interval=RECONCILE_INTERVAL):
+        super().__init__(name="payment-reconciler", daemon=True)
+        self.nowpayments = nowpayments
+        self.apply_batch = apply_batch
+        self.concurrency = concurrency
+        self.interval = interval
+        self._stopping = threading.Event()
+
+    def stop(self):
+        self._stopping.set()
+
+    def _poll(self, payment):
+        try:
+            return self.nowpayments.get_payment_status(payment["payment_id"])
+        except Exception as e:
+            logger.warning(f"Could not poll payment {payment['payment_id']}: {e}")
+            return None
+
+    def reconcile(self):
+        """Run one pass, returns {outcome: count} for the polled payments"""
+        pending = data_manager.get_pending_payments()
+        if not pending:
+            return {}
+        with ThreadPoolExecutor(max_workers=self.concurrency, thread_name_prefix="reconciler") as pool:
+            polled = list(pool.map(self._poll, pending))
+        outcomes = {}
+        changed = []
+        for payment, current in zip(pending, polled):
+            if current is None:
+                outcome = "error"
+            elif current.get("payment_status") == payment["status"]:
+                outcome = "unchanged"
+            else:
+                # credit_payments finds the user through the order id
+                current.setdefault("order_id", f"deposit_{payment['user_id']}")
+                changed.append(current)
+                continue
+            outcomes[outcome] = outcomes.get(outcome, 0) + 1
+        if changed:
+            for outcome in self.apply_batch(changed):
+                outcomes[outcome] = outcomes.get(outcome, 0) + 1
+        for outcome, count in outcomes.items():
+            POLLED.inc(count, outcome=outcome)
+        return outcomes
+
+    def run(self):
+        while not self._stopping.is_set():
+            try:
+                outcomes = self.reconcile()
+                if outcomes:
+                    logger.info(f"Reconciled open payments: {outcomes}")
+            except Exception as e:
+                logger.error(f"Payment reconciliation failed, will retry: {e}")
+            self._stopping.wait(self.interval)
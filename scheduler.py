@@ -0,0 +1,163 @@
+import asyncio
+import logging
+import os
+from datetime import date, datetime, time, timedelta
+import async_data_manager as db
+import data_manager
+from storage import expiry_key
+
+logger = logging.getLogger(__name__)
+
+# Due subscriptions renewed or suspended per transaction
+SCHEDULER_BATCH_SIZE = int(os.getenv("SCHEDULER_BATCH_SIZE", "100"))
+# Longest sleep between checks, so expiry edits made by the admin app are seen
+SCHEDULER_MAX_SLEEP = int(os.getenv("SCHEDULER_MAX_SLEEP", "3600"))
+
+
+def subscription_period(offer, start=None):
+    """Billing fields stored on a subscription bought from an offer"""
+    start = start or date.today()
+    return {
+        "offer_id": offer.get("id"),
+        "price": offer["price"],
+        "duration_days": offer["duration_days"],
+        "expiry": (start + timedelta(days=offer["duration_days"])).isoformat()
+    }
+
+
+def reactivated(subscription):
+    """A suspended subscription without its suspension marks, so it is scheduled again"""
+    return {k: v for k, v in subscription.items() if k not in ("status", "suspended_at")}
+
+
+def renewed_expiry(subscription, today):
+    # Extend from the old expiry, but never bill for days spent expired
+    start = max(date.fromisoformat(subscription["expiry"][:10]), today - timedelta(days=1))
+    return (start + timedelta(days=subscription["duration_days"])).isoformat()
+
+
+class ExpiryScheduler:
+    """Renews or suspends subscriptions once their expiry date has passed.
+
+    Due subscriptions come from the store's expiry index, so a pass never
+    reads the rest of the users. Each batch is renewed from the wallet in one
+    transaction; subscriptions the wallet cannot cover are suspended in Plesk.
+    notify(user_id, text) is awaited for every renewal and suspension.
+    """
+
+    def __init__(self, plesk, notify=None, batch_size=SCHEDULER_BATCH_SIZE, max_sleep=SCHEDULER_MAX_SLEEP):
+        self.plesk = plesk
+        self.notify = notify
+        self.batch_size = batch_size
+        self.max_sleep = max_sleep
+        self._task = None
+
+    async def start(self):
+        self._task = asyncio.create_task(self._loop())
+
+    async def stop(self):
+        if self._task:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _loop(self):
+        while True:
+            try:
+                await self.run_once()
+                delay = await self._seconds_until_due()
+            except Exception as e:
+                logger.error(f"Expiry pass failed: {str(e)}")
+                delay = 60
+            await asyncio.sleep(delay)
+
+    async def _seconds_until_due(self):
+        expiry = await db.run(data_manager.next_expiry)
+        if expiry is None:
+            return self.max_sleep
+        try:
+            # A subscription is due once its expiry date is over
+            due_at = datetime.combine(date.fromisoformat(expiry[:10]) + timedelta(days=1), time())
+        except ValueError:
+            logger.warning(f"Malformed subscription expiry {expiry!r}, checking again in {self.max_sleep} s")
+            return self.max_sleep
+        return min(max((due_at - datetime.now()).total_seconds(), 0), self.max_sleep)
+
+    async def run_once(self, today=None):
+        """Process every due subscription, returns (renewed, suspended) user IDs"""
+        today = today or date.today()
+        renewed, suspended, failed = [], [], set()
+        while True:
+            due = await db.run(data_manager.get_due_subscriptions, today.isoformat(), self.batch_size + len(failed))
+            due = [user["id"] for user in due if user["id"] not in failed]
+            if not due:
+                return renewed, suspended
+            batch_renewed, to_suspend = await db.in_transaction(lambda tx: self._renew(tx, due, today))
+            renewed.extend(batch_renewed)
+            done = await self._suspend(to_suspend, today)
+            suspended.extend(done)
+            # Whatever was neither renewed nor suspended is not asked for again in this pass
+            failed.update(set(due) - set(batch_renewed) - set(done))
+            for user_id in batch_renewed:
+                await self._notify(user_id, "🔄 Your subscription has been renewed from your wallet balance.")
+            for user_id in done:
+                await self._notify(
+                    user_id,
+                    "⚠️ Your subscription has expired and was suspended.\n"
+                    "Top up your wallet and buy a plan to reactivate it."
+                )
+
+    def _renew(self, tx, user_ids, today):
+        """Renew what the wallet covers, returns (renewed IDs, [(ID, subscription)] to suspend)"""
+        renewed, to_suspend = [], []
+        for user_id in user_ids:
+            user = tx.get_user(user_id)
+            subscription = user and user.get("subscription")
+            key = expiry_key(subscription)
+            # Changed since it was read from the index
+            if not key or key >= today.isoformat():
+                continue
+            try:
+                expiry = renewed_expiry(subscription, today)
+            except ValueError:
+                logger.warning(f"Subscription of user {user_id} has a malformed expiry {key!r}, skipping it")
+                continue
+            price = subscription.get("price")
+            if price is not None and user.get("wallet_balance", 0) >= price:
+                tx.adjust_balance(user_id, -price)
+                tx.add_transaction(user_id=user_id, transaction_type="renewal", amount=-price)
+                tx.set_subscription(user_id, dict(subscription, expiry=expiry))
+                renewed.append(user_id)
+            else:
+                to_suspend.append((user_id, subscription))
+        return renewed, to_suspend
+
+    async def _suspend(self, items, today):
+        """Suspend in Plesk, then mark the subscriptions; returns the IDs that were suspended"""
+        async def suspend(user_id, subscription):
+            domain = subscription.get("credentials", {}).get("domain")
+            if domain:
+                await self.plesk.suspend_subscription(domain)
+            else:
+                logger.warning(f"Subscription of user {user_id} has no domain, only marking it suspended")
+            return user_id
+
+        results = await asyncio.gather(*(suspend(*item) for item in items), return_exceptions=True)
+        suspended = []
+        for (user_id, _), result in zip(items, results):
+            if isinstance(result, Exception):
+                logger.error(f"Suspending subscription of user {user_id} failed: {str(result)}")
+            else:
+                suspended.append(user_id)
+
+        def mark(tx):
+            for user_id in suspended:
+                subscription = tx.get_user(user_id)["subscription"]
+                tx.set_subscription(user_id, dict(subscription, status="suspended", suspended_at=today.isoformat()))
+        if suspended:
+            await db.in_transaction(mark)
+        return suspended
+
+    async def _notify(self, user_id, text):
+        if self.notify:
+            await self.notify(user_id, text)
@@ -0,0 +1,90 @@
+import json
+import mmap
+import os
+
+# Encoding of users.db: "json" (compact) or "msgpack" (needs `pip install msgpack`).
+# Either is read back regardless of this setting, so it can be changed at any time.
+DB_FORMAT = os.getenv("DB_FORMAT", "json")
+
+
+class JSONSerializer:
+    name = "json"
+
+    def dumps(self, data):
+        return json.dumps(data, separators=(",", ":")).encode()
+
+    def loads(self, buffer):
+        # json cannot parse from a buffer, so the mapping is copied once
+        return json.loads(buffer[:])
+
+
+class MsgpackSerializer:
+    name = "msgpack"
+
+    def __init__(self):
+        try:
+            import msgpack
+        except ImportError:
+            raise RuntimeError("DB_FORMAT=msgpack needs the msgpack package (pip install msgpack)")
+        self.msgpack = msgpack
+
+    def dumps(self, data):
+        return self.msgpack.packb(data, use_bin_type=True)
+
+    def loads(self, buffer):
+        # Decodes straight from the mapping, without copying the file
+        return self.msgpack.unpackb(buffer, raw=False, strict_map_key=False)
+
+
+SERIALIZERS = {
+    "json": JSONSerializer,
+    "msgpack": MsgpackSerializer,
+}
+
+
+def get_serializer(name=DB_FORMAT):
+    if name not in SERIALIZERS:
+        raise ValueError(f"Unknown DB_FORMAT: {name}")
+    return SERIALIZERS[name]()
+
+
+def detect_format(head):
+    """Format of a snapshot from its first byte; JSON documents start with '{' (or whitespace)"""
+    return "json" if head[:1] in (b"{", b" ", b"\n", b"\r", b"\t") else "msgpack"
+
+
+def write_snapshot(path, payload):
+    """Replace the file at path with payload, never leaving a partial file behind.
+
+    The bytes go to a temporary file that is fsynced and renamed over path;
+    the directory is fsynced too, so the rename survives a crash.
+    """
+    tmp = f"{path}.tmp"
+    with open(tmp, "wb") as f:
+        f.write(payload)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp, path)
+    dir_fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def read_snapshot(path):
+    """Decode a snapshot through a read-only memory map, whatever its format"""
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size == 0:
+            return {"users": [], "offers": []}
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            return _reader(detect_format(mapped[:1])).loads(mapped)
+
+
+_readers = {}
+
+
+def _reader(name):
+    if name not in _readers:
+        _readers[name] = get_serializer(name)
+    return _readers[name]
@@ -0,0 +1,1380 @@
+import copy
+import json
+import os
+import fcntl
+import heapq
+import itertools
+from bisect import bisect_left, insort
+import sqlite3
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime
+from archive import HistoryArchive, month_of
+from journal import Journal
+import metrics
+from snapshot import get_serializer, read_snapshot, write_snapshot
+
+LOCK_WAIT = metrics.histogram(
+    "storage_lock_wait_seconds", "Time spent waiting for a store's lock", ["store", "mode"]
+)
+READ_SECONDS = metrics.histogram("storage_read_seconds", "Parsing users.db after it changed", ["store"])
+WRITE_SECONDS = metrics.histogram("storage_write_seconds", "Writing users.db or committing to SQLite", ["store"])
+
+
+def new_record(transaction_type, amount, currency=None):
+    """Build a history entry"""
+    return {
+        "type": transaction_type,
+        "amount": amount,
+        "currency": currency,
+        "timestamp": datetime.now().isoformat()
+    }
+
+# Transaction types summed into total_revenue (refunds cancel a purchase)
+REVENUE_TYPES = ("purchase", "refund", "renewal")
+# Every transaction type written
+TRANSACTION_TYPES = ("deposit",) + REVENUE_TYPES
+# Journal records read backwards for recent transactions of one type
+RECENT_SCAN_LIMIT = int(os.getenv("RECENT_SCAN_LIMIT", "10000"))
+
+
+def compute_stats(users, history):
+    """Dashboard counters computed from scratch"""
+    return {
+        "total_users": len(users),
+        "active_subscriptions": sum(1 for u in users if u.get("subscription")),
+        "total_revenue": sum(r["amount"] for r in history if r["type"] in REVENUE_TYPES)
+    }
+
+
+def expiry_key(subscription):
+    """Expiry date the scheduler should act on, None for subscriptions it leaves alone.
+
+    Subscriptions bought before durations were stored (no duration_days)
+    and suspended ones are not scheduled.
+    """
+    if not subscription or subscription.get("duration_days") is None or subscription.get("status") == "suspended":
+        return None
+    return subscription.get("expiry")
+
+
+# NOWPayments statuses after which a payment never changes again
+FINAL_PAYMENT_STATUSES = ("finished", "failed", "refunded", "expired", "partially_paid")
+
+
+def build_payment_index(payments):
+    """Open payments by status, then payment_id, with their updated_at"""
+    index = {}
+    for payment_id, payment in payments.items():
+        if payment["status"] not in FINAL_PAYMENT_STATUSES:
+            index.setdefault(payment["status"], {})[payment_id] = payment.get("updated_at")
+    return index
+
+
+def build_expiry_heap(users):
+    heap = [[expiry_key(u.get("subscription")), u["id"]] for u in users if expiry_key(u.get("subscription"))]
+    heapq.heapify(heap)
+    return heap
+
+
+def walk_expiry_heap(heap, users_by_id, before=None, limit=None):
+    """Users whose current expiry is earliest, in expiry order, without touching the rest.
+
+    Explores the heap from its root, so only entries up to the last match are
+    read. Entries left behind by an older expiry of the same user are skipped.
+    """
+    frontier = [(heap[0][0], heap[0][1], 0)] if heap else []
+    seen = set()
+    matches = []
+    while frontier and (limit is None or len(matches) < limit):
+        expiry, user_id, index = heapq.heappop(frontier)
+        if before is not None and expiry >= before:
+            break
+        user = users_by_id.get(user_id)
+        if user and user_id not in seen and expiry_key(user.get("subscription")) == expiry:
+            seen.add(user_id)
+            matches.append(user)
+        for child in (2 * index + 1, 2 * index + 2):
+            if child < len(heap):
+                heapq.heappush(frontier, (heap[child][0], heap[child][1], child))
+    return matches
+
+
+# Sort orders offered by list_users
+USER_SORTS = ("created", "balance")
+
+
+def user_summary(user):
+    """The columns shown in the admin user list"""
+    subscription = user.get("subscription")
+    return {
+        "id": user["id"],
+        "username": user.get("username"),
+        "wallet_balance": user.get("wallet_balance", 0),
+        "plan": subscription.get("plan") if subscription else None,
+        "created_at": user.get("created_at")
+    }
+
+
+def _prefix_range(keys, prefix):
+    """Slice bounds of the (key, id) entries whose key starts with prefix"""
+    start = bisect_left(keys, (prefix,))
+    end = bisect_left(keys, (prefix + "\uffff",), start)
+    return start, end
+
+
+class UserIndex:
+    """Sorted views of one snapshot's users for the admin list.
+
+    Users are kept in creation (insertion) order and by balance; usernames
+    and IDs are sorted as text so a prefix search is a bisect. A page is a
+    slice of one of these, so it costs O(page size) plus O(matches) when
+    searching. Built once from a loaded snapshot, then kept up to date with
+    update() for each user a write changed.
+    """
+
+    def __init__(self, users):
+        self.summaries = {u["id"]: user_summary(u) for u in users}
+        self.balances = sorted((s["wallet_balance"], user_id) for user_id, s in self.summaries.items())
+        self.orders = {
+            "created": [u["id"] for u in users],
+            "balance": [user_id for _, user_id in self.balances],
+        }
+        self.created_rank = None
+        self.names = sorted((u["username"].lower(), u["id"]) for u in users if u.get("username"))
+        self.ids = sorted((str(u["id"]), u["id"]) for u in users)
+
+    def update(self, user):
+        """Replace the entries of one added or changed user"""
+        user_id = user["id"]
+        summary = user_summary(user)
+        old = self.summaries.get(user_id)
+        if old is None:
+            self.orders["created"].append(user_id)
+            if self.created_rank is not None:
+                self.created_rank[user_id] = len(self.created_rank)
+            insort(self.ids, (str(user_id), user_id))
+        else:
+            if old["wallet_balance"] == summary["wallet_balance"] and old["username"] == summary["username"]:
+                self.summaries[user_id] = summary
+                return
+            pos = bisect_left(self.balances, (old["wallet_balance"], user_id))
+            del self.balances[pos], self.orders["balance"][pos]
+            if old["username"]:
+                del self.names[bisect_left(self.names, (old["username"].lower(), user_id))]
+        self.summaries[user_id] = summary
+        pos = bisect_left(self.balances, (summary["wallet_balance"], user_id))
+        self.balances.insert(pos, (summary["wallet_balance"], user_id))
+        self.orders["balance"].insert(pos, user_id)
+        if summary["username"]:
+            insort(self.names, (summary["username"].lower(), user_id))
+
+    def _sort_key(self, sort):
+        if sort == "balance":
+            return lambda user_id: (self.summaries[user_id]["wallet_balance"], user_id)
+        if self.created_rank is None:
+            self.created_rank = {user_id: n for n, user_id in enumerate(self.orders["created"])}
+        return self.created_rank.__getitem__
+
+    def search(self, query):
+        """IDs whose username or Telegram ID starts with query"""
+        start, end = _prefix_range(self.names, query.lower())
+        matches = {user_id for _, user_id in self.names[start:end]}
+        if query.isdigit():
+            start, end = _prefix_range(self.ids, query)
+            matches.update(user_id for _, user_id in self.ids[start:end])
+        return matches
+
+    def page(self, query=None, sort="created", descending=False, limit=50, offset=0):
+        if query:
+            order = sorted(self.search(query), key=self._sort_key(sort), reverse=descending)
+            total = len(order)
+            ids = order[offset:offset + limit]
+        else:
+            order = self.orders[sort]
+            total = len(order)
+            if descending:
+                end = max(total - offset, 0)
+                ids = order[max(end - limit, 0):end][::-1]
+            else:
+                ids = order[offset:offset + limit]
+        return [dict(self.summaries[user_id]) for user_id in ids], total
+
+
+class JSONStorage:
+    """Original storage layout: one document holding users and offers.
+
+    The parsed document is cached in-process. Every writer bumps a generation
+    counter kept in the lock file, so a reader only re-parses after a write
+    from this or another process (or when the file's inode/mtime/size change).
+    The document is encoded with the configured serializer (DB_FORMAT) and
+    replaced atomically on every write.
+
+    Transactions live in the journal; compact_history() moves old months into
+    the archive and keeps a `history_checkpoint` (count, balance and totals
+    per type of the archived records) on each user.
+
+    The journal is appended before the document is replaced. Records written
+    with a document change carry its `commit_seq`, which the document stores,
+    so records of a commit that crashed before the document was replaced are
+    dropped on open and before the next write (_recover_locked).
+    """
+
+    def __init__(self, path, serializer=None):
+        self.path = path
+        self.serializer = serializer or get_serializer()
+        self.name = os.path.basename(path)
+        self.lock_path = path + ".lock"
+        self.journal = Journal(path + ".journal")
+        self.archive = HistoryArchive(path + ".archive")
+        self._open_lock()
+        self._snapshot = None
+        self._snapshot_key = None
+        self._users_by_id = {}
+        self._offers_by_id = {}
+        self._user_index = None
+        self.hits = 0
+        self.misses = 0
+        with self._locked(fcntl.LOCK_EX):
+            self._recover_locked()
+
+    def _open_lock(self):
+        # flock is shared by everything using the same open file, so a forked
+        # child must open its own descriptor to be excluded from its parent
+        self._pid = os.getpid()
+        self._lock_fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+        self._mutex = threading.RLock()
+
+    def _check_fork(self):
+        if self._pid != os.getpid():
+            self._open_lock()
+
+    def _generation(self):
+        raw = os.pread(self._lock_fd, 8, 0)
+        return int.from_bytes(raw, "little") if len(raw) == 8 else 0
+
+    def _file_key(self):
+        try:
+            st = os.stat(self.path)
+        except FileNotFoundError:
+            return (self._generation(), None)
+        return (self._generation(), st.st_ino, st.st_mtime_ns, st.st_size)
+
+    def _remember(self, data, key, changed_users=None):
+        """Cache a snapshot; changed_users are the IDs a write from this
+        process changed, None when the users may differ in any way"""
+        self._snapshot = data
+        self._snapshot_key = key
+        self._users_by_id = {u["id"]: u for u in data.get("users", [])}
+        self._offers_by_id = {o["id"]: o for o in data.get("offers", [])}
+        if changed_users is None or self._user_index is None:
+            # Built on the first list_users() after a load
+            self._user_index = None
+            return
+        for user_id in changed_users:
+            self._user_index.update(self._users_by_id[user_id])
+
+    @contextmanager
+    def _locked(self, mode):
+        self._check_fork()
+        start = time.perf_counter()
+        with self._mutex:
+            fcntl.flock(self._lock_fd, mode)
+            LOCK_WAIT.observe(
+                time.perf_counter() - start, store=self.name, mode="exclusive" if mode == fcntl.LOCK_EX else "shared"
+            )
+            try:
+                yield
+            finally:
+                fcntl.flock(self._lock_fd, fcntl.LOCK_UN)
+
+    def _read(self):
+        """Return the cached document, re-parsing only if the file changed.
+
+        The result is shared and must not be mutated.
+        """
+        self._check_fork()
+        with self._mutex:
+            if self._snapshot is not None and self._file_key() == self._snapshot_key:
+                self.hits += 1
+                return self._snapshot
+            with self._locked(fcntl.LOCK_SH):
+                return self._read_locked()
+
+    def cache_stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+    def load(self):
+        """Load the whole document including every user's history
+        (a private copy the caller may modify)"""
+        with self._locked(fcntl.LOCK_SH):
+            data = copy.deepcopy(self._read_locked())
+            for user in data.get("users", []):
+                archived = self.archive.read(user["id"]) if user.get("history_checkpoint") else []
+                user["history"] = archived + user.get("history", []) + self.journal.read(user["id"])
+        return data
+
+    def _read_locked(self):
+        key = self._file_key()
+        if self._snapshot is not None and key == self._snapshot_key:
+            self.hits += 1
+            return self._snapshot
+        self.misses += 1
+        if key[1] is None:
+            data = {"users": [], "offers": []}
+        else:
+            with READ_SECONDS.time(store=self.name):
+                data = read_snapshot(self.path)
+        self._remember(data, key)
+        return data
+
+    def _write_locked(self, data, changed_users=None):
+        with WRITE_SECONDS.time(store=self.name):
+            write_snapshot(self.path, self.serializer.dumps(data))
+        os.pwrite(self._lock_fd, (self._generation() + 1).to_bytes(8, "little"), 0)
+        self._remember(data, self._file_key(), changed_users)
+
+    def _recover_locked(self):
+        """Drop journal records of a commit whose document write never happened"""
+        committed = self._read_locked().get("commit_seq", 0)
+        last = self.journal.last_seq()
+        if last and last[0] > committed:
+            self.journal.truncate(last[1])
+
+    def _commit_locked(self, entries, data=None, changed_users=None):
+        """Append journal entries and, if given, write the document as one commit"""
+        if data is None:
+            self.journal.append(entries)
+            return
+        seq = self._snapshot.get("commit_seq", 0) + 1
+        self.journal.append(entries, seq)
+        data["commit_seq"] = seq
+        try:
+            self._write_locked(data, changed_users)
+        except BaseException:
+            self._recover_locked()
+            raise
+
+    def save(self, data):
+        """Write the whole document.
+
+        History is append-only: entries beyond the stored count go to the journal.
+        """
+        with self._locked(fcntl.LOCK_EX):
+            self._recover_locked()
+            data = copy.deepcopy(data)
+            entries = []
+            for user in data.get("users", []):
+                history = user.pop("history", [])
+                legacy = self._users_by_id.get(user["id"], {}).get("history", [])
+                if legacy:
+                    user["history"] = legacy
+                archived = self._users_by_id.get(user["id"], {}).get("history_checkpoint", {}).get("count", 0)
+                stored = archived + len(legacy) + self.journal.count(user["id"])
+                entries.extend((user["id"], record) for record in history[stored:])
+            version = self._snapshot.get("offers_version", 0)
+            data["offers_version"] = version + (data.get("offers", []) != self._snapshot.get("offers", []))
+            stats = self._snapshot.get("stats")
+            if stats:
+                revenue = stats["total_revenue"] + sum(r["amount"] for _, r in entries if r["type"] in REVENUE_TYPES)
+                data["stats"] = dict(compute_stats(data.get("users", []), []), total_revenue=revenue)
+            else:
+                data.pop("stats", None)
+            data.pop("recent", None)
+            if "expiry_heap" in self._snapshot:
+                data["expiry_heap"] = build_expiry_heap(data.get("users", []))
+            self._commit_locked(entries, data)
+
+    @contextmanager
+    def transaction(self):
+        """Read-modify-write under one exclusive lock, written once on success.
+
+        Transactions must not be nested.
+        """
+        with self._locked(fcntl.LOCK_EX):
+            self._recover_locked()
+            tx = JSONTransaction(copy.deepcopy(self._read_locked()))
+            yield tx
+            self._commit_locked(tx.journal_entries, tx.data if tx.dirty else None, tx.changed_users)
+
+    def commit_batch(self, funcs):
+        """Apply func(tx) for every func with one lock, one write and one fsync.
+
+        Returns a (result, exception) pair per func. A func that raises leaves
+        no trace: the batch is replayed on a fresh copy without it, so funcs
+        must act only through tx.
+        """
+        with self._locked(fcntl.LOCK_EX):
+            self._recover_locked()
+            snapshot = self._read_locked()
+            errors = {}
+            while True:
+                tx = JSONTransaction(copy.deepcopy(snapshot))
+                results = {}
+                for i, func in enumerate(funcs):
+                    if i in errors:
+                        continue
+                    try:
+                        results[i] = func(tx)
+                    except Exception as e:
+                        errors[i] = e
+                        break
+                else:
+                    break
+            self._commit_locked(tx.journal_entries, tx.data if tx.dirty else None, tx.changed_users)
+        return [(results.get(i), errors.get(i)) for i in range(len(funcs))]
+
+    def get_user(self, user_id):
+        """Get a user without history"""
+        with self._mutex:
+            self._read()
+            user = self._users_by_id.get(user_id)
+            if not user:
+                return None
+            return copy.deepcopy({k: v for k, v in user.items() if k != "history"})
+
+    def list_users(self, query=None, sort="created", descending=False, limit=50, offset=0):
+        """A page of user summaries and the number of matching users"""
+        with self._mutex:
+            data = self._read()
+            if self._user_index is None:
+                self._user_index = UserIndex(data.get("users", []))
+            return self._user_index.page(query, sort, descending, limit, offset)
+
+    def iter_users(self):
+        """Yield every user without history, from the snapshot current at the first call"""
+        with self._mutex:
+            users = self._read().get("users", [])
+        for user in users:
+            yield copy.deepcopy({k: v for k, v in user.items() if k != "history"})
+
+    def iter_transactions(self, start=None, end=None, transaction_type=None, user_id=None):
+        """Yield transactions (with user_id) oldest first, optionally in [start, end).
+
+        Only the setup holds the lock: the journal is append-only, so the
+        bytes present at that point are streamed afterwards without it.
+        """
+        with self._locked(fcntl.LOCK_SH):
+            data = self._read_locked()
+            size = self.journal.size()
+            offsets = None if user_id is None else self.journal.offsets(user_id)
+            users = data.get("users", []) if user_id is None else [self._users_by_id.get(user_id, {})]
+            months = [m for m in self.archive.months() if m < data.get("archived_before", "")]
+
+        def wanted(record):
+            return ((transaction_type is None or record["type"] == transaction_type)
+                    and (start is None or record["timestamp"] >= start)
+                    and (end is None or record["timestamp"] < end))
+
+        # Archived months come first, segments never change once written
+        for month in months:
+            if (start and month < month_of(start)) or (end and month > month_of(end)):
+                continue
+            for record_user_id, record in self.archive.scan(month, user_id):
+                if wanted(record):
+                    yield dict(record, user_id=record_user_id)
+        # Entries still embedded in users.db predate the journal
+        for user in users:
+            for record in user.get("history", []):
+                if wanted(record):
+                    yield dict(record, user_id=user["id"])
+        if not size:
+            return
+        begin = self.journal.find_time(start, size) if start and offsets is None else 0
+        for record_user_id, record in self.journal.scan(begin, size, offsets):
+            if end is not None and record["timestamp"] >= end:
+                return
+            if wanted(record):
+                yield dict(record, user_id=record_user_id)
+
+    def get_history(self, user_id, limit=None, offset=0):
+        """Up to `limit` history entries, skipping the `offset` most recent, oldest first.
+
+        Pages reaching past the journal continue into the archive.
+        """
+        with self._locked(fcntl.LOCK_SH):
+            self._read_locked()
+            user = self._users_by_id.get(user_id, {})
+            records = self.journal.read(user_id, limit, offset)
+            # Entries still embedded in users.db predate the journal
+            legacy = user.get("history", [])
+            hot = len(legacy) + self.journal.count(user_id)
+            end = max(len(legacy) - max(offset - self.journal.count(user_id), 0), 0)
+            start = 0 if limit is None else max(end - (limit - len(records)), 0)
+            records = copy.deepcopy(legacy[start:end]) + records
+            archived = user.get("history_checkpoint", {}).get("count", 0)
+        if archived and (limit is None or len(records) < limit):
+            remaining = None if limit is None else limit - len(records)
+            records = self.archive.read(user_id, remaining, max(offset - hot, 0)) + records
+        return records
+
+    def history_count(self, user_id):
+        with self._locked(fcntl.LOCK_SH):
+            self._read_locked()
+            user = self._users_by_id.get(user_id, {})
+            archived = user.get("history_checkpoint", {}).get("count", 0)
+            return archived + len(user.get("history", [])) + self.journal.count(user_id)
+
+    def migrate_history(self):
+        """Move history embedded in users.db into the journal, keeping time order"""
+        with self._locked(fcntl.LOCK_EX):
+            self._recover_locked()
+            data = copy.deepcopy(self._read_locked())
+            legacy = [(u["id"], r) for u in data["users"] for r in u.pop("history", [])]
+            if not legacy:
+                return 0
+            entries = sorted(legacy + list(self.journal), key=lambda e: e[1]["timestamp"])
+            self.journal.rewrite(entries)
+            self._write_locked(data, changed_users=())
+            return len(legacy)
+
+    def compact_history(self, before):
+        """Move transactions of the months before `before` (an ISO date) into
+        the archive, one segment per month, and fold them into each user's
+        history_checkpoint. Returns the number of records moved.
+
+        The archive is written first, then the journal, then users.db, so a
+        run interrupted at any point is completed by the next one.
+        """
+        self.migrate_history()
+        cutoff = month_of(before)
+        with self._locked(fcntl.LOCK_EX):
+            self._recover_locked()
+            data = copy.deepcopy(self._read_locked())
+            archived_before = data.get("archived_before", "")
+            if cutoff <= archived_before:
+                return 0
+            moved, kept = {}, []
+            for user_id, record in self.journal:
+                month = month_of(record["timestamp"])
+                if month < cutoff:
+                    moved.setdefault(month, []).append((user_id, record))
+                else:
+                    kept.append((user_id, record))
+            for month, entries in sorted(moved.items()):
+                self.archive.write_month(month, entries)
+            users = {u["id"]: u for u in data.get("users", [])}
+            # Segments left by an interrupted run are folded in as well
+            for month in self.archive.months():
+                if not archived_before <= month < cutoff:
+                    continue
+                for user_id, record in moved.get(month) or self.archive.scan(month):
+                    if user_id not in users:
+                        continue
+                    checkpoint = users[user_id].setdefault(
+                        "history_checkpoint", {"count": 0, "balance": 0, "totals": {}}
+                    )
+                    checkpoint["before"] = f"{cutoff}-01"
+                    checkpoint["count"] += 1
+                    checkpoint["balance"] += record["amount"]
+                    totals = checkpoint["totals"]
+                    totals[record["type"]] = totals.get(record["type"], 0) + record["amount"]
+            data["archived_before"] = cutoff
+            self.journal.rewrite(kept)
+            self._write_locked(data, changed_users=())
+            return sum(len(entries) for entries in moved.values())
+
+    def get_stats(self):
+        """Dashboard counters, None until they have been built"""
+        stats = self._read().get("stats")
+        return dict(stats) if stats else None
+
+    def rebuild_stats(self):
+        """Recompute the dashboard counters from scratch"""
+        with self._locked(fcntl.LOCK_EX):
+            self._recover_locked()
+            data = copy.deepcopy(self._read_locked())
+            users = data.get("users", [])
+            history = [(u["id"], r) for u in users for r in u.get("history", [])] + list(self.journal)
+            history.sort(key=lambda e: e[1]["timestamp"])
+            data["stats"] = compute_stats(users, [r for _, r in history])
+            data["stats"]["total_revenue"] += sum(
+                amount for u in users
+                for kind, amount in u.get("history_checkpoint", {}).get("totals", {}).items()
+                if kind in REVENUE_TYPES
+            )
+            # Older versions kept a copy of the newest transactions here
+            data.pop("recent", None)
+            self._write_locked(data, changed_users=())
+            return dict(data["stats"])
+
+    def rebuild_expiry_index(self):
+        """Build the expiry heap from every user's subscription"""
+        with self._locked(fcntl.LOCK_EX):
+            data = copy.deepcopy(self._read_locked())
+            data["expiry_heap"] = build_expiry_heap(data.get("users", []))
+            self._write_locked(data, changed_users=())
+            return len(data["expiry_heap"])
+
+    def _walk_expiry(self, before, limit):
+        if "expiry_heap" not in self._read():
+            self.rebuild_expiry_index()
+        with self._mutex:
+            data = self._read()
+            users = walk_expiry_heap(data["expiry_heap"], self._users_by_id, before, limit)
+            return copy.deepcopy([{k: v for k, v in u.items() if k != "history"} for u in users])
+
+    def get_due_subscriptions(self, before, limit=100):
+        """Users whose subscription expiry is earlier than `before`, soonest first"""
+        return self._walk_expiry(before, limit)
+
+    def next_expiry(self):
+        """Earliest scheduled expiry, None if nothing is scheduled"""
+        users = self._walk_expiry(None, 1)
+        return expiry_key(users[0]["subscription"]) if users else None
+
+    def get_recent_transactions(self, limit=10, transaction_type=None):
+        """Newest transactions across all users, newest first.
+
+        The journal is in time order, so this reads it backwards from the end
+        and stops after `limit` matches. Filtered by type, at most the last
+        RECENT_SCAN_LIMIT records are read, so a rare type may return fewer.
+        """
+        with self._locked(fcntl.LOCK_SH):
+            self._read_locked()
+            size = self.journal.size()
+            users = self._users_by_id
+        matches = []
+        records = self.journal.scan_backwards(size)
+        if transaction_type is not None:
+            records = itertools.islice(records, RECENT_SCAN_LIMIT)
+        for user_id, record in records:
+            if transaction_type is None or record["type"] == transaction_type:
+                matches.append(dict(record, user_id=user_id, username=users.get(user_id, {}).get("username")))
+                if len(matches) == limit:
+                    break
+        return matches
+
+    def rebuild_payment_index(self):
+        """Build the open payments index from every recorded payment"""
+        with self._locked(fcntl.LOCK_EX):
+            data = copy.deepcopy(self._read_locked())
+            data["pending_payments"] = build_payment_index(data.get("payments", {}))
+            self._write_locked(data, changed_users=())
+
+    def get_pending_payments(self, limit=None):
+        """Payments not in a final status, least recently updated first.
+
+        Served from the pending_payments index, so the cost follows the
+        number of open payments.
+        """
+        if "pending_payments" not in self._read():
+            self.rebuild_payment_index()
+        with self._mutex:
+            data = self._read()
+            open_ids = [
+                (updated_at or "", payment_id)
+                for by_id in data["pending_payments"].values() for payment_id, updated_at in by_id.items()
+            ]
+            open_ids.sort()
+            return [dict(data["payments"][payment_id]) for _, payment_id in open_ids[:limit]]
+
+    def get_offers(self):
+        return copy.deepcopy(self._read().get("offers", []))
+
+    def get_offers_version(self):
+        """Counter bumped whenever offers change"""
+        return self._read().get("offers_version", 0)
+
+    def get_offer(self, offer_id):
+        with self._mutex:
+            self._read()
+            offer = self._offers_by_id.get(offer_id)
+            return dict(offer) if offer else None
+
+    def get_purchase(self, job_id):
+        """Charge marker of a provisioning job, None if it was never charged or is settled"""
+        purchase = self._read().get("purchases", {}).get(str(job_id))
+        return dict(purchase) if purchase else None
+
+
+class JSONTransaction:
+    """Mutations applied to a private copy of the JSON document"""
+
+    def __init__(self, data):
+        self.data = data
+        self.dirty = False
+        self.journal_entries = []
+        # IDs of the users added or changed, to update the admin list index
+        self.changed_users = set()
+        self._users = {u["id"]: u for u in data.setdefault("users", [])}
+
+    def _index_expiry(self, user):
+        # The heap only exists once built; stale entries are skipped by readers
+        # and dropped when it is rebuilt
+        heap = self.data.get("expiry_heap")
+        if heap is None:
+            return
+        key = expiry_key(user.get("subscription"))
+        if key:
+            heapq.heappush(heap, [key, user["id"]])
+        if len(heap) > 2 * len(self._users) + 64:
+            self.data["expiry_heap"] = build_expiry_heap(self.data["users"])
+
+    def _bump(self, name, delta):
+        # Counters only exist once built by rebuild_stats()
+        if delta and "stats" in self.data:
+            self.data["stats"][name] += delta
+            self.dirty = True
+
+    def get_user(self, user_id):
+        user = self._users.get(user_id)
+        if not user:
+            return None
+        return copy.deepcopy({k: v for k, v in user.items() if k != "history"})
+
+    def add_user(self, user):
+        if user["id"] in self._users:
+            return False
+        user = copy.deepcopy(user)
+        user.setdefault("created_at", datetime.now().isoformat())
+        self.data["users"].append(user)
+        self._users[user["id"]] = user
+        for record in user.pop("history", []):
+            self._add_record(user["id"], record)
+        self.dirty = True
+        self.changed_users.add(user["id"])
+        self._index_expiry(user)
+        self._bump("total_users", 1)
+        self._bump("active_subscriptions", 1 if user.get("subscription") else 0)
+        return True
+
+    def save_user(self, user):
+        if user["id"] not in self._users:
+            return False
+        user = copy.deepcopy(user)
+        user.pop("history", None)
+        if "history" in self._users[user["id"]]:
+            user["history"] = self._users[user["id"]]["history"]
+        users = self.data["users"]
+        old = self._users[user["id"]]
+        users[users.index(old)] = user
+        self._users[user["id"]] = user
+        self.dirty = True
+        self.changed_users.add(user["id"])
+        self._index_expiry(user)
+        self._bump("active_subscriptions", bool(user.get("subscription")) - bool(old.get("subscription")))
+        return True
+
+    def adjust_balance(self, user_id, amount):
+        user = self._users.get(user_id)
+        if not user:
+            return False
+        user["wallet_balance"] = user.get("wallet_balance", 0) + amount
+        self.dirty = True
+        self.changed_users.add(user_id)
+        return True
+
+    def set_balance(self, user_id, amount):
+        user = self._users.get(user_id)
+        if not user:
+            return False
+        user["wallet_balance"] = amount
+        self.dirty = True
+        self.changed_users.add(user_id)
+        return True
+
+    def set_subscription(self, user_id, subscription):
+        user = self._users.get(user_id)
+        if not user:
+            return False
+        self._bump("active_subscriptions", bool(subscription) - bool(user.get("subscription")))
+        user["subscription"] = copy.deepcopy(subscription)
+        self.dirty = True
+        self.changed_users.add(user_id)
+        self._index_expiry(user)
+        return True
+
+    def add_transaction(self, user_id, transaction_type, amount, currency=None):
+        user = self._users.get(user_id)
+        if not user:
+            return False
+        self._add_record(user_id, new_record(transaction_type, amount, currency))
+        return True
+
+    def _add_record(self, user_id, record):
+        self.journal_entries.append((user_id, record))
+        if record["type"] in REVENUE_TYPES:
+            self._bump("total_revenue", record["amount"])
+
+    def save_offer(self, offer):
+        # The caller's dict is left alone, so a replayed batch still sees it without an id
+        offer = dict(offer)
+        offers = self.data.setdefault("offers", [])
+        if offer.get("id") is None:
+            offer["id"] = max((o["id"] for o in offers), default=0) + 1
+            offers.append(dict(offer))
+        else:
+            self.data["offers"] = [dict(offer) if o["id"] == offer["id"] else o for o in offers]
+        self._offers_changed()
+        return offer
+
+    def delete_offer(self, offer_id):
+        self.data["offers"] = [o for o in self.data.get("offers", []) if o["id"] != offer_id]
+        self._offers_changed()
+
+    def get_payment(self, payment_id):
+        payment = self.data.get("payments", {}).get(str(payment_id))
+        return dict(payment) if payment else None
+
+    def set_payment(self, payment_id, payment):
+        payments = self.data.setdefault("payments", {})
+        payment_id = str(payment_id)
+        previous = payments.get(payment_id)
+        payments[payment_id] = dict(payment, payment_id=payment_id)
+        self.dirty = True
+        # The index only exists once built
+        index = self.data.get("pending_payments")
+        if index is None:
+            return
+        if previous and previous["status"] in index:
+            index[previous["status"]].pop(payment_id, None)
+            if not index[previous["status"]]:
+                del index[previous["status"]]
+        if payment["status"] not in FINAL_PAYMENT_STATUSES:
+            index.setdefault(payment["status"], {})[payment_id] = payment.get("updated_at")
+
+    def get_purchase(self, job_id):
+        purchase = self.data.get("purchases", {}).get(str(job_id))
+        return dict(purchase) if purchase else None
+
+    def set_purchase(self, job_id, purchase):
+        self.data.setdefault("purchases", {})[str(job_id)] = dict(purchase)
+        self.dirty = True
+
+    def delete_purchase(self, job_id):
+        if self.data.get("purchases", {}).pop(str(job_id), None) is not None:
+            self.dirty = True
+
+    def _offers_changed(self):
+        self.data["offers_version"] = self.data.get("offers_version", 0) + 1
+        self.dirty = True
+
+
+class SQLiteConnections:
+    """Per-thread SQLite connections in WAL mode, with the schema applied once"""
+
+    def __init__(self, path, schema=None):
+        self.path = path
+        self._local = threading.local()
+        if schema:
+            self.get().executescript(schema)
+
+    def get(self):
+        # sqlite3 connections may not be shared between threads or processes
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.row_factory = sqlite3.Row
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+            self._local.pid = os.getpid()
+        return conn
+
+    def write(self):
+        """BEGIN IMMEDIATE ... COMMIT block"""
+        return _WriteTransaction(self.get(), os.path.basename(self.path))
+
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS users (
+    id INTEGER PRIMARY KEY,
+    username TEXT,
+    wallet_balance REAL NOT NULL DEFAULT 0,
+    subscription TEXT,
+    created_at TEXT
+);
+CREATE TABLE IF NOT EXISTS transactions (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    user_id INTEGER NOT NULL,
+    type TEXT NOT NULL,
+    amount REAL NOT NULL,
+    currency TEXT,
+    timestamp TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS transactions_user ON transactions(user_id, id);
+CREATE INDEX IF NOT EXISTS transactions_type ON transactions(type, id);
+CREATE INDEX IF NOT EXISTS transactions_time ON transactions(timestamp);
+CREATE TABLE IF NOT EXISTS stats (
+    name TEXT PRIMARY KEY,
+    value REAL NOT NULL
+);
+CREATE TRIGGER IF NOT EXISTS stats_user_insert AFTER INSERT ON users BEGIN
+    UPDATE stats SET value = value + 1 WHERE name = 'total_users';
+    UPDATE stats SET value = value + 1 WHERE name = 'active_subscriptions' AND NEW.subscription IS NOT NULL;
+END;
+CREATE TRIGGER IF NOT EXISTS stats_user_delete AFTER DELETE ON users BEGIN
+    UPDATE stats SET value = value - 1 WHERE name = 'total_users';
+    UPDATE stats SET value = value - 1 WHERE name = 'active_subscriptions' AND OLD.subscription IS NOT NULL;
+END;
+CREATE TRIGGER IF NOT EXISTS stats_subscription AFTER UPDATE OF subscription ON users BEGIN
+    UPDATE stats SET value = value + (NEW.subscription IS NOT NULL) - (OLD.subscription IS NOT NULL)
+        WHERE name = 'active_subscriptions';
+END;
+CREATE TRIGGER IF NOT EXISTS stats_purchase AFTER INSERT ON transactions WHEN NEW.type = 'purchase' BEGIN
+    UPDATE stats SET value = value + NEW.amount WHERE name = 'total_revenue';
+END;
+CREATE TRIGGER IF NOT EXISTS stats_refund AFTER INSERT ON transactions WHEN NEW.type = 'refund' BEGIN
+    UPDATE stats SET value = value + NEW.amount WHERE name = 'total_revenue';
+END;
+CREATE TRIGGER IF NOT EXISTS stats_renewal AFTER INSERT ON transactions WHEN NEW.type = 'renewal' BEGIN
+    UPDATE stats SET value = value + NEW.amount WHERE name = 'total_revenue';
+END;
+CREATE INDEX IF NOT EXISTS users_expiry ON users(json_extract(subscription, '$.expiry'))
+    WHERE json_extract(subscription, '$.duration_days') IS NOT NULL
+    AND json_extract(subscription, '$.status') IS NOT 'suspended';
+CREATE TABLE IF NOT EXISTS offers (
+    id INTEGER PRIMARY KEY,
+    name TEXT,
+    price REAL,
+    duration_days INTEGER,
+    plesk_plan_id TEXT
+);
+CREATE TABLE IF NOT EXISTS payments (
+    payment_id TEXT PRIMARY KEY,
+    user_id INTEGER,
+    status TEXT NOT NULL,
+    amount REAL,
+    currency TEXT,
+    updated_at TEXT
+);
+CREATE INDEX IF NOT EXISTS payments_pending ON payments(updated_at)
+    WHERE status NOT IN ('finished', 'failed', 'refunded', 'expired', 'partially_paid');
+CREATE TABLE IF NOT EXISTS purchases (
+    job_id TEXT PRIMARY KEY,
+    user_id INTEGER,
+    amount REAL,
+    state TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO meta (name, value) VALUES ('offers_version', 0);
+CREATE TRIGGER IF NOT EXISTS offers_version_insert AFTER INSERT ON offers BEGIN
+    UPDATE meta SET value = value + 1 WHERE name = 'offers_version';
+END;
+CREATE TRIGGER IF NOT EXISTS offers_version_update AFTER UPDATE ON offers BEGIN
+    UPDATE meta SET value = value + 1 WHERE name = 'offers_version';
+END;
+CREATE TRIGGER IF NOT EXISTS offers_version_delete AFTER DELETE ON offers BEGIN
+    UPDATE meta SET value = value + 1 WHERE name = 'offers_version';
+END;
+"""
+
+# Same condition as the users_expiry partial index, so queries can use it
+_SCHEDULED = (
+    "json_extract(subscription, '$.duration_days') IS NOT NULL"
+    " AND json_extract(subscription, '$.status') IS NOT 'suspended'"
+)
+
+# Indexes behind list_users, created once users.created_at exists
+USER_INDEXES = """
+CREATE INDEX IF NOT EXISTS users_created ON users(created_at, id);
+CREATE INDEX IF NOT EXISTS users_balance ON users(wallet_balance, id);
+CREATE INDEX IF NOT EXISTS users_username ON users(username COLLATE NOCASE);
+"""
+
+_USER_SORT_COLUMNS = {"created": "created_at", "balance": "wallet_balance"}
+# Rows fetched per query while streaming an export
+EXPORT_CHUNK_SIZE = 1000
+
+
+def _id_prefix_ranges(prefix, max_digits=19):
+    """[low, high) ranges of the positive integers whose decimal form starts with prefix"""
+    if prefix.startswith("0"):
+        return []
+    ranges = []
+    low, width = int(prefix), 1
+    for _ in range(max_digits - len(prefix) + 1):
+        ranges.append((low, low + width))
+        low, width = low * 10, width * 10
+    return ranges
+
+
+class SQLiteStorage:
+    """SQLite store in WAL mode with primary-key lookups by Telegram ID"""
+
+    def __init__(self, path):
+        self.path = path
+        self.db = SQLiteConnections(path, SCHEMA)
+        self._migrate()
+
+    def _migrate(self):
+        conn = self._conn()
+        columns = {row["name"] for row in conn.execute("PRAGMA table_info(users)")}
+        if "created_at" not in columns:
+            conn.execute("ALTER TABLE users ADD COLUMN created_at TEXT")
+        conn.executescript(USER_INDEXES)
+
+    def _conn(self):
+        return self.db.get()
+
+    def _write(self):
+        return self.db.write()
+
+    @staticmethod
+    def _user_from_row(row):
+        return {
+            "id": row["id"],
+            "username": row["username"],
+            "wallet_balance": row["wallet_balance"],
+            "subscription": json.loads(row["subscription"]) if row["subscription"] else None,
+            "created_at": row["created_at"]
+        }
+
+    def _history(self, conn, user_id):
+        rows = conn.execute(
+            "SELECT type, amount, currency, timestamp FROM transactions"
+            " WHERE user_id = ? ORDER BY id",
+            (user_id,)
+        )
+        return [dict(r) for r in rows]
+
+    def _upsert_user(self, conn, user):
+        subscription = user.get("subscription")
+        conn.execute(
+            "INSERT INTO users (id, username, wallet_balance, subscription, created_at) VALUES (?, ?, ?, ?, ?)"
+            " ON CONFLICT(id) DO UPDATE SET username = excluded.username,"
+            " wallet_balance = excluded.wallet_balance, subscription = excluded.subscription,"
+            " created_at = COALESCE(excluded.created_at, users.created_at)",
+            (user["id"], user.get("username"), user.get("wallet_balance", 0),
+             json.dumps(subscription) if subscription else None, user.get("created_at"))
+        )
+
+    def _insert_history(self, conn, user_id, records):
+        conn.executemany(
+            "INSERT INTO transactions (user_id, type, amount, currency, timestamp) VALUES (?, ?, ?, ?, ?)",
+            [(user_id, r["type"], r["amount"], r.get("currency"), r["timestamp"]) for r in records]
+        )
+
+    def load(self):
+        """Materialize the whole store in the JSON layout"""
+        conn = self._conn()
+        users = []
+        for row in conn.execute("SELECT * FROM users ORDER BY rowid"):
+            user = self._user_from_row(row)
+            user["history"] = self._history(conn, user["id"])
+            users.append(user)
+        return {"users": users, "offers": self.get_offers()}
+
+    def save(self, data):
+        """Replace users and offers with the contents of a JSON-layout document.
+
+        History is append-only, so only entries beyond the stored count are inserted.
+        """
+        with self._write() as conn:
+            ids = [u["id"] for u in data.get("users", [])]
+            for user in data.get("users", []):
+                self._upsert_user(conn, user)
+                stored = conn.execute(
+                    "SELECT COUNT(*) FROM transactions WHERE user_id = ?", (user["id"],)
+                ).fetchone()[0]
+                self._insert_history(conn, user["id"], user.get("history", [])[stored:])
+            conn.execute(
+                f"DELETE FROM users WHERE id NOT IN ({','.join('?' * len(ids))})", ids
+            )
+            conn.execute("DELETE FROM offers")
+            for offer in data.get("offers", []):
+                self._insert_offer(conn, offer)
+
+    @contextmanager
+    def transaction(self):
+        """BEGIN IMMEDIATE transaction committed once on success"""
+        with self._write() as conn:
+            yield SQLiteTransaction(self, conn)
+
+    def get_user(self, user_id):
+        """Get a user without history"""
+        row = self._conn().execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
+        return self._user_from_row(row) if row else None
+
+    def get_stats(self):
+        """Dashboard counters, None until they have been built"""
+        stats = {r["name"]: r["value"] for r in self._conn().execute("SELECT name, value FROM stats")}
+        return stats or None
+
+    def rebuild_stats(self):
+        """Recompute the dashboard counters from scratch and store them"""
+        with self._write() as conn:
+            stats = {
+                "total_users": conn.execute("SELECT COUNT(*) FROM users").fetchone()[0],
+                "active_subscriptions": conn.execute(
+                    "SELECT COUNT(*) FROM users WHERE subscription IS NOT NULL"
+                ).fetchone()[0],
+                "total_revenue": conn.execute(
+                    "SELECT COALESCE(SUM(amount), 0) FROM transactions WHERE type IN ('purchase', 'refund', 'renewal')"
+                ).fetchone()[0]
+            }
+            conn.executemany("INSERT OR REPLACE INTO stats (name, value) VALUES (?, ?)", stats.items())
+            return stats
+
+    def iter_users(self, chunk_size=EXPORT_CHUNK_SIZE):
+        """Yield every user without history, read in short keyset chunks"""
+        last_id = None
+        while True:
+            rows = self._conn().execute(
+                "SELECT * FROM users WHERE id > COALESCE(?, -9223372036854775808) ORDER BY id LIMIT ?",
+                (last_id, chunk_size)
+            ).fetchall()
+            for row in rows:
+                yield self._user_from_row(row)
+            if len(rows) < chunk_size:
+                return
+            last_id = rows[-1]["id"]
+
+    def iter_transactions(self, start=None, end=None, transaction_type=None, user_id=None,
+                          chunk_size=EXPORT_CHUNK_SIZE):
+        """Yield transactions (with user_id) oldest first, optionally in [start, end).
+
+        Rows are fetched in keyset chunks on id, so no read stays open
+        across the export.
+        """
+        conn = self._conn()
+        last_id = 0
+        if start:
+            first = conn.execute("SELECT MIN(id) FROM transactions WHERE timestamp >= ?", (start,)).fetchone()[0]
+            if first is None:
+                return
+            last_id = first - 1
+        where, params = "", []
+        if transaction_type is not None:
+            where += " AND type = ?"
+            params.append(transaction_type)
+        if user_id is not None:
+            where += " AND user_id = ?"
+            params.append(user_id)
+        while True:
+            rows = conn.execute(
+                "SELECT id, user_id, type, amount, currency, timestamp FROM transactions"
+                f" WHERE id > ?{where} ORDER BY id LIMIT ?",
+                [last_id] + params + [chunk_size]
+            ).fetchall()
+            for row in rows:
+                if end is not None and row["timestamp"] >= end:
+                    return
+                if start is None or row["timestamp"] >= start:
+                    yield {k: row[k] for k in ("type", "amount", "currency", "timestamp", "user_id")}
+            if len(rows) < chunk_size:
+                return
+            last_id = rows[-1]["id"]
+
+    def list_users(self, query=None, sort="created", descending=False, limit=50, offset=0):
+        """A page of user summaries and the number of matching users"""
+        where, params = "", []
+        if query:
+            # Prefix ranges keep both searches on an index. NOCASE compares
+            # lowercased text, so the bound is built from the lowercased query.
+            low = query.lower()
+            high = low[:-1] + chr(ord(low[-1]) + 1)
+            clauses = ["(username >= ? COLLATE NOCASE AND username < ? COLLATE NOCASE)"]
+            params = [low, high]
+            if query.isdigit():
+                for low, high in _id_prefix_ranges(query):
+                    clauses.append("(id >= ? AND id < ?)")
+                    params += [low, high]
+            where = "WHERE " + " OR ".join(clauses)
+        conn = self._conn()
+        total = conn.execute(f"SELECT COUNT(*) FROM users {where}", params).fetchone()[0]
+        direction = "DESC" if descending else "ASC"
+        rows = conn.execute(
+            f"SELECT id, username, wallet_balance, created_at, json_extract(subscription, '$.plan') AS plan"
+            f" FROM users {where} ORDER BY {_USER_SORT_COLUMNS[sort]} {direction}, id {direction} LIMIT ? OFFSET ?",
+            params + [limit, offset]
+        )
+        return [dict(row) for row in rows], total
+
+    def get_due_subscriptions(self, before, limit=100):
+        """Users whose subscription expiry is earlier than `before`, soonest first"""
+        rows = self._conn().execute(
+            f"SELECT * FROM users WHERE {_SCHEDULED}"
+            " AND json_extract(subscription, '$.expiry') > '' AND json_extract(subscription, '$.expiry') < ?"
+            " ORDER BY json_extract(subscription, '$.expiry') LIMIT ?",
+            (before, limit)
+        )
+        return [self._user_from_row(row) for row in rows]
+
+    def next_expiry(self):
+        """Earliest scheduled expiry, None if nothing is scheduled"""
+        return self._conn().execute(
+            f"SELECT MIN(json_extract(subscription, '$.expiry')) FROM users WHERE {_SCHEDULED}"
+            " AND json_extract(subscription, '$.expiry') > ''"
+        ).fetchone()[0]
+
+    def get_recent_transactions(self, limit=10, transaction_type=None):
+        """Newest transactions across all users, walked backwards through an index"""
+        where = "WHERE t.type = ?" if transaction_type else ""
+        rows = self._conn().execute(
+            "SELECT t.user_id, u.username, t.type, t.amount, t.currency, t.timestamp"
+            f" FROM transactions t LEFT JOIN users u ON u.id = t.user_id {where}"
+            " ORDER BY t.id DESC LIMIT ?",
+            ((transaction_type,) if transaction_type else ()) + (limit,)
+        )
+        return [dict(r) for r in rows]
+
+    def get_pending_payments(self, limit=None):
+        """Payments not in a final status, least recently updated first, from a partial index"""
+        rows = self._conn().execute(
+            "SELECT * FROM payments"
+            " WHERE status NOT IN ('finished', 'failed', 'refunded', 'expired', 'partially_paid')"
+            " ORDER BY updated_at LIMIT ?",
+            (-1 if limit is None else limit,)
+        )
+        return [dict(r) for r in rows]
+
+    def get_history(self, user_id, limit=None, offset=0):
+        """Up to `limit` history entries, skipping the `offset` most recent, oldest first"""
+        rows = self._conn().execute(
+            "SELECT type, amount, currency, timestamp FROM transactions"
+            " WHERE user_id = ? ORDER BY id DESC LIMIT ? OFFSET ?",
+            (user_id, -1 if limit is None else limit, offset)
+        ).fetchall()
+        return [dict(r) for r in reversed(rows)]
+
+    def history_count(self, user_id):
+        return self._conn().execute(
+            "SELECT COUNT(*) FROM transactions WHERE user_id = ?", (user_id,)
+        ).fetchone()[0]
+
+    def _insert_offer(self, conn, offer):
+        cur = conn.execute(
+            "INSERT OR REPLACE INTO offers (id, name, price, duration_days, plesk_plan_id)"
+            " VALUES (?, ?, ?, ?, ?)",
+            (offer.get("id"), offer["name"], offer["price"], offer["duration_days"], offer["plesk_plan_id"])
+        )
+        return dict(offer, id=cur.lastrowid if offer.get("id") is None else offer["id"])
+
+    def get_offers(self):
+        return [dict(r) for r in self._conn().execute("SELECT * FROM offers ORDER BY id")]
+
+    def get_offers_version(self):
+        """Counter bumped (by triggers) whenever offers change"""
+        return self._conn().execute("SELECT value FROM meta WHERE name = 'offers_version'").fetchone()[0]
+
+    def get_offer(self, offer_id):
+        row = self._conn().execute("SELECT * FROM offers WHERE id = ?", (offer_id,)).fetchone()
+        return dict(row) if row else None
+
+    def get_purchase(self, job_id):
+        """Charge marker of a provisioning job, None if it was never charged or is settled"""
+        row = self._conn().execute("SELECT * FROM purchases WHERE job_id = ?", (str(job_id),)).fetchone()
+        return dict(row) if row else None
+
+
+class SQLiteTransaction:
+    """Mutations executed inside an open SQLite write transaction"""
+
+    def __init__(self, storage, conn):
+        self.storage = storage
+        self.conn = conn
+
+    def _exists(self, user_id):
+        return self.conn.execute("SELECT 1 FROM users WHERE id = ?", (user_id,)).fetchone() is not None
+
+    def get_user(self, user_id):
+        row = self.conn.execute("SELECT * FROM users WHERE id = ?", (user_id,)).fetchone()
+        return self.storage._user_from_row(row) if row else None
+
+    def add_user(self, user):
+        if self._exists(user["id"]):
+            return False
+        user = dict(user, created_at=user.get("created_at") or datetime.now().isoformat())
+        self.storage._upsert_user(self.conn, user)
+        self.storage._insert_history(self.conn, user["id"], user.get("history", []))
+        return True
+
+    def save_user(self, user):
+        if not self._exists(user["id"]):
+            return False
+        self.storage._upsert_user(self.conn, user)
+        return True
+
+    def adjust_balance(self, user_id, amount):
+        cur = self.conn.execute(
+            "UPDATE users SET wallet_balance = wallet_balance + ? WHERE id = ?",
+            (amount, user_id)
+        )
+        return cur.rowcount > 0
+
+    def set_balance(self, user_id, amount):
+        cur = self.conn.execute("UPDATE users SET wallet_balance = ? WHERE id = ?", (amount, user_id))
+        return cur.rowcount > 0
+
+    def set_subscription(self, user_id, subscription):
+        cur = self.conn.execute(
+            "UPDATE users SET subscription = ? WHERE id = ?",
+            (json.dumps(subscription) if subscription else None, user_id)
+        )
+        return cur.rowcount > 0
+
+    def add_transaction(self, user_id, transaction_type, amount, currency=None):
+        if not self._exists(user_id):
+            return False
+        self.storage._insert_history(self.conn, user_id, [new_record(transaction_type, amount, currency)])
+        return True
+
+    def get_payment(self, payment_id):
+        row = self.conn.execute("SELECT * FROM payments WHERE payment_id = ?", (str(payment_id),)).fetchone()
+        return dict(row) if row else None
+
+    def set_payment(self, payment_id, payment):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO payments (payment_id, user_id, status, amount, currency, updated_at)"
+            " VALUES (?, ?, ?, ?, ?, ?)",
+            (str(payment_id), payment.get("user_id"), payment["status"], payment.get("amount"),
+             payment.get("currency"), payment.get("updated_at"))
+        )
+
+    def get_purchase(self, job_id):
+        row = self.conn.execute("SELECT * FROM purchases WHERE job_id = ?", (str(job_id),)).fetchone()
+        return dict(row) if row else None
+
+    def set_purchase(self, job_id, purchase):
+        self.conn.execute(
+            "INSERT OR REPLACE INTO purchases (job_id, user_id, amount, state) VALUES (?, ?, ?, ?)",
+            (str(job_id), purchase.get("user_id"), purchase.get("amount"), purchase["state"])
+        )
+
+    def delete_purchase(self, job_id):
+        self.conn.execute("DELETE FROM purchases WHERE job_id = ?", (str(job_id),))
+
+    def save_offer(self, offer):
+        return self.storage._insert_offer(self.conn, offer)
+
+    def delete_offer(self, offer_id):
+        self.conn.execute("DELETE FROM offers WHERE id = ?", (offer_id,))
+
+
+class _WriteTransaction:
+    """BEGIN IMMEDIATE ... COMMIT, rolled back on error"""
+
+    def __init__(self, conn, name=None):
+        self.conn = conn
+        self.name = name
+
+    def __enter__(self):
+        with LOCK_WAIT.time(store=self.name, mode="exclusive"):
+            self.conn.execute("BEGIN IMMEDIATE")
+        return self.conn
+
+    def __exit__(self, exc_type, exc, tb):
+        with WRITE_SECONDS.time(store=self.name):
+            self.conn.execute("ROLLBACK" if exc_type else "COMMIT")
+        return False
+
+
+def migrate_json_to_sqlite(json_path, sqlite_path):
+    """One-shot copy of a JSON users.db into a fresh SQLite store"""
+    source = JSONStorage(json_path).load()
+    target = SQLiteStorage(sqlite_path)
+    if target._conn().execute("SELECT 1 FROM users LIMIT 1").fetchone():
+        raise ValueError(f"{sqlite_path} already contains users")
+    target.save(source)
+    with target.transaction() as tx:
+        for payment_id, payment in source.get("payments", {}).items():
+            tx.set_payment(payment_id, payment)
+        for job_id, purchase in source.get("purchases", {}).items():
+            tx.set_purchase(job_id, purchase)
+    return len(source.get("users", [])), len(source.get("offers", []))
@@ -0,0 +1,18 @@
+import os
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import data_manager
+from storage import JSONStorage, SQLiteStorage
+
+
+@pytest.fixture(params=[JSONStorage, SQLiteStorage], ids=["json", "sqlite"])
+def store(request, tmp_path, monkeypatch):
+    """A fresh store of each backend behind data_manager"""
+    storage = request.param(str(tmp_path / "store"))
+    monkeypatch.setattr(data_manager, "_storage", storage)
+    monkeypatch.setattr(data_manager, "_committer", None)
+    return storage
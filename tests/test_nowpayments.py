@@ -0,0 +1,16 @@
+import data_manager
+from nowpayments import credit_payments
+
+
+def test_event_without_status_is_skipped(store):
+    with store.transaction() as tx:
+        tx.add_user({"id": 7, "username": "a", "wallet_balance": 0})
+    events = [
+        {"payment_id": 1, "order_id": "deposit_7_x", "price_amount": 5},
+        {"payment_id": 2, "payment_status": None, "order_id": "deposit_7_x", "price_amount": 5},
+        {"payment_id": 3, "payment_status": "finished", "order_id": "deposit_7_x", "price_amount": 5},
+    ]
+
+    assert credit_payments(events) == ["invalid payload", "invalid payload", "credited"]
+    assert data_manager.get_user(7)["wallet_balance"] == 5
+    assert data_manager.get_pending_payments() == []
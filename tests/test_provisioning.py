@@ -0,0 +1,93 @@
+import asyncio
+from datetime import date, timedelta
+
+import data_manager
+from provisioning import JobStore, ProvisioningWorkers
+from scheduler import ExpiryScheduler
+
+OFFER = {"id": 1, "name": "Basic", "price": 5.0, "duration_days": 30, "plesk_plan_id": "basic"}
+
+
+class FakePlesk:
+    def __init__(self):
+        self.calls = []
+
+    async def suspend_subscription(self, domain):
+        self.calls.append(("suspend", domain))
+
+    async def unsuspend_subscription(self, domain):
+        self.calls.append(("unsuspend", domain))
+
+    async def update_subscription(self, subscription_id, plan_id):
+        self.calls.append(("update", subscription_id))
+
+    async def delete_client(self, client_id):
+        self.calls.append(("delete", client_id))
+
+
+def test_buying_a_plan_reactivates_a_suspended_subscription(store, tmp_path):
+    expired = (date.today() - timedelta(days=2)).isoformat()
+    with store.transaction() as tx:
+        tx.add_user({"id": 1, "username": "a", "wallet_balance": 0, "subscription": {
+            "plan": "Basic", "price": 5.0, "duration_days": 30, "expiry": expired,
+            "plesk_client_id": 7, "subscription_id": 70, "credentials": {"domain": "a.example.com"},
+        }})
+    plesk = FakePlesk()
+    done = []
+
+    async def notify(job, subscription, error):
+        done.append((subscription, error))
+
+    async def scenario():
+        await ExpiryScheduler(plesk).run_once()
+        assert data_manager.get_user(1)["subscription"]["status"] == "suspended"
+        assert data_manager.next_expiry() is None
+
+        workers = ProvisioningWorkers(JobStore(str(tmp_path / "jobs.db")), plesk, notify, workers=1)
+        await workers.start()
+        job_id = await workers.reserve(1, 1, "update", OFFER)
+        data_manager.commit(lambda tx: tx.set_purchase(job_id, {"user_id": 1, "amount": 5.0, "state": "charged"}))
+        await workers.submit(job_id)
+        while not done:
+            await asyncio.sleep(0.01)
+        await workers.stop()
+
+    asyncio.run(scenario())
+
+    subscription = data_manager.get_user(1)["subscription"]
+    assert done[0][1] is None
+    assert "status" not in subscription and "suspended_at" not in subscription
+    assert data_manager.next_expiry() == subscription["expiry"] > expired
+    assert plesk.calls == [("suspend", "a.example.com"), ("unsuspend", "a.example.com"), ("update", 70)]
+
+
+def test_refund_cleans_up_only_jobs_whose_purchase_is_still_charged(store, tmp_path):
+    with store.transaction() as tx:
+        tx.add_user({"id": 1, "username": "a", "wallet_balance": 0})
+    jobs = JobStore(str(tmp_path / "jobs.db"))
+    plesk = FakePlesk()
+    notified = []
+
+    async def notify(job, subscription, error):
+        notified.append(job["id"])
+
+    workers = ProvisioningWorkers(jobs, plesk, notify, workers=1)
+    client = {"plesk_client_id": 7, "username": "u", "password": "p"}
+    settled, failed = (jobs.create(1, 1, "new", OFFER) for _ in range(2))
+    for job_id in (settled, failed):
+        jobs.save_progress(job_id, {"client": client})
+        jobs.fail(job_id, "boom", True)
+    data_manager.commit(lambda tx: tx.set_purchase(failed, {"user_id": 1, "amount": 5.0, "state": "charged"}))
+
+    async def scenario():
+        # settled already completed and dropped its marker, its client is in use
+        await workers._refund_failed(jobs.get(settled), "boom")
+        await workers._refund_failed(jobs.get(failed), "boom")
+        await workers._refund_failed(jobs.get(failed), "boom")
+
+    asyncio.run(scenario())
+
+    assert plesk.calls == [("delete", 7)]
+    assert notified == [failed]
+    assert data_manager.get_user(1)["wallet_balance"] == 5.0
+    assert data_manager.get_purchase(failed) is None
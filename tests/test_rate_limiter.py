@@ -0,0 +1,33 @@
+import asyncio
+import fcntl
+import os
+import threading
+
+from rate_limiter import TokenBucket
+
+
+def test_acquire_async_does_not_block_the_loop_while_the_file_is_locked(tmp_path):
+    bucket = TokenBucket(str(tmp_path / "plesk.ratelimit"), rate=100, burst=5)
+    bucket.reserve()
+    # Another process's lock: a separate open file description
+    fd = os.open(bucket.path, os.O_RDWR)
+    fcntl.flock(fd, fcntl.LOCK_EX)
+    assert bucket.reserve(blocking=False) is None
+
+    async def scenario():
+        ticks = 0
+
+        async def ticker():
+            nonlocal ticks
+            while True:
+                ticks += 1
+                await asyncio.sleep(0.01)
+
+        task = asyncio.create_task(ticker())
+        threading.Timer(0.2, fcntl.flock, (fd, fcntl.LOCK_UN)).start()
+        await bucket.acquire_async()
+        task.cancel()
+        return ticks
+
+    assert asyncio.run(scenario()) >= 10
+    os.close(fd)
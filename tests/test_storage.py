@@ -0,0 +1,109 @@
+import os
+import random
+import sys
+
+import pytest
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import storage as storage_module
+from storage import JSONStorage, SQLiteStorage, UserIndex
+
+OFFER = {"id": None, "name": "Basic", "price": 5.0, "duration_days": 30, "plesk_plan_id": "basic"}
+
+
+def failing(tx):
+    raise RuntimeError("boom")
+
+
+def test_commit_batch_replays_new_offer_after_failed_write(tmp_path):
+    storage = JSONStorage(str(tmp_path / "users.db"))
+    offer = dict(OFFER)
+
+    (saved, error), (_, failure) = storage.commit_batch([lambda tx: tx.save_offer(offer), failing])
+
+    assert error is None and isinstance(failure, RuntimeError)
+    assert offer["id"] is None
+    assert storage.get_offers() == [dict(OFFER, id=saved["id"])]
+
+
+@pytest.mark.parametrize("backend", [JSONStorage, SQLiteStorage])
+def test_save_offer_leaves_input_unchanged(tmp_path, backend):
+    storage = backend(str(tmp_path / "store"))
+    offer = dict(OFFER)
+
+    with storage.transaction() as tx:
+        saved = tx.save_offer(offer)
+
+    assert offer["id"] is None
+    assert storage.get_offer(saved["id"])["name"] == "Basic"
+
+
+def test_journal_records_of_unwritten_commit_are_dropped(tmp_path):
+    path = str(tmp_path / "users.db")
+    storage = JSONStorage(path)
+    with storage.transaction() as tx:
+        tx.add_user({"id": 1, "wallet_balance": 0})
+        tx.add_transaction(1, "deposit", 10)
+    # A crash after the journal append, before users.db was replaced
+    storage.journal.append([(1, {"type": "deposit", "amount": 5, "currency": None, "timestamp": "x"})],
+                           seq=storage._read()["commit_seq"] + 1)
+
+    reopened = JSONStorage(path)
+
+    assert [r["amount"] for r in reopened.get_history(1)] == [10]
+    with reopened.transaction() as tx:
+        tx.add_transaction(1, "deposit", 1)
+    assert [r["amount"] for r in reopened.get_history(1)] == [10, 1]
+
+
+@pytest.mark.parametrize("backend", [JSONStorage, SQLiteStorage])
+@pytest.mark.parametrize("query", ["Z", "z", "ZO", "zoe"])
+def test_list_users_prefix_search_ignores_case(tmp_path, backend, query):
+    storage = backend(str(tmp_path / "store"))
+    with storage.transaction() as tx:
+        tx.add_user({"id": 1, "username": "Zoe"})
+        tx.add_user({"id": 2, "username": "alice"})
+
+    users, total = storage.list_users(query)
+
+    assert total == 1 and [u["id"] for u in users] == [1]
+
+
+def test_recent_transactions_of_one_type_read_a_bounded_tail(tmp_path, monkeypatch):
+    monkeypatch.setattr(storage_module, "RECENT_SCAN_LIMIT", 5)
+    storage = JSONStorage(str(tmp_path / "users.db"))
+    with storage.transaction() as tx:
+        tx.add_user({"id": 1, "wallet_balance": 0})
+        tx.add_transaction(1, "refund", 3)
+        for _ in range(10):
+            tx.add_transaction(1, "deposit", 1)
+
+    assert storage.get_recent_transactions(10, "refund") == []
+    assert len(storage.get_recent_transactions(3, "deposit")) == 3
+
+
+def test_user_index_follows_writes_without_rebuilding(tmp_path):
+    storage = JSONStorage(str(tmp_path / "users.db"))
+    rng = random.Random(1)
+    with storage.transaction() as tx:
+        for user_id in range(1, 40):
+            tx.add_user({"id": user_id, "username": f"user{user_id}", "wallet_balance": rng.randint(0, 5)})
+    storage.list_users()
+    index = storage._user_index
+
+    for n in range(200):
+        user_id = rng.randint(1, 60)
+        with storage.transaction() as tx:
+            if not tx.add_user({"id": user_id, "username": rng.choice([None, f"new{n}", "Zed"])}):
+                tx.adjust_balance(user_id, rng.randint(-3, 3))
+                if rng.random() < 0.3:
+                    user = tx.get_user(user_id)
+                    tx.save_user(dict(user, username=rng.choice([None, f"renamed{n}", "zed"])))
+
+    assert storage._user_index is index
+    fresh = UserIndex(storage._read()["users"])
+    for query in (None, "z", "user1", "1", "ren"):
+        for sort in ("created", "balance"):
+            for descending in (False, True):
+                assert index.page(query, sort, descending, 500) == fresh.page(query, sort, descending, 500)
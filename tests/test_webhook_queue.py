@@ -0,0 +1,22 @@
+import os
+import sys
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from webhook_queue import WebhookQueue, WebhookWorker
+
+
+def test_prune_deletes_only_old_processed_events(tmp_path):
+    queue = WebhookQueue(str(tmp_path / "webhooks.db"))
+    for payment_id in (1, 2, 3):
+        queue.enqueue({"payment_id": payment_id, "payment_status": "finished"})
+    (old, _), (recent, _), _ = queue.fetch_batch()
+    queue.mark_processed([(old, "credited"), (recent, "credited")])
+    with queue.db.write() as conn:
+        conn.execute("UPDATE events SET processed_at = ? WHERE id = ?",
+                     ((datetime.now() - timedelta(days=30)).isoformat(), old))
+
+    assert WebhookWorker(queue, apply_batch=None, retention_days=7).prune() == 1
+    assert queue.pending() == 1
+    assert not queue.enqueue({"payment_id": 2, "payment_status": "finished"})
@@ -0,0 +1,145 @@
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime, timedelta
+from storage import SQLiteConnections
+
+logger = logging.getLogger(__name__)
+
+# Durable inbox for NOWPayments IPN callbacks
+WEBHOOK_QUEUE_FILE = os.getenv("WEBHOOK_QUEUE_FILE", "webhooks.db")
+# Events applied to the store per transaction
+WEBHOOK_BATCH_SIZE = int(os.getenv("WEBHOOK_BATCH_SIZE", "100"))
+# Days processed events are kept (redeliveries within this window are dropped at enqueue)
+WEBHOOK_RETENTION_DAYS = int(os.getenv("WEBHOOK_RETENTION_DAYS", "7"))
+# Seconds between prunes of processed events
+PRUNE_INTERVAL = 3600
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS events (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    payment_id TEXT NOT NULL,
+    payment_status TEXT,
+    payload TEXT NOT NULL,
+    received_at TEXT NOT NULL,
+    processed_at TEXT,
+    result TEXT,
+    UNIQUE (payment_id, payment_status)
+);
+CREATE INDEX IF NOT EXISTS events_pending ON events(id) WHERE processed_at IS NULL;
+CREATE INDEX IF NOT EXISTS events_processed ON events(processed_at) WHERE processed_at IS NOT NULL;
+"""
+
+
+class WebhookQueue:
+    """SQLite-backed queue of verified webhook payloads.
+
+    A redelivered notification (same payment_id and status) is dropped at
+    enqueue time by the unique index, so the worker sees each state change
+    of a payment once.
+    """
+
+    def __init__(self, path=WEBHOOK_QUEUE_FILE):
+        self.path = path
+        self.db = SQLiteConnections(path, SCHEMA)
+
+    def enqueue(self, payload):
+        """Store a payload, returns False if it was already queued"""
+        with self.db.write() as conn:
+            cursor = conn.execute(
+                "INSERT OR IGNORE INTO events (payment_id, payment_status, payload, received_at)"
+                " VALUES (?, ?, ?, ?)",
+                (str(payload.get("payment_id")), payload.get("payment_status"),
+                 json.dumps(payload), datetime.now().isoformat())
+            )
+            return cursor.rowcount == 1
+
+    def fetch_batch(self, limit=WEBHOOK_BATCH_SIZE):
+        """Oldest unprocessed events as (id, payload) pairs"""
+        rows = self.db.get().execute(
+            "SELECT id, payload FROM events WHERE processed_at IS NULL ORDER BY id LIMIT ?", (limit,)
+        ).fetchall()
+        return [(row["id"], json.loads(row["payload"])) for row in rows]
+
+    def mark_processed(self, results):
+        """Record the outcome of each event, results is a list of (id, result)"""
+        now = datetime.now().isoformat()
+        with self.db.write() as conn:
+            conn.executemany(
+                "UPDATE events SET processed_at = ?, result = ? WHERE id = ?",
+                [(now, result, event_id) for event_id, result in results]
+            )
+
+    def prune(self, before):
+        """Delete events processed before `before` (an ISO timestamp), returns how many"""
+        with self.db.write() as conn:
+            return conn.execute(
+                "DELETE FROM events WHERE processed_at IS NOT NULL AND processed_at < ?", (before,)
+            ).rowcount
+
+    def pending(self):
+        return self.db.get().execute("SELECT COUNT(*) FROM events WHERE processed_at IS NULL").fetchone()[0]
+
+
+class WebhookWorker(threading.Thread):
+    """Drains the queue into the store, one transaction per batch, and
+    deletes events processed more than `retention_days` ago"""
+
+    def __init__(self, queue, apply_batch, batch_size=WEBHOOK_BATCH_SIZE, poll_interval=5,
+                 retention_days=WEBHOOK_RETENTION_DAYS):
+        super().__init__(name="webhook-worker", daemon=True)
+        self.queue = queue
+        self.apply_batch = apply_batch
+        self.batch_size = batch_size
+        self.poll_interval = poll_interval
+        self.retention_days = retention_days
+        self._pruned_at = None
+        self._wake = threading.Event()
+        self._stopping = threading.Event()
+
+    def wake(self):
+        """Called after enqueue so new events are picked up right away"""
+        self._wake.set()
+
+    def stop(self):
+        self._stopping.set()
+        self._wake.set()
+
+    def apply_next_batch(self):
+        """Apply the oldest batch of queued events, returns how many were handled"""
+        batch = self.queue.fetch_batch(self.batch_size)
+        if batch:
+            outcomes = self.apply_batch([payload for _, payload in batch])
+            self.queue.mark_processed([(event_id, outcome) for (event_id, _), outcome in zip(batch, outcomes)])
+        return len(batch)
+
+    def drain(self):
+        """Apply queued events until the queue is empty, returns how many were handled"""
+        handled = 0
+        while True:
+            applied = self.apply_next_batch()
+            if not applied:
+                return handled
+            handled += applied
+
+    def prune(self):
+        """Delete processed events older than the retention window, returns how many"""
+        before = (datetime.now() - timedelta(days=self.retention_days)).isoformat()
+        self._pruned_at = time.monotonic()
+        return self.queue.prune(before)
+
+    def run(self):
+        while not self._stopping.is_set():
+            try:
+                self.drain()
+            except Exception as e:
+                logger.error(f"Applying webhook batch failed, will retry: {e}")
+            if self._pruned_at is None or time.monotonic() - self._pruned_at >= PRUNE_INTERVAL:
+                try:
+                    self.prune()
+                except Exception as e:
+                    logger.error(f"Pruning processed webhooks failed: {e}")
+            self._wake.wait(self.poll_interval)
+            self._wake.clear()